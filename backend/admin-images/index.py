@@ -1,85 +1,506 @@
 '''
 Business: Get all generated images for admin dashboard
-Args: event with httpMethod GET, optional query parameters for filtering
-Returns: HTTP response with list of all images and user data
+Args: event with httpMethod GET, optional query parameters for filtering, paging (cursor),
+      export=ndjson|csv and search=<text> with user_id, from, to, model, theme, after filters
+Returns: HTTP response with list of all images and user data, or an NDJSON/CSV export
 '''
 
+import base64
+import csv
+import io
 import json
 import os
-from typing import Dict, Any
-import psycopg2
+import functools
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Any, Callable, List, Tuple
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+ALLOWED_METHODS = ('GET', 'POST', 'OPTIONS')
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': ', '.join(ALLOWED_METHODS),
+    'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Key',
+    'Access-Control-Max-Age': CORS_MAX_AGE
+}
+
+def json_dumps(payload: Any, default: Callable[[Any], Any] | None = None) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(payload, default=default)
+
+def json_loads(raw: str | bytes | None) -> Any:
+    if not raw:
+        return {}
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] | None = None,
+                  default: Callable[[Any], Any] | None = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, **headers} if headers else dict(JSON_HEADERS),
+        'isBase64Encoded': False,
+        'body': json_dumps(payload, default)
+    }
+
+def request_header(event: Dict[str, Any], name: str) -> str | None:
+    headers = event.get('headers') or {}
+    return headers.get(name) or headers.get(name.lower())
+
+def image_srcset(variants: Dict[str, Dict[str, str]] | None) -> Dict[str, str] | None:
+    '''Turns the {format: {width: url}} map from the variants column into srcset strings per format'''
+    if not variants:
+        return None
+    return {
+        fmt: ', '.join(f'{url} {width}w' for width, url in sorted(widths.items(), key=lambda item: int(item[0])))
+        for fmt, widths in variants.items()
+    }
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_LOG_EVERY = int(os.environ.get('DB_POOL_LOG_EVERY', '100'))
+
+class ConnectionPool:
+    '''
+    Per-process pool of warm connections kept at module scope, so a reused
+    container skips the TCP/TLS handshake and backend fork on every request.
+    Idle connections are health-checked and recycled by idle time and age.
+    '''
+
+    def __init__(self, connect: Callable[[str], Any], max_size: int):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []
+        self._born: Dict[int, float] = {}
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'waits': 0, 'recycled': 0, 'leaked': 0}
+
+    def getconn(self, dsn: str) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise RuntimeError('Database connection pool exhausted')
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._connect(dsn)
+                with self._lock:
+                    self._born[id(conn)] = time.monotonic()
+                self._count('misses')
+            else:
+                self._count('hits')
+        except Exception:
+            self._slots.release()
+            raise
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def reclaim(self) -> None:
+        for conn in list(self._checked_out()):
+            self._count('leaked')
+            self.putconn(conn, discard=True)
+
+    def scoped(self, func: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.reclaim()
+        return wrapper
+
+    def _take_idle(self) -> Any:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+                born = self._born.get(id(conn), 0.0)
+            now = time.monotonic()
+            if conn.closed or now - released_at > DB_POOL_MAX_IDLE or now - born > DB_POOL_MAX_LIFETIME:
+                self._count('recycled')
+                self._close(conn)
+                continue
+            if now - released_at > DB_POOL_CHECK_AFTER and not self._is_alive(conn):
+                self._count('recycled')
+                self._close(conn)
+                continue
+            return conn
+
+    def _is_alive(self, conn: Any) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn: Any) -> None:
+        with self._lock:
+            self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checked_out(self) -> List[Any]:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+            checkouts = self.stats['hits'] + self.stats['misses']
+            snapshot = dict(self.stats) if key in ('hits', 'misses') and checkouts % DB_POOL_LOG_EVERY == 0 else None
+        if snapshot:
+            print(json.dumps({'db_pool': snapshot}))
+
+def connect_db(dsn: str) -> Any:
+    import psycopg2
+    return psycopg2.connect(dsn)
+
+db_pool = ConnectionPool(connect_db, DB_POOL_MAX_SIZE)
+
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', '60'))
+
+_count_cache: Dict[Any, Tuple[float, int]] = {}
+_count_cache_lock = threading.Lock()
+
+def encode_page_cursor(created_at: datetime, image_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), image_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_page_cursor(page_cursor: str) -> Tuple[datetime, int]:
+    '''Opaque cursor is base64url of [created_at, id] of the last row served'''
+    try:
+        raw = base64.urlsafe_b64decode(page_cursor + '=' * (-len(page_cursor) % 4))
+        created_at, image_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(image_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+def cached_count(key: Any, compute: Callable[[], int]) -> int:
+    now = time.monotonic()
+    with _count_cache_lock:
+        entry = _count_cache.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    value = compute()
+    with _count_cache_lock:
+        _count_cache[key] = (now + COUNT_CACHE_TTL, value)
+    return value
+
+def estimated_image_count(cursor: Any) -> int:
+    '''
+    Planner estimate of non-archived rows instead of a COUNT(*) scan on every
+    page. The estimate is read from the partial keyset index, which only holds
+    rows with is_archived = FALSE, so archived images are not counted.
+    '''
+    def compute() -> int:
+        cursor.execute('''
+            SELECT c.reltuples::bigint
+            FROM pg_class c
+            WHERE c.oid = 'idx_generated_images_active_created'::regclass
+        ''')
+        estimate = cursor.fetchone()[0]
+        if estimate is None or estimate < 0:
+            cursor.execute('SELECT COUNT(*) FROM generated_images WHERE is_archived = FALSE')
+            return cursor.fetchone()[0]
+        return estimate
+    return cached_count('all', compute)
+
+def user_image_count(cursor: Any, user_id: int) -> int:
+    def compute() -> int:
+        cursor.execute('SELECT COUNT(*) FROM generated_images WHERE user_id = %s AND is_archived = FALSE', (user_id,))
+        return cursor.fetchone()[0]
+    return cached_count(('user', user_id), compute)
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '2000'))
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', '3000000'))
+
+EXPORT_COLUMNS = ['id', 'user_id', 'username', 'email', 'prompt', 'image_url', 'theme', 'model', 'is_favorite', 'created_at']
+
+def image_filters(query_params: Dict[str, str]) -> Tuple[List[str], List[Any]]:
+    '''WHERE conditions shared by export and search: user_id, model, theme and a from/to created_at range'''
+    conditions = ['gi.is_archived = FALSE']
+    values: List[Any] = []
+    
+    if query_params.get('user_id'):
+        conditions.append('gi.user_id = %s')
+        values.append(int(query_params['user_id']))
+    if query_params.get('model'):
+        conditions.append('gi.model = %s')
+        values.append(query_params['model'])
+    if query_params.get('theme'):
+        conditions.append('gi.theme = %s')
+        values.append(query_params['theme'])
+    if query_params.get('from'):
+        conditions.append('gi.created_at >= %s')
+        values.append(datetime.fromisoformat(query_params['from']))
+    if query_params.get('to'):
+        conditions.append('gi.created_at < %s')
+        values.append(datetime.fromisoformat(query_params['to']))
+    return conditions, values
+
+def export_images(conn: Any, query_params: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Streams matching rows through a server-side cursor in EXPORT_BATCH_SIZE
+    batches and encodes them straight into the response body. A response stops
+    before its UTF-8 body would pass EXPORT_MAX_BYTES; X-Export-Next-Cursor
+    then resumes the transfer.
+    '''
+    export_format = query_params.get('export')
+    conditions, values = image_filters(query_params)
+    
+    if query_params.get('after'):
+        after_created_at, after_id = decode_page_cursor(query_params['after'])
+        conditions.append('(gi.created_at, gi.id) > (%s, %s)')
+        values.extend([after_created_at, after_id])
+    
+    line = io.StringIO()
+    writer = csv.writer(line) if export_format == 'csv' else None
+    parts: List[str] = []
+    body_bytes = 0
+    if writer and not query_params.get('after'):
+        writer.writerow(EXPORT_COLUMNS)
+        parts.append(line.getvalue())
+        body_bytes = len(parts[0].encode('utf-8'))
+    
+    rows_written = 0
+    last_row = None
+    truncated = False
+    
+    with conn.cursor(name='generated_images_export') as export_cursor:
+        export_cursor.itersize = EXPORT_BATCH_SIZE
+        export_cursor.execute(f'''
+            SELECT gi.id, gi.user_id, u.username, u.email, gi.prompt, gi.image_url,
+                   gi.theme, gi.model, gi.is_favorite, gi.created_at
+            FROM generated_images gi
+            LEFT JOIN users u ON gi.user_id = u.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY gi.created_at, gi.id
+        ''', values)
+        
+        for row in export_cursor:
+            created_at = row[9].isoformat() if row[9] else None
+            if writer:
+                line.seek(0)
+                line.truncate()
+                writer.writerow(list(row[:9]) + [created_at])
+                text = line.getvalue()
+            else:
+                text = json_dumps(dict(zip(EXPORT_COLUMNS, list(row[:9]) + [created_at]))) + '\n'
+            text_bytes = len(text.encode('utf-8'))
+            if rows_written and body_bytes + text_bytes > EXPORT_MAX_BYTES:
+                truncated = True
+                break
+            parts.append(text)
+            body_bytes += text_bytes
+            rows_written += 1
+            last_row = row
+    
+    response_headers = {
+        'Content-Type': 'text/csv; charset=utf-8' if writer else 'application/x-ndjson',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'X-Export-Rows, X-Export-Next-Cursor',
+        'X-Export-Rows': str(rows_written)
+    }
+    if truncated and last_row:
+        response_headers['X-Export-Next-Cursor'] = encode_page_cursor(last_row[9], last_row[0])
+    
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'isBase64Encoded': False,
+        'body': ''.join(parts)
+    }
+
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '50'))
+SEARCH_PAGE_MAX = int(os.environ.get('SEARCH_PAGE_MAX', '200'))
+SEARCH_TRIGRAM_MIN = 3
+
+def search_images(cursor: Any, query_params: Dict[str, str], after: Tuple[datetime, int] | None) -> Dict[str, Any]:
+    '''
+    Finds prompts by Russian or English word stems through the
+    prompt_search_vector GIN index and, for text of SEARCH_TRIGRAM_MIN
+    characters or more, by substring through the trigram index. Each match
+    branch carries the usual filters, the keyset cursor and its own
+    ORDER BY created_at DESC LIMIT, so it returns at most one page: a rare
+    term is read from its GIN index and top-N sorted, a common one can be
+    read by walking idx_generated_images_active_created until the page is
+    full. Only the union of those pages is joined and sorted. query_ms is
+    the database time.
+    '''
+    text = query_params['search'].strip()
+    limit = min(max(int(query_params.get('limit', SEARCH_PAGE_SIZE)), 1), SEARCH_PAGE_MAX)
+    
+    matches = [
+        ("prompt_search_vector(gi.prompt) @@ "
+         "(websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s))", [text, text])
+    ]
+    if len(text) >= SEARCH_TRIGRAM_MIN:
+        pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        matches.append(('gi.prompt ILIKE %s', [f'%{pattern}%']))
+    
+    conditions, filter_values = image_filters(query_params)
+    if after:
+        conditions.append('(gi.created_at, gi.id) < (%s, %s)')
+        filter_values.extend(after)
+    
+    branches: List[str] = []
+    values: List[Any] = []
+    for match, match_values in matches:
+        branches.append(f'''(
+            SELECT gi.id, gi.created_at FROM generated_images gi
+            WHERE {match} AND {' AND '.join(conditions)}
+            ORDER BY gi.created_at DESC, gi.id DESC
+            LIMIT %s
+        )''')
+        values.extend(match_values + filter_values + [limit + 1])
+    
+    started = time.monotonic()
+    cursor.execute(f'''
+        WITH matched AS (
+            {' UNION '.join(branches)}
+        )
+        SELECT gi.id, gi.prompt, gi.image_url, gi.theme, gi.model,
+               gi.created_at, u.id, u.username, u.email, gi.variants
+        FROM matched m
+        JOIN generated_images gi ON gi.id = m.id
+        LEFT JOIN users u ON gi.user_id = u.id
+        ORDER BY m.created_at DESC, m.id DESC
+        LIMIT %s
+    ''', values + [limit + 1])
+    rows = cursor.fetchall()
+    query_ms = round((time.monotonic() - started) * 1000, 1)
+    
+    images = []
+    for row in rows[:limit]:
+        images.append({
+            'id': row[0],
+            'prompt': row[1],
+            'image_url': row[2],
+            'theme': row[3],
+            'model': row[4],
+            'created_at': str(row[5]),
+            'user': {
+                'id': row[6],
+                'username': row[7],
+                'email': row[8]
+            },
+            'variants': row[9],
+            'srcset': image_srcset(row[9])
+        })
+    
+    return json_response(200, {
+        'success': True,
+        'images': images,
+        'limit': limit,
+        'next_cursor': encode_page_cursor(rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None,
+        'query_ms': query_ms
+    })
+
+@db_pool.scoped
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Key',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return {'statusCode': 200, 'headers': PREFLIGHT_HEADERS, 'body': ''}
     
     if method == 'GET':
-        admin_key = event.get('headers', {}).get('x-admin-key', '')
+        admin_key = request_header(event, 'X-Admin-Key') or ''
         if admin_key != 'photoset-admin-2025':
-            return {
-                'statusCode': 403,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'Forbidden: Admin access only'})
-            }
+            return json_response(403, {'error': 'Forbidden: Admin access only'})
     elif method == 'POST':
         pass
     else:
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Database not configured'})
-        }
+        return json_response(500, {'error': 'Database not configured'})
     
-    conn = psycopg2.connect(database_url)
+    conn = db_pool.getconn(database_url)
     cursor = conn.cursor()
     
     if method == 'GET':
         query_params = event.get('queryStringParameters', {}) or {}
         user_id = query_params.get('user_id')
+        keyset = 'cursor' in query_params
+        
+        try:
+            after = decode_page_cursor(query_params['cursor']) if query_params.get('cursor') else None
+        except ValueError:
+            cursor.close()
+            db_pool.putconn(conn)
+            return json_response(400, {'error': 'Invalid cursor'})
+        
+        if query_params.get('export') in ('ndjson', 'csv'):
+            try:
+                response = export_images(conn, query_params)
+            except ValueError:
+                response = json_response(400, {'error': 'Invalid export filter or cursor'})
+            cursor.close()
+            db_pool.putconn(conn)
+            return response
+        
+        if query_params.get('search', '').strip():
+            try:
+                response = search_images(cursor, query_params, after)
+            except ValueError:
+                response = json_response(400, {'error': 'Invalid search filter'})
+            cursor.close()
+            db_pool.putconn(conn)
+            return response
         
         if user_id:
             limit = int(query_params.get('limit', 100))
-            offset = int(query_params.get('offset', 0))
+            offset = 0 if keyset else int(query_params.get('offset', 0))
             
             cursor.execute('''
                 SELECT 
-                    id, user_id, prompt, image_url, theme, model, is_favorite, created_at
+                    id, user_id, prompt, image_url, theme, model, is_favorite, created_at, variants
                 FROM generated_images
                 WHERE user_id = %s AND is_archived = FALSE
-                ORDER BY created_at DESC
+                  AND (%s::timestamp IS NULL OR (created_at, id) < (%s::timestamp, %s))
+                ORDER BY created_at DESC, id DESC
                 LIMIT %s OFFSET %s
-            ''', (user_id, limit, offset))
+            ''', (user_id, after and after[0], after and after[0], after and after[1], limit + 1, offset))
             
+            rows = cursor.fetchall()
             images = []
-            for row in cursor.fetchall():
+            for row in rows[:limit]:
                 images.append({
                     'id': row[0],
                     'user_id': row[1],
@@ -88,48 +509,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'theme': row[4],
                     'model': row[5],
                     'is_favorite': row[6],
-                    'created_at': str(row[7])
+                    'created_at': str(row[7]),
+                    'variants': row[8],
+                    'srcset': image_srcset(row[8])
                 })
             
-            cursor.execute('SELECT COUNT(*) FROM generated_images WHERE user_id = %s AND is_archived = FALSE', (user_id,))
-            total_count = cursor.fetchone()[0]
+            next_cursor = encode_page_cursor(rows[limit - 1][7], rows[limit - 1][0]) if len(rows) > limit else None
+            total_count = user_image_count(cursor, int(user_id))
             
             cursor.close()
-            conn.close()
+            db_pool.putconn(conn)
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'isBase64Encoded': False,
-                'body': json.dumps({
-                    'success': True,
-                    'images': images,
-                    'total': total_count,
-                    'limit': limit,
-                    'offset': offset
-                })
-            }
+            return json_response(200, {
+                'success': True,
+                'images': images,
+                'total': total_count,
+                'limit': limit,
+                'offset': offset,
+                'next_cursor': next_cursor
+            })
         else:
             limit = int(query_params.get('limit', 50))
-            offset = int(query_params.get('offset', 0))
+            offset = 0 if keyset else int(query_params.get('offset', 0))
             
             cursor.execute('''
                 SELECT 
                     gi.id, gi.prompt, gi.image_url, gi.theme, gi.model, 
                     gi.created_at, gi.is_archived,
-                    u.id as user_id, u.username, u.email
+                    u.id as user_id, u.username, u.email, gi.variants
                 FROM generated_images gi
                 LEFT JOIN users u ON gi.user_id = u.id
                 WHERE gi.is_archived = FALSE
-                ORDER BY gi.created_at DESC
+                  AND (%s::timestamp IS NULL OR (gi.created_at, gi.id) < (%s::timestamp, %s))
+                ORDER BY gi.created_at DESC, gi.id DESC
                 LIMIT %s OFFSET %s
-            ''', (limit, offset))
+            ''', (after and after[0], after and after[0], after and after[1], limit + 1, offset))
             
+            rows = cursor.fetchall()
             images = []
-            for row in cursor.fetchall():
+            for row in rows[:limit]:
                 images.append({
                     'id': row[0],
                     'prompt': row[1],
@@ -142,33 +560,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'id': row[7],
                         'username': row[8],
                         'email': row[9]
-                    }
+                    },
+                    'variants': row[10],
+                    'srcset': image_srcset(row[10])
                 })
             
-            cursor.execute('SELECT COUNT(*) FROM generated_images WHERE is_archived = FALSE')
-            total_count = cursor.fetchone()[0]
+            next_cursor = encode_page_cursor(rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None
+            total_count = estimated_image_count(cursor)
             
             cursor.close()
-            conn.close()
+            db_pool.putconn(conn)
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'isBase64Encoded': False,
-                'body': json.dumps({
-                    'success': True,
-                    'images': images,
-                    'total': total_count,
-                    'limit': limit,
-                    'offset': offset
-                })
-            }
+            return json_response(200, {
+                'success': True,
+                'images': images,
+                'total': total_count,
+                'total_is_estimate': True,
+                'limit': limit,
+                'offset': offset,
+                'next_cursor': next_cursor
+            })
     elif method == 'POST':
-        body_str = event.get('body', '{}')
-        body = json.loads(body_str)
+        body = json_loads(event.get('body'))
         
         user_id = body.get('user_id')
         prompt = body.get('prompt', '')
@@ -178,15 +591,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         if not user_id or not image_url:
             cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({'error': 'user_id and image_url required'})
-            }
+            db_pool.putconn(conn)
+            return json_response(400, {'error': 'user_id and image_url required'})
         
         cursor.execute('''
             INSERT INTO generated_images (user_id, prompt, image_url, theme, model, is_favorite, is_archived)
@@ -197,6 +603,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         row = cursor.fetchone()
         conn.commit()
         
+        with _count_cache_lock:
+            _count_cache.pop(('user', row[1]), None)
+        
         saved_image = {
             'id': row[0],
             'user_id': row[1],
@@ -209,17 +618,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
         
         cursor.close()
-        conn.close()
+        db_pool.putconn(conn)
         
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'isBase64Encoded': False,
-            'body': json.dumps({
-                'success': True,
-                'image': saved_image
-            })
-        }
\ No newline at end of file
+        return json_response(200, {
+            'success': True,
+            'image': saved_image
+        })
\ No newline at end of file
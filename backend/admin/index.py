@@ -1,10 +1,696 @@
 import json
 import os
-import random
+import secrets
 import string
-from typing import Dict, Any
-import psycopg
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Tuple
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+ALLOWED_METHODS = ('GET', 'POST', 'PUT', 'DELETE', 'OPTIONS')
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': ', '.join(ALLOWED_METHODS),
+    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+    'Access-Control-Max-Age': CORS_MAX_AGE
+}
+
+def json_dumps(payload: Any, default: Callable[[Any], Any] | None = None) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(payload, default=default)
+
+def json_loads(raw: str | bytes | None) -> Any:
+    if not raw:
+        return {}
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] | None = None,
+                  default: Callable[[Any], Any] | None = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, **headers} if headers else dict(JSON_HEADERS),
+        'isBase64Encoded': False,
+        'body': json_dumps(payload, default)
+    }
+
+def request_header(event: Dict[str, Any], name: str) -> str | None:
+    headers = event.get('headers') or {}
+    return headers.get(name) or headers.get(name.lower())
+
+def image_srcset(variants: Dict[str, Dict[str, str]] | None) -> Dict[str, str] | None:
+    '''Turns the {format: {width: url}} map from the variants column into srcset strings per format'''
+    if not variants:
+        return None
+    return {
+        fmt: ', '.join(f'{url} {width}w' for width, url in sorted(widths.items(), key=lambda item: int(item[0])))
+        for fmt, widths in variants.items()
+    }
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_LOG_EVERY = int(os.environ.get('DB_POOL_LOG_EVERY', '100'))
+
+class ConnectionPool:
+    '''
+    Per-process pool of warm connections kept at module scope, so a reused
+    container skips the TCP/TLS handshake and backend fork on every request.
+    Idle connections are health-checked and recycled by idle time and age.
+    '''
+
+    def __init__(self, connect: Callable[[str], Any], max_size: int):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []
+        self._born: Dict[int, float] = {}
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'waits': 0, 'recycled': 0, 'leaked': 0}
+
+    def getconn(self, dsn: str) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise RuntimeError('Database connection pool exhausted')
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._connect(dsn)
+                with self._lock:
+                    self._born[id(conn)] = time.monotonic()
+                self._count('misses')
+            else:
+                self._count('hits')
+        except Exception:
+            self._slots.release()
+            raise
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def reclaim(self) -> None:
+        for conn in list(self._checked_out()):
+            self._count('leaked')
+            self.putconn(conn, discard=True)
+
+    def scoped(self, func: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.reclaim()
+        return wrapper
+
+    def _take_idle(self) -> Any:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+                born = self._born.get(id(conn), 0.0)
+            now = time.monotonic()
+            if conn.closed or now - released_at > DB_POOL_MAX_IDLE or now - born > DB_POOL_MAX_LIFETIME:
+                self._count('recycled')
+                self._close(conn)
+                continue
+            if now - released_at > DB_POOL_CHECK_AFTER and not self._is_alive(conn):
+                self._count('recycled')
+                self._close(conn)
+                continue
+            return conn
+
+    def _is_alive(self, conn: Any) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn: Any) -> None:
+        with self._lock:
+            self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checked_out(self) -> List[Any]:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+            checkouts = self.stats['hits'] + self.stats['misses']
+            snapshot = dict(self.stats) if key in ('hits', 'misses') and checkouts % DB_POOL_LOG_EVERY == 0 else None
+        if snapshot:
+            print(json.dumps({'db_pool': snapshot}))
+
+def connect_db(dsn: str) -> Any:
+    import psycopg
+    return psycopg.connect(dsn)
+
+db_pool = ConnectionPool(connect_db, DB_POOL_MAX_SIZE)
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '30'))
+SESSION_CACHE_LOG_EVERY = int(os.environ.get('SESSION_CACHE_LOG_EVERY', '500'))
+
+class SessionCache:
+    '''
+    Bounded LRU of resolved sessions keyed by a SHA-256 of the token. Entries
+    live for SESSION_CACHE_TTL seconds or until the session expires, whichever
+    comes first, and are dropped explicitly on logout or account changes.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(session_token: str) -> str:
+        return hashlib.sha256(session_token.encode('utf-8')).hexdigest()
+
+    def get(self, session_token: str) -> Dict[str, Any] | None:
+        key = self.key(session_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                session = entry[1]
+                self._count('hits')
+            else:
+                if entry:
+                    del self._entries[key]
+                session = None
+                self._count('misses')
+        return session
+
+    def put(self, session_token: str, session: Dict[str, Any]) -> None:
+        ttl = min(self._ttl, session['expires_at'] - time.time())
+        if ttl <= 0:
+            return
+        key = self.key(session_token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, session)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, session_token: str) -> None:
+        with self._lock:
+            if self._entries.pop(self.key(session_token), None):
+                self.stats['invalidations'] += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            stale = [key for key, (_, session) in self._entries.items() if session['user_id'] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self.stats['invalidations'] += len(stale)
+
+    def _count(self, key: str) -> None:
+        self.stats[key] += 1
+        if (self.stats['hits'] + self.stats['misses']) % SESSION_CACHE_LOG_EVERY == 0:
+            print(json.dumps({'session_cache': self.stats}))
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+def resolve_session(session_token: str, dsn: str, fresh: bool = False) -> Dict[str, Any] | None:
+    '''
+    Returns the session with its user, from the cache when warm; expired
+    sessions are returned too. Logout and password resets only clear the
+    cache of the auth function, so here a revoked token stays valid for up
+    to SESSION_CACHE_TTL seconds; fresh=True reads user_sessions instead and
+    is used wherever the request spends or grants something.
+    '''
+    session = None if fresh else session_cache.get(session_token)
+    if session:
+        return session
+
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT s.user_id, EXTRACT(EPOCH FROM s.expires_at), u.email, u.username, u.full_name,
+                   u.credits, u.plan, u.avatar_url, u.is_admin, s.id
+            FROM user_sessions s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.session_token = %s
+            """,
+            (session_token,)
+        )
+        row = cur.fetchone()
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+
+    if not row:
+        return None
+
+    session = {
+        'user_id': row[0],
+        'expires_at': float(row[1]),
+        'email': row[2],
+        'username': row[3],
+        'full_name': row[4],
+        'credits': row[5],
+        'plan': row[6],
+        'avatar_url': row[7],
+        'is_admin': bool(row[8]),
+        'session_id': row[9]
+    }
+    session_cache.put(session_token, session)
+    return session
+
+PROMO_MAX_STRIPES = int(os.environ.get('PROMO_MAX_STRIPES', '64'))
+
+# One statement per redemption. The usage row goes in first, so a repeated
+# activation by the same user stops at the unique index; the claim then takes
+# one slot either on promo_codes itself or, for striped codes, on the first
+# stripe with room, starting from a per-user offset so concurrent redemptions
+# lock different rows. Both claims re-check the limit after the row lock, so
+# max_uses cannot be overshot. A usage row without a claim means the code ran
+# out in between and the caller rolls the statement back.
+REDEEM_PROMO_SQL = """
+WITH promo AS (
+    SELECT id, generations_count, stripes, is_active,
+           is_active AND (expires_at IS NULL OR expires_at > NOW()) AS redeemable,
+           stripes > 1 OR max_uses IS NULL OR used_count < max_uses AS available
+    FROM promo_codes
+    WHERE code = %(code)s
+),
+usage AS (
+    INSERT INTO promo_code_usage (promo_code_id, user_id)
+    SELECT id, %(user_id)s FROM promo WHERE redeemable AND available
+    ON CONFLICT (promo_code_id, user_id) DO NOTHING
+    RETURNING promo_code_id
+),
+claimed_direct AS (
+    UPDATE promo_codes p SET used_count = p.used_count + 1
+    WHERE p.id = (SELECT promo_code_id FROM usage)
+      AND p.stripes = 1
+      AND (p.max_uses IS NULL OR p.used_count < p.max_uses)
+    RETURNING p.id
+),
+stripe AS (
+    SELECT s.stripe
+    FROM promo_code_stripes s
+    WHERE s.promo_code_id = (SELECT promo_code_id FROM usage)
+      AND (s.capacity IS NULL OR s.used_count < s.capacity)
+    ORDER BY (s.stripe + %(user_id)s) %% (SELECT stripes FROM promo)
+    LIMIT 1
+    FOR UPDATE
+),
+claimed_striped AS (
+    UPDATE promo_code_stripes s SET used_count = s.used_count + 1
+    WHERE s.promo_code_id = (SELECT promo_code_id FROM usage)
+      AND s.stripe = (SELECT stripe FROM stripe)
+    RETURNING s.promo_code_id
+),
+credited AS (
+    UPDATE users SET credits = credits + (SELECT generations_count FROM promo)
+    WHERE id = %(user_id)s
+      AND EXISTS (SELECT 1 FROM claimed_direct UNION ALL SELECT 1 FROM claimed_striped)
+    RETURNING id
+)
+SELECT (SELECT id FROM promo), (SELECT is_active FROM promo), (SELECT redeemable FROM promo),
+       (SELECT available FROM promo), (SELECT generations_count FROM promo), EXISTS (SELECT 1 FROM usage), EXISTS (SELECT 1 FROM credited)
+"""
+
+PROMO_CODE_ALPHABET = string.ascii_uppercase + string.digits
+PROMO_CODE_LENGTH = 10
+PROMO_BATCH_MAX = int(os.environ.get('PROMO_BATCH_MAX', '100000'))
+PROMO_INSERT_ATTEMPTS = int(os.environ.get('PROMO_INSERT_ATTEMPTS', '5'))
+
+# Random bytes map onto the alphabet through one translate() call; bytes past
+# the largest multiple of the alphabet size are dropped to keep codes unbiased
+_PROMO_CODE_TABLE = bytes(ord(PROMO_CODE_ALPHABET[b % len(PROMO_CODE_ALPHABET)]) for b in range(256))
+_PROMO_CODE_REJECT = bytes(range(256 - 256 % len(PROMO_CODE_ALPHABET), 256))
+
+def new_promo_codes(count: int, seen: set) -> List[str]:
+    '''Draws count codes from secrets that are not in seen, adding them to it'''
+    codes: List[str] = []
+    while len(codes) < count:
+        needed = count - len(codes)
+        raw = secrets.token_bytes(needed * PROMO_CODE_LENGTH * 9 // 8 + PROMO_CODE_LENGTH)
+        chars = raw.translate(_PROMO_CODE_TABLE, _PROMO_CODE_REJECT).decode('ascii')
+        for start in range(0, len(chars) - PROMO_CODE_LENGTH + 1, PROMO_CODE_LENGTH):
+            code = chars[start:start + PROMO_CODE_LENGTH]
+            if code in seen:
+                continue
+            seen.add(code)
+            codes.append(code)
+            if len(codes) == count:
+                break
+    return codes
+
+def create_promo_batch(conn: Any, cur: Any, body: Dict[str, Any], user_id: int) -> Dict[str, Any]:
+    '''
+    Creates count codes in one transaction: the batch is COPYed into a temp
+    table and moved into promo_codes with ON CONFLICT DO NOTHING, so only
+    codes that collide with existing ones are drawn again. Responds with the
+    codes as CSV.
+    '''
+    count = body.get('count')
+    generations = body.get('generations', 15)
+    max_uses = body.get('max_uses', 1)
+    
+    if not isinstance(count, int) or not 1 <= count <= PROMO_BATCH_MAX:
+        return json_response(400, {'error': 'INVALID_COUNT', 'max_count': PROMO_BATCH_MAX})
+    
+    started = time.monotonic()
+    seen: set = set()
+    batch = new_promo_codes(count, seen)
+    created: List[str] = []
+    
+    cur.execute("CREATE TEMP TABLE promo_import (code VARCHAR(50)) ON COMMIT DROP")
+    for attempt in range(PROMO_INSERT_ATTEMPTS):
+        with cur.copy("COPY promo_import (code) FROM STDIN") as copy:
+            copy.write('\n'.join(batch) + '\n')
+        cur.execute(
+            """
+            INSERT INTO promo_codes (code, generations_count, max_uses, created_by)
+            SELECT code, %s, %s, %s FROM promo_import
+            ON CONFLICT (code) DO NOTHING
+            RETURNING code
+            """,
+            (generations, max_uses, user_id)
+        )
+        inserted = {row[0] for row in cur.fetchall()}
+        created.extend(inserted)
+        collided = len(batch) - len(inserted)
+        if not collided:
+            break
+        cur.execute("TRUNCATE promo_import")
+        batch = new_promo_codes(collided, seen)
+    else:
+        conn.rollback()
+        return json_response(409, {'error': 'PROMO_COLLISIONS', 'message': 'Не удалось подобрать уникальные коды'})
+    conn.commit()
+    
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'text/csv; charset=utf-8',
+            'Content-Disposition': 'attachment; filename="promo-codes.csv"',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Expose-Headers': 'X-Promo-Count, X-Promo-Attempts, X-Promo-Duration-Ms',
+            'X-Promo-Count': str(len(created)),
+            'X-Promo-Attempts': str(attempt + 1),
+            'X-Promo-Duration-Ms': str(round((time.monotonic() - started) * 1000))
+        },
+        'isBase64Encoded': False,
+        'body': 'code\n' + '\n'.join(created) + '\n'
+    }
+
+def promo_stripe_capacities(max_uses: int | None, stripes: int) -> List[int | None]:
+    '''Splits max_uses across stripes as evenly as possible; unlimited codes get unlimited stripes'''
+    if max_uses is None:
+        return [None] * stripes
+    return [max_uses // stripes + (1 if stripe < max_uses % stripes else 0) for stripe in range(stripes)]
+
+PUBLIC_CONTENT_VERSION_TTL = float(os.environ.get('PUBLIC_CONTENT_VERSION_TTL', '5'))
+PUBLIC_CONTENT_MAX_AGE = int(os.environ.get('PUBLIC_CONTENT_MAX_AGE', '60'))
+PUBLIC_CONTENT_LIMIT = int(os.environ.get('PUBLIC_CONTENT_LIMIT', '100'))
+PUBLIC_CONTENT_CACHE_SIZE = int(os.environ.get('PUBLIC_CONTENT_CACHE_SIZE', '64'))
+
+PUBLIC_CONTENT = {
+    'public-gallery': (
+        'gallery',
+        """
+        SELECT id, image_url, title, description, theme, variants
+        FROM gallery_items
+        WHERE category = %s AND is_visible = TRUE
+        ORDER BY display_order DESC, created_at DESC
+        LIMIT %s
+        """,
+        ('id', 'image_url', 'title', 'description', 'theme', 'variants')
+    ),
+    'public-photoshoots': (
+        'photoshoots',
+        """
+        SELECT id, image_url, title, description, theme_id, icon, variants
+        FROM photoshoot_examples
+        WHERE is_visible = TRUE
+        ORDER BY display_order DESC, created_at DESC
+        LIMIT %s
+        """,
+        ('id', 'image_url', 'title', 'description', 'theme_id', 'icon', 'variants')
+    )
+}
+
+class PublicContentCache:
+    '''
+    Rendered public listings tagged with the content_versions value they were
+    built from. The version itself is re-read at most every
+    PUBLIC_CONTENT_VERSION_TTL seconds, so a warm instance answers without a
+    query; writes made through this instance expire it immediately.
+    '''
+
+    def __init__(self, version_ttl: float, max_size: int):
+        self._version_ttl = version_ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._versions: Dict[str, Tuple[float, int]] = {}
+        self._entries: OrderedDict[Tuple[Any, ...], Tuple[int, str, str]] = OrderedDict()
+
+    def version(self, name: str) -> int | None:
+        with self._lock:
+            entry = self._versions.get(name)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def set_version(self, name: str, version: int) -> None:
+        with self._lock:
+            self._versions[name] = (time.monotonic() + self._version_ttl, version)
+
+    def expire_version(self, name: str) -> None:
+        with self._lock:
+            self._versions.pop(name, None)
+
+    def get(self, key: Tuple[Any, ...], version: int) -> Tuple[str, str] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry[0] != version:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key: Tuple[Any, ...], version: int, etag: str, body: str) -> None:
+        with self._lock:
+            self._entries[key] = (version, etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+public_cache = PublicContentCache(PUBLIC_CONTENT_VERSION_TTL, PUBLIC_CONTENT_CACHE_SIZE)
+
+def serve_public_content(event: Dict[str, Any], dsn: str, action: str, params: Dict[str, str]) -> Dict[str, Any]:
+    '''Visible gallery or photoshoot items for anonymous visitors, with a strong ETag per content version'''
+    name, query, columns = PUBLIC_CONTENT[action]
+    try:
+        limit = min(max(int(params.get('limit', PUBLIC_CONTENT_LIMIT)), 1), PUBLIC_CONTENT_LIMIT)
+    except ValueError:
+        return json_response(400, {'error': 'INVALID_LIMIT'})
+    args: Tuple[Any, ...] = (params.get('category', 'gallery'), limit) if name == 'gallery' else (limit,)
+    key = (action,) + args
+    
+    conn = None
+    try:
+        version = public_cache.version(name)
+        if version is None:
+            conn = db_pool.getconn(dsn)
+            with conn.cursor() as cur:
+                cur.execute("SELECT version FROM content_versions WHERE name = %s", (name,))
+                row = cur.fetchone()
+            version = row[0] if row else 0
+            public_cache.set_version(name, version)
+        
+        cached = public_cache.get(key, version)
+        if cached is None:
+            conn = conn or db_pool.getconn(dsn)
+            with conn.cursor() as cur:
+                cur.execute(query, args)
+                rows = cur.fetchall()
+            items = []
+            for row in rows:
+                item = dict(zip(columns, row))
+                item['srcset'] = image_srcset(item['variants'])
+                items.append(item)
+            body = json_dumps({'success': True, 'items': items, 'version': version})
+            cached = (f'"{name}-{version}-{hashlib.sha256(body.encode("utf-8")).hexdigest()[:16]}"', body)
+            public_cache.put(key, version, *cached)
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
+    
+    etag, body = cached
+    response_headers = {
+        **JSON_HEADERS,
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={PUBLIC_CONTENT_MAX_AGE}',
+        'Access-Control-Expose-Headers': 'ETag'
+    }
+    if etag in (request_header(event, 'If-None-Match') or '').replace(' ', '').split(','):
+        return {'statusCode': 304, 'headers': response_headers, 'body': ''}
+    return {'statusCode': 200, 'headers': response_headers, 'isBase64Encoded': False, 'body': body}
+
+BULK_UPDATE_MAX = int(os.environ.get('BULK_UPDATE_MAX', '1000'))
+
+# Patchable columns per content kind with their SQL type and accepted Python type
+BULK_UPDATE_TARGETS = {
+    'gallery': ('gallery_items', {
+        'display_order': ('integer', int),
+        'is_visible': ('boolean', bool),
+        'title': ('varchar', str),
+        'description': ('text', str),
+        'image_url': ('text', str),
+        'theme': ('varchar', str),
+        'category': ('varchar', str)
+    }),
+    'photoshoots': ('photoshoot_examples', {
+        'display_order': ('integer', int),
+        'is_visible': ('boolean', bool),
+        'title': ('varchar', str),
+        'description': ('text', str),
+        'image_url': ('text', str),
+        'theme_id': ('varchar', str),
+        'icon': ('varchar', str)
+    })
+}
+
+GENERATE_IMAGE_URL = os.environ.get('GENERATE_IMAGE_URL', '')
+VARIANTS_REQUEST_TIMEOUT = float(os.environ.get('VARIANTS_REQUEST_TIMEOUT', '15'))
+
+def request_variants(table: str, ids: List[int]) -> None:
+    '''
+    Asks generate-image to render srcset variants for rows saved here, since
+    this function has no image stack of its own. Failures are only logged:
+    the rows keep variants NULL and the periodic backfill renders them.
+    '''
+    worker_key = os.environ.get('JOB_WORKER_KEY')
+    if not GENERATE_IMAGE_URL or not worker_key or not ids:
+        return
+    import urllib.request
+    request = urllib.request.Request(
+        f'{GENERATE_IMAGE_URL}?action=variants',
+        data=json_dumps({'table': table, 'ids': ids}).encode('utf-8'),
+        headers={'Content-Type': 'application/json', 'X-Worker-Key': worker_key},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=VARIANTS_REQUEST_TIMEOUT) as response:
+            response.read()
+    except Exception as e:
+        print(json.dumps({'variants_request_failed': table, 'ids': ids, 'error': str(e)}))
+
+def bulk_update_content(conn: Any, cur: Any, body: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Applies a list of {id, field: value} patches to gallery_items or
+    photoshoot_examples with one UPDATE ... FROM (VALUES ...) in one
+    transaction. Fields left out or null keep their value; later patches
+    for the same id win. Returns the content version after the change.
+    '''
+    target = BULK_UPDATE_TARGETS.get(body.get('content'))
+    patches = body.get('items')
+    if not target:
+        return json_response(400, {'error': 'INVALID_CONTENT', 'allowed': list(BULK_UPDATE_TARGETS)})
+    if not isinstance(patches, list) or not 1 <= len(patches) <= BULK_UPDATE_MAX:
+        return json_response(400, {'error': 'INVALID_ITEMS', 'max_items': BULK_UPDATE_MAX})
+    
+    table, columns = target
+    merged: Dict[int, Dict[str, Any]] = {}
+    for patch in patches:
+        if not isinstance(patch, dict) or type(patch.get('id')) is not int:
+            return json_response(400, {'error': 'INVALID_ITEM', 'item': patch})
+        for field, value in patch.items():
+            if field == 'id':
+                continue
+            if field not in columns:
+                return json_response(400, {'error': 'UNKNOWN_FIELD', 'field': field})
+            if value is not None and type(value) is not columns[field][1]:
+                return json_response(400, {'error': 'INVALID_VALUE', 'field': field})
+        merged.setdefault(patch['id'], {}).update(patch)
+    
+    fields = [field for field in columns if any(field in patch for patch in merged.values())]
+    if not fields:
+        return json_response(400, {'error': 'NOTHING_TO_UPDATE'})
+    
+    assignments = [f'{field} = COALESCE(v.{field}, t.{field})' for field in fields]
+    if 'image_url' in fields:
+        assignments.append('variants = CASE WHEN v.image_url IS DISTINCT FROM t.image_url AND v.image_url IS NOT NULL THEN NULL ELSE t.variants END')
+    assignments.append('updated_at = NOW()')
+    row_template = '(' + ', '.join(['%s::integer'] + [f'%s::{columns[field][0]}' for field in fields]) + ')'
+    values: List[Any] = []
+    for item_id, patch in merged.items():
+        values.append(item_id)
+        values.extend(patch.get(field) for field in fields)
+    
+    cur.execute(
+        f"""
+        UPDATE {table} t SET {', '.join(assignments)}
+        FROM (VALUES {', '.join([row_template] * len(merged))}) AS v(id, {', '.join(fields)})
+        WHERE t.id = v.id
+        RETURNING t.id
+        """,
+        values
+    )
+    updated = {row[0] for row in cur.fetchall()}
+    name = 'gallery' if table == 'gallery_items' else 'photoshoots'
+    cur.execute("SELECT version FROM content_versions WHERE name = %s", (name,))
+    version = cur.fetchone()[0]
+    conn.commit()
+    public_cache.expire_version(name)
+    request_variants(table, [item_id for item_id in updated if merged[item_id].get('image_url') is not None])
+    
+    return json_response(200, {
+        'success': True,
+        'updated': len(updated),
+        'missing': [item_id for item_id in merged if item_id not in updated],
+        'version': version
+    })
+
+@db_pool.scoped
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Админ-панель для управления промокодами и контентом
@@ -15,83 +701,80 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return {'statusCode': 200, 'headers': PREFLIGHT_HEADERS, 'body': ''}
     
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    session_token = request_header(event, 'X-Session-Token')
     params = event.get('queryStringParameters') or {}
     action = params.get('action', '')
+    dsn = os.environ.get('DATABASE_URL')
+    
+    if method == 'GET' and action in PUBLIC_CONTENT:
+        return serve_public_content(event, dsn, action, params)
     
     if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'AUTH_REQUIRED'})
-        }
+        return json_response(401, {'error': 'AUTH_REQUIRED'})
     
-    dsn = os.environ.get('DATABASE_URL')
+    session = resolve_session(session_token, dsn, fresh=method != 'GET')
     
-    with psycopg.connect(dsn) as conn:
+    if not session or time.time() > session['expires_at']:
+        return json_response(401, {'error': 'INVALID_SESSION'})
+    
+    user_id = session['user_id']
+    
+    if action != 'activate-promo' and not session['is_admin']:
+        return json_response(403, {'error': 'ADMIN_ONLY'})
+    
+    conn = db_pool.getconn(dsn)
+    try:
         with conn.cursor() as cur:
-            cur.execute(
-                "SELECT u.id, u.email, u.username, u.is_admin FROM sessions s JOIN users u ON s.user_id = u.id WHERE s.session_token = %s AND s.expires_at > NOW()",
-                (session_token,)
-            )
-            user_row = cur.fetchone()
-            
-            if not user_row:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'INVALID_SESSION'})
-                }
-            
-            user_id, email, username, is_admin = user_row
-            
-            if action != 'activate-promo' and not is_admin:
-                return {
-                    'statusCode': 403,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'ADMIN_ONLY'})
-                }
-            
             if method == 'POST' and action == 'create-promo':
-                body = json.loads(event.get('body', '{}'))
+                body = json_loads(event.get('body'))
+                if 'count' in body:
+                    return create_promo_batch(conn, cur, body, user_id)
+                
                 generations = body.get('generations', 15)
                 max_uses = body.get('max_uses')
-                
-                code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-                
-                cur.execute(
-                    "INSERT INTO promo_codes (code, generations_count, max_uses, created_by) VALUES (%s, %s, %s, %s) RETURNING id, code",
-                    (code, generations, max_uses, user_id)
-                )
-                promo_id, promo_code = cur.fetchone()
+                stripes = body.get('stripes', 1)
+                
+                if not isinstance(stripes, int) or not 1 <= stripes <= PROMO_MAX_STRIPES:
+                    return json_response(400, {'error': 'INVALID_STRIPES', 'max_stripes': PROMO_MAX_STRIPES})
+                
+                seen: set = set()
+                for _ in range(PROMO_INSERT_ATTEMPTS):
+                    cur.execute(
+                        "INSERT INTO promo_codes (code, generations_count, max_uses, stripes, created_by) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (code) DO NOTHING RETURNING id, code",
+                        (new_promo_codes(1, seen)[0], generations, max_uses, stripes, user_id)
+                    )
+                    created = cur.fetchone()
+                    if created:
+                        break
+                else:
+                    return json_response(409, {'error': 'PROMO_COLLISIONS', 'message': 'Не удалось подобрать уникальные коды'})
+                promo_id, promo_code = created
+                if stripes > 1:
+                    cur.executemany(
+                        "INSERT INTO promo_code_stripes (promo_code_id, stripe, capacity) VALUES (%s, %s, %s)",
+                        [(promo_id, stripe, capacity) for stripe, capacity in enumerate(promo_stripe_capacities(max_uses, stripes))]
+                    )
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'promo_code': promo_code,
-                        'id': promo_id,
-                        'generations': generations
-                    })
-                }
+                return json_response(200, {
+                    'success': True,
+                    'promo_code': promo_code,
+                    'id': promo_id,
+                    'generations': generations
+                })
             
             elif method == 'GET' and action == 'list-promos':
                 cur.execute(
-                    "SELECT id, code, generations_count, used_count, max_uses, is_active, created_at FROM promo_codes ORDER BY created_at DESC LIMIT 50"
+                    """
+                    SELECT p.id, p.code, p.generations_count,
+                           p.used_count + COALESCE((SELECT SUM(s.used_count) FROM promo_code_stripes s WHERE s.promo_code_id = p.id), 0),
+                           p.max_uses, p.is_active, p.created_at, p.stripes
+                    FROM promo_codes p
+                    ORDER BY p.created_at DESC
+                    LIMIT 50
+                    """
                 )
                 rows = cur.fetchall()
                 
@@ -104,17 +787,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'used_count': row[3],
                         'max_uses': row[4],
                         'is_active': row[5],
-                        'created_at': row[6].isoformat() if row[6] else None
+                        'created_at': row[6].isoformat() if row[6] else None,
+                        'stripes': row[7]
                     })
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'promos': promos})
-                }
+                return json_response(200, {'success': True, 'promos': promos})
             
             elif method == 'POST' and action == 'toggle-promo':
-                body = json.loads(event.get('body', '{}'))
+                body = json_loads(event.get('body'))
                 promo_id = body.get('promo_id')
                 
                 cur.execute(
@@ -124,14 +804,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 result = cur.fetchone()
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'is_active': result[0] if result else False})
-                }
+                return json_response(200, {'success': True, 'is_active': result[0] if result else False})
             
             elif method == 'POST' and action == 'add-gallery':
-                body = json.loads(event.get('body', '{}'))
+                body = json_loads(event.get('body'))
                 image_url = body.get('image_url')
                 title = body.get('title', '')
                 description = body.get('description', '')
@@ -144,18 +820,16 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 item_id = cur.fetchone()[0]
                 conn.commit()
+                public_cache.expire_version('gallery')
+                request_variants('gallery_items', [item_id])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'id': item_id})
-                }
+                return json_response(200, {'success': True, 'id': item_id})
             
             elif method == 'GET' and action == 'list-gallery':
                 category = params.get('category', 'gallery')
                 
                 cur.execute(
-                    "SELECT id, image_url, title, description, theme, is_visible, display_order FROM gallery_items WHERE category = %s ORDER BY display_order DESC, created_at DESC",
+                    "SELECT id, image_url, title, description, theme, is_visible, display_order, variants FROM gallery_items WHERE category = %s ORDER BY display_order DESC, created_at DESC",
                     (category,)
                 )
                 rows = cur.fetchall()
@@ -169,17 +843,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'description': row[3],
                         'theme': row[4],
                         'is_visible': row[5],
-                        'display_order': row[6]
+                        'display_order': row[6],
+                        'variants': row[7],
+                        'srcset': image_srcset(row[7])
                     })
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'items': items})
-                }
+                return json_response(200, {'success': True, 'items': items})
             
             elif method == 'PUT' and action == 'update-gallery':
-                body = json.loads(event.get('body', '{}'))
+                body = json_loads(event.get('body'))
                 item_id = body.get('id')
                 
                 updates = []
@@ -194,6 +866,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 if 'image_url' in body:
                     updates.append('image_url = %s')
                     values.append(body['image_url'])
+                    updates.append('variants = NULL')
                 if 'is_visible' in body:
                     updates.append('is_visible = %s')
                     values.append(body['is_visible'])
@@ -204,15 +877,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 query = f"UPDATE gallery_items SET {', '.join(updates)} WHERE id = %s"
                 cur.execute(query, tuple(values))
                 conn.commit()
+                public_cache.expire_version('gallery')
+                if 'image_url' in body:
+                    request_variants('gallery_items', [item_id])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True})
-                }
+                return json_response(200, {'success': True})
+            
+            elif method == 'POST' and action == 'bulk-update':
+                return bulk_update_content(conn, cur, json_loads(event.get('body')))
             
             elif method == 'POST' and action == 'add-photoshoot':
-                body = json.loads(event.get('body', '{}'))
+                body = json_loads(event.get('body'))
                 image_url = body.get('image_url')
                 title = body.get('title')
                 description = body.get('description', '')
@@ -225,16 +900,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 item_id = cur.fetchone()[0]
                 conn.commit()
+                public_cache.expire_version('photoshoots')
+                request_variants('photoshoot_examples', [item_id])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'id': item_id})
-                }
+                return json_response(200, {'success': True, 'id': item_id})
             
             elif method == 'GET' and action == 'list-photoshoots':
                 cur.execute(
-                    "SELECT id, image_url, title, description, theme_id, icon, is_visible, display_order FROM photoshoot_examples ORDER BY display_order DESC, created_at DESC"
+                    "SELECT id, image_url, title, description, theme_id, icon, is_visible, display_order, variants FROM photoshoot_examples ORDER BY display_order DESC, created_at DESC"
                 )
                 rows = cur.fetchall()
                 
@@ -248,97 +921,51 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'theme_id': row[4],
                         'icon': row[5],
                         'is_visible': row[6],
-                        'display_order': row[7]
+                        'display_order': row[7],
+                        'variants': row[8],
+                        'srcset': image_srcset(row[8])
                     })
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'items': items})
-                }
+                return json_response(200, {'success': True, 'items': items})
             
             elif method == 'POST' and action == 'activate-promo':
-                body = json.loads(event.get('body', '{}'))
+                body = json_loads(event.get('body'))
                 promo_code = body.get('code', '').strip().upper()
                 
                 if not promo_code:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'PROMO_CODE_REQUIRED'})
-                    }
+                    return json_response(400, {'error': 'PROMO_CODE_REQUIRED'})
                 
-                cur.execute(
-                    "SELECT id, generations_count, used_count, max_uses, is_active FROM promo_codes WHERE code = %s",
-                    (promo_code,)
-                )
-                promo_row = cur.fetchone()
+                cur.execute(REDEEM_PROMO_SQL, {'code': promo_code, 'user_id': user_id})
+                promo_id, is_active, redeemable, available, generations, inserted, credited = cur.fetchone()
                 
-                if not promo_row:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'PROMO_NOT_FOUND', 'message': 'Промокод не найден'})
-                    }
-                
-                promo_id, generations, used_count, max_uses, is_active = promo_row
+                if promo_id is None:
+                    return json_response(404, {'error': 'PROMO_NOT_FOUND', 'message': 'Промокод не найден'})
                 
                 if not is_active:
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'PROMO_INACTIVE', 'message': 'Промокод деактивирован'})
-                    }
-                
-                if max_uses and used_count >= max_uses:
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'PROMO_EXHAUSTED', 'message': 'Промокод исчерпан'})
-                    }
+                    return json_response(403, {'error': 'PROMO_INACTIVE', 'message': 'Промокод деактивирован'})
                 
-                cur.execute(
-                    "SELECT 1 FROM promo_code_usage WHERE promo_code_id = %s AND user_id = %s",
-                    (promo_id, user_id)
-                )
-                already_used = cur.fetchone()
-                
-                if already_used:
-                    return {
-                        'statusCode': 403,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'PROMO_ALREADY_USED', 'message': 'Вы уже использовали этот промокод'})
-                    }
+                if not redeemable:
+                    return json_response(403, {'error': 'PROMO_EXPIRED', 'message': 'Срок действия промокода истёк'})
                 
-                cur.execute(
-                    "INSERT INTO promo_code_usage (promo_code_id, user_id) VALUES (%s, %s)",
-                    (promo_id, user_id)
-                )
+                if not available:
+                    return json_response(403, {'error': 'PROMO_EXHAUSTED', 'message': 'Промокод исчерпан'})
                 
-                cur.execute(
-                    "UPDATE promo_codes SET used_count = used_count + 1 WHERE id = %s",
-                    (promo_id,)
-                )
+                if not inserted:
+                    return json_response(403, {'error': 'PROMO_ALREADY_USED', 'message': 'Вы уже использовали этот промокод'})
                 
-                cur.execute(
-                    "UPDATE users SET credits = credits + %s WHERE id = %s",
-                    (generations, user_id)
-                )
+                if not credited:
+                    conn.rollback()
+                    return json_response(403, {'error': 'PROMO_EXHAUSTED', 'message': 'Промокод исчерпан'})
                 
                 conn.commit()
+                session_cache.invalidate_user(user_id)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'message': f'Промокод активирован! Вы получили {generations} бесплатных генераций',
-                        'generations_added': generations
-                    })
-                }
+                return json_response(200, {
+                    'success': True,
+                    'message': f'Промокод активирован! Вы получили {generations} бесплатных генераций',
+                    'generations_added': generations
+                })
             
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'UNKNOWN_ACTION'})
-            }
\ No newline at end of file
+            return json_response(400, {'error': 'UNKNOWN_ACTION'})
+    finally:
+        db_pool.putconn(conn)
@@ -1,110 +1,737 @@
 """
-Business: Complete authentication system - register, login, verify, reset password
+Business: Complete authentication system - register, login, verify, logout, reset password
 Args: event with POST/GET and path parameter for action
 Returns: HTTP response with auth data or error
 """
 
 import json
+import math
 import os
 import re
 import secrets
 from datetime import datetime, timedelta
-from typing import Dict, Any
-import psycopg2
-import bcrypt
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, List, Tuple
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+ALLOWED_METHODS = ('GET', 'POST', 'OPTIONS')
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': ', '.join(ALLOWED_METHODS),
+    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+    'Access-Control-Max-Age': CORS_MAX_AGE
+}
+
+def json_dumps(payload: Any, default: Callable[[Any], Any] | None = None) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(payload, default=default)
+
+def json_loads(raw: str | bytes | None) -> Any:
+    if not raw:
+        return {}
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] | None = None,
+                  default: Callable[[Any], Any] | None = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, **headers} if headers else dict(JSON_HEADERS),
+        'isBase64Encoded': False,
+        'body': json_dumps(payload, default)
+    }
+
+def request_header(event: Dict[str, Any], name: str) -> str | None:
+    headers = event.get('headers') or {}
+    return headers.get(name) or headers.get(name.lower())
+
+def image_srcset(variants: Dict[str, Dict[str, str]] | None) -> Dict[str, str] | None:
+    '''Turns the {format: {width: url}} map from the variants column into srcset strings per format'''
+    if not variants:
+        return None
+    return {
+        fmt: ', '.join(f'{url} {width}w' for width, url in sorted(widths.items(), key=lambda item: int(item[0])))
+        for fmt, widths in variants.items()
+    }
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_LOG_EVERY = int(os.environ.get('DB_POOL_LOG_EVERY', '100'))
+
+class ConnectionPool:
+    '''
+    Per-process pool of warm connections kept at module scope, so a reused
+    container skips the TCP/TLS handshake and backend fork on every request.
+    Idle connections are health-checked and recycled by idle time and age.
+    '''
+
+    def __init__(self, connect: Callable[[str], Any], max_size: int):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []
+        self._born: Dict[int, float] = {}
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'waits': 0, 'recycled': 0, 'leaked': 0}
+
+    def getconn(self, dsn: str) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise RuntimeError('Database connection pool exhausted')
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._connect(dsn)
+                with self._lock:
+                    self._born[id(conn)] = time.monotonic()
+                self._count('misses')
+            else:
+                self._count('hits')
+        except Exception:
+            self._slots.release()
+            raise
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def reclaim(self) -> None:
+        for conn in list(self._checked_out()):
+            self._count('leaked')
+            self.putconn(conn, discard=True)
+
+    def scoped(self, func: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.reclaim()
+        return wrapper
+
+    def _take_idle(self) -> Any:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+                born = self._born.get(id(conn), 0.0)
+            now = time.monotonic()
+            if conn.closed or now - released_at > DB_POOL_MAX_IDLE or now - born > DB_POOL_MAX_LIFETIME:
+                self._count('recycled')
+                self._close(conn)
+                continue
+            if now - released_at > DB_POOL_CHECK_AFTER and not self._is_alive(conn):
+                self._count('recycled')
+                self._close(conn)
+                continue
+            return conn
+
+    def _is_alive(self, conn: Any) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn: Any) -> None:
+        with self._lock:
+            self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checked_out(self) -> List[Any]:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+            checkouts = self.stats['hits'] + self.stats['misses']
+            snapshot = dict(self.stats) if key in ('hits', 'misses') and checkouts % DB_POOL_LOG_EVERY == 0 else None
+        if snapshot:
+            print(json.dumps({'db_pool': snapshot}))
+
+def connect_db(dsn: str) -> Any:
+    import psycopg2
+    return psycopg2.connect(dsn)
+
+db_pool = ConnectionPool(connect_db, DB_POOL_MAX_SIZE)
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '30'))
+SESSION_CACHE_LOG_EVERY = int(os.environ.get('SESSION_CACHE_LOG_EVERY', '500'))
+
+class SessionCache:
+    '''
+    Bounded LRU of resolved sessions keyed by a SHA-256 of the token. Entries
+    live for SESSION_CACHE_TTL seconds or until the session expires, whichever
+    comes first, and are dropped explicitly on logout or account changes.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(session_token: str) -> str:
+        return hashlib.sha256(session_token.encode('utf-8')).hexdigest()
+
+    def get(self, session_token: str) -> Dict[str, Any] | None:
+        key = self.key(session_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                session = entry[1]
+                self._count('hits')
+            else:
+                if entry:
+                    del self._entries[key]
+                session = None
+                self._count('misses')
+        return session
+
+    def put(self, session_token: str, session: Dict[str, Any]) -> None:
+        ttl = min(self._ttl, session['expires_at'] - time.time())
+        if ttl <= 0:
+            return
+        key = self.key(session_token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, session)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, session_token: str) -> None:
+        with self._lock:
+            if self._entries.pop(self.key(session_token), None):
+                self.stats['invalidations'] += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            stale = [key for key, (_, session) in self._entries.items() if session['user_id'] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self.stats['invalidations'] += len(stale)
+
+    def _count(self, key: str) -> None:
+        self.stats[key] += 1
+        if (self.stats['hits'] + self.stats['misses']) % SESSION_CACHE_LOG_EVERY == 0:
+            print(json.dumps({'session_cache': self.stats}))
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+SESSION_LOOKUP_SQL = """
+    SELECT s.user_id, EXTRACT(EPOCH FROM s.expires_at), u.email, u.username, u.full_name,
+           u.credits, u.plan, u.avatar_url, u.is_admin, s.id
+    FROM user_sessions s
+    JOIN users u ON s.user_id = u.id
+    WHERE s.session_token = %s
+"""
+
+def resolve_session(session_token: str, dsn: str, cur: Any = None) -> Dict[str, Any] | None:
+    '''
+    Returns the session with its user, from the cache when warm; expired
+    sessions are returned too. A cold lookup runs on cur when given, so a
+    caller that already holds a connection does not take a second one.
+    '''
+    session = session_cache.get(session_token)
+    if session:
+        return session
+
+    if cur is not None:
+        cur.execute(SESSION_LOOKUP_SQL, (session_token,))
+        row = cur.fetchone()
+    else:
+        conn = db_pool.getconn(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute(SESSION_LOOKUP_SQL, (session_token,))
+            row = cur.fetchone()
+            cur.close()
+        finally:
+            db_pool.putconn(conn)
+
+    if not row:
+        return None
+
+    session = {
+        'user_id': row[0],
+        'expires_at': float(row[1]),
+        'email': row[2],
+        'username': row[3],
+        'full_name': row[4],
+        'credits': row[5],
+        'plan': row[6],
+        'avatar_url': row[7],
+        'is_admin': bool(row[8]),
+        'session_id': row[9]
+    }
+    session_cache.put(session_token, session)
+    return session
+
+ACTIVITY_GRANULARITY = float(os.environ.get('ACTIVITY_GRANULARITY', '300'))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', '60'))
+ACTIVITY_FLUSH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_SIZE', '200'))
+ACTIVITY_TRACKED_MAX = int(os.environ.get('ACTIVITY_TRACKED_MAX', '10000'))
+
+ACTIVITY_FLUSH_SQL = f"""
+    UPDATE user_sessions s SET last_activity = v.touched_at
+    FROM (VALUES %s) AS v(id, touched_at)
+    WHERE s.id = v.id
+      AND (s.last_activity IS NULL OR s.last_activity < v.touched_at - INTERVAL '{ACTIVITY_GRANULARITY:g} seconds')
+"""
+
+class ActivityBuffer:
+    '''
+    Write-behind buffer for user_sessions.last_activity. A session is touched
+    at most once per ACTIVITY_GRANULARITY seconds, and pending touches go out
+    as one bulk UPDATE when the buffer fills or ACTIVITY_FLUSH_INTERVAL has
+    passed since the last flush, checked when a request starts and again
+    before verify responds. A touch on a quiet instance is therefore written
+    at once; on a busy one it can wait up to ACTIVITY_FLUSH_INTERVAL, and is
+    lost if the instance is reclaimed first. last_activity is a recency hint,
+    not an audit trail.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._touched: OrderedDict[int, float] = OrderedDict()
+        self._pending: Dict[int, float] = {}
+        self._last_flush = 0.0
+
+    def touch(self, session_id: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            last = self._touched.get(session_id)
+            if last is not None and now - last < ACTIVITY_GRANULARITY:
+                return
+            self._touched[session_id] = now
+            self._touched.move_to_end(session_id)
+            while len(self._touched) > ACTIVITY_TRACKED_MAX:
+                self._touched.popitem(last=False)
+            self._pending[session_id] = time.time()
+
+    def flush_due(self, dsn: str) -> None:
+        with self._lock:
+            due = self._pending and (
+                len(self._pending) >= ACTIVITY_FLUSH_SIZE
+                or time.monotonic() - self._last_flush >= ACTIVITY_FLUSH_INTERVAL
+            )
+        if due:
+            try:
+                self.flush(dsn)
+            except Exception as e:
+                print(json.dumps({'activity_flush_error': str(e)}))
+
+    def flush(self, dsn: str | None = None, cur: Any = None) -> None:
+        '''
+        Writes pending touches. Given a cursor, the UPDATE joins the caller's
+        transaction and the caller commits; otherwise it runs and commits on
+        a pooled connection of its own.
+        '''
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending = {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        from psycopg2.extras import execute_values
+        conn = None
+        try:
+            if cur is None:
+                conn = db_pool.getconn(dsn)
+            target = cur if conn is None else conn.cursor()
+            execute_values(target, ACTIVITY_FLUSH_SQL, pending, template='(%s, to_timestamp(%s))', page_size=len(pending))
+            if conn is not None:
+                conn.commit()
+                target.close()
+        except Exception:
+            with self._lock:
+                for session_id, touched_at in pending:
+                    self._pending.setdefault(session_id, touched_at)
+            raise
+        finally:
+            if conn is not None:
+                db_pool.putconn(conn)
+
+activity_buffer = ActivityBuffer()
+
+SECURITY_LOG_FLUSH_INTERVAL = float(os.environ.get('SECURITY_LOG_FLUSH_INTERVAL', '5'))
+SECURITY_LOG_FLUSH_SIZE = int(os.environ.get('SECURITY_LOG_FLUSH_SIZE', '50'))
+SECURITY_LOG_MAX_ENTRIES = int(os.environ.get('SECURITY_LOG_MAX_ENTRIES', '5000'))
+
+class SecurityLogBuffer:
+    '''
+    Append buffer for security_logs so auth responses do not wait on the
+    audit insert. Entries keep their own timestamp and are written with one
+    multi-row INSERT before a response once the buffer holds
+    SECURITY_LOG_FLUSH_SIZE entries or SECURITY_LOG_FLUSH_INTERVAL has passed
+    since the last flush, so on a quiet instance an entry goes out with the
+    request that made it. A failed insert keeps the entries for the next
+    attempt; past SECURITY_LOG_MAX_ENTRIES the oldest are dropped and counted.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: List[Tuple[Any, ...]] = []
+        self._last_flush = 0.0
+        self.dropped = 0
+
+    def append(self, user_id: int | None, action: str, success: bool, ip_address: str | None = None,
+               user_agent: str | None = None, details: Dict[str, Any] | None = None) -> None:
+        with self._lock:
+            self._entries.append((
+                user_id, action, success, ip_address, user_agent,
+                json.dumps(details) if details is not None else None, time.time()
+            ))
+            self._trim()
+
+    def _trim(self) -> None:
+        excess = len(self._entries) - SECURITY_LOG_MAX_ENTRIES
+        if excess > 0:
+            del self._entries[:excess]
+            self.dropped += excess
+
+    def flush_due(self, dsn: str) -> None:
+        with self._lock:
+            due = self._entries and (
+                len(self._entries) >= SECURITY_LOG_FLUSH_SIZE
+                or time.monotonic() - self._last_flush >= SECURITY_LOG_FLUSH_INTERVAL
+            )
+        if due:
+            try:
+                self.flush(dsn)
+            except Exception as e:
+                print(json.dumps({'security_log_flush_error': str(e), 'pending': len(self._entries), 'dropped': self.dropped}))
+
+    def flush(self, dsn: str) -> None:
+        with self._lock:
+            entries, self._entries = self._entries, []
+            self._last_flush = time.monotonic()
+        if not entries:
+            return
+        from psycopg2.extras import execute_values
+        conn = None
+        try:
+            conn = db_pool.getconn(dsn)
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                "INSERT INTO security_logs (user_id, action, success, ip_address, user_agent, details, created_at) VALUES %s",
+                entries,
+                template='(%s, %s, %s, %s, %s, %s, to_timestamp(%s))',
+                page_size=len(entries)
+            )
+            conn.commit()
+            cur.close()
+        except Exception:
+            with self._lock:
+                self._entries[:0] = entries
+                self._trim()
+            raise
+        finally:
+            if conn is not None:
+                db_pool.putconn(conn)
+
+security_log = SecurityLogBuffer()
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', str(os.cpu_count() or 1)))
+BCRYPT_QUEUE_DEPTH = int(os.environ.get('BCRYPT_QUEUE_DEPTH', '8'))
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    '''
+    Runs bcrypt on a bounded thread pool. At most workers + queue_depth hashes
+    are admitted at once; anything beyond that is rejected immediately so a
+    credential-stuffing burst cannot starve the other auth actions.
+    '''
+
+    def __init__(self, workers: int, queue_depth: int, rounds: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.rounds = rounds
+
+    def hash(self, password: str) -> str:
+        import bcrypt
+        return self._run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)).decode('utf-8'))
+
+    def check(self, password: str, password_hash: str) -> bool:
+        import bcrypt
+        return self._run(lambda: bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8')))
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        parts = password_hash.split('$')
+        return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != self.rounds
+
+    def _run(self, work: Callable[[], Any]) -> Any:
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(work)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+password_hasher = PasswordHasher(BCRYPT_WORKERS, BCRYPT_QUEUE_DEPTH, BCRYPT_ROUNDS)
+
+def busy_response() -> Dict[str, Any]:
+    return json_response(503, {'error': 'Server is busy, please retry'}, {'Retry-After': '1'})
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '10000'))
+RATE_LIMIT_SWEEP_INTERVAL = float(os.environ.get('RATE_LIMIT_SWEEP_INTERVAL', '3600'))
+
+RATE_LIMIT_TAKE_SQL = """
+INSERT INTO rate_limit_buckets AS b (bucket_key, capacity, rate, tokens, allowed, updated_at)
+SELECT k, c, r, c - 1, TRUE, clock_timestamp()
+FROM unnest(%s::text[], %s::float8[], %s::float8[]) AS t(k, c, r)
+ORDER BY k
+ON CONFLICT (bucket_key) DO UPDATE SET
+    capacity = EXCLUDED.capacity,
+    rate = EXCLUDED.rate,
+    allowed = LEAST(EXCLUDED.capacity, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * EXCLUDED.rate) >= 1,
+    tokens = LEAST(EXCLUDED.capacity, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * EXCLUDED.rate)
+        - CASE WHEN LEAST(EXCLUDED.capacity, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * EXCLUDED.rate) >= 1
+               THEN 1 ELSE 0 END,
+    updated_at = clock_timestamp()
+RETURNING allowed, tokens, rate
+"""
+
+def parse_rate_limit(spec: str) -> Tuple[float, float] | None:
+    '''Parses "capacity/seconds" into (capacity, tokens per second); empty, 0 or off disables the limit'''
+    spec = spec.strip()
+    if not spec or spec in ('0', 'off'):
+        return None
+    capacity, _, seconds = spec.partition('/')
+    return float(capacity), float(capacity) / float(seconds or 1)
+
+class MemoryRateLimitStore:
+    '''
+    Token buckets held by this instance only. Buckets refill lazily when
+    touched, and the least recently used ones are dropped beyond max_keys.
+    '''
+
+    def __init__(self, max_keys: int):
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def take(self, dsn: str, buckets: List[Tuple[str, float, float]]) -> float:
+        now = time.monotonic()
+        retry_after = 0.0
+        with self._lock:
+            for key, capacity, rate in buckets:
+                tokens, updated = self._buckets.pop(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+class PostgresRateLimitStore:
+    '''
+    Token buckets shared by every instance through rate_limit_buckets. One
+    UPSERT refills, checks and debits all buckets of a request under their
+    row locks, taken in key order so concurrent requests cannot deadlock.
+    '''
+
+    def __init__(self, sweep_interval: float):
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+
+    def take(self, dsn: str, buckets: List[Tuple[str, float, float]]) -> float:
+        keys, capacities, rates = (list(column) for column in zip(*buckets))
+        conn = db_pool.getconn(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute(RATE_LIMIT_TAKE_SQL, (keys, capacities, rates))
+            rows = cur.fetchall()
+            if time.monotonic() >= self._next_sweep:
+                self._next_sweep = time.monotonic() + self._sweep_interval
+                cur.execute("DELETE FROM rate_limit_buckets WHERE updated_at < NOW() - INTERVAL '1 day'")
+            conn.commit()
+            cur.close()
+        finally:
+            db_pool.putconn(conn)
+        return max([(1 - tokens) / rate for allowed, tokens, rate in rows if not allowed] or [0.0])
+
+class RateLimiter:
+    '''
+    Checks a request against named per-action limits. Every (limit, key) pair
+    is its own bucket; the request is rejected if any bucket is empty. Store
+    errors fail open so an outage of the limiter never blocks sign-ins.
+    '''
+
+    def __init__(self, store: Any, limits: Dict[str, Tuple[float, float] | None]):
+        self._store = store
+        self._limits = limits
+
+    def check(self, dsn: str, keys: List[Tuple[str, str]]) -> float:
+        buckets = [
+            (f'{name}:{key}', *self._limits[name])
+            for name, key in keys
+            if self._limits.get(name) and key
+        ]
+        if not buckets or self._store is None:
+            return 0.0
+        try:
+            return self._store.take(dsn, buckets)
+        except Exception as e:
+            print(json.dumps({'rate_limiter_error': str(e)}))
+            return 0.0
+
+def rate_limit_store(backend: str) -> Any:
+    if backend == 'postgres':
+        return PostgresRateLimitStore(RATE_LIMIT_SWEEP_INTERVAL)
+    if backend == 'memory':
+        return MemoryRateLimitStore(RATE_LIMIT_MAX_KEYS)
+    return None
+
+def source_ip(event: Dict[str, Any]) -> str:
+    return (event.get('requestContext') or {}).get('identity', {}).get('sourceIp', 'unknown')
+
+def rate_limited_response(retry_after: float) -> Dict[str, Any]:
+    seconds = max(1, math.ceil(retry_after))
+    return json_response(429, {'error': 'Too many requests', 'code': 'RATE_LIMITED', 'retry_after': seconds},
+                         {'Retry-After': str(seconds)})
+
+rate_limiter = RateLimiter(rate_limit_store(RATE_LIMIT_BACKEND), {
+    'login_ip': parse_rate_limit(os.environ.get('RATE_LIMIT_LOGIN_IP', '20/60')),
+    'login_email': parse_rate_limit(os.environ.get('RATE_LIMIT_LOGIN_EMAIL', '10/300'))
+})
+
+@db_pool.scoped
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return {'statusCode': 200, 'headers': PREFLIGHT_HEADERS, 'body': ''}
     
     path_params = event.get('pathParams', {})
     action = path_params.get('action', event.get('queryStringParameters', {}).get('action', 'register'))
     
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
+        return json_response(500, {'error': 'Database not configured'})
     
+    activity_buffer.flush_due(dsn)
+    response = dispatch(action, event, dsn)
+    security_log.flush_due(dsn)
+    return response
+
+def dispatch(action: str, event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     if action == 'register':
         return handle_register(event, dsn)
     elif action == 'login':
         return handle_login(event, dsn)
     elif action == 'verify':
         return handle_verify(event, dsn)
+    elif action == 'logout':
+        return handle_logout(event, dsn)
     elif action == 'reset-request':
         return handle_reset_request(event, dsn)
     elif action == 'reset-complete':
         return handle_reset_complete(event, dsn)
     elif action == 'admin_stats':
         return handle_admin_stats(event, dsn)
+    elif action == 'admin_stats_reconcile':
+        return handle_admin_stats_reconcile(event, dsn)
     elif action == 'admin_users':
         return handle_admin_users(event, dsn)
     elif action == 'admin_images':
         return handle_admin_images(event, dsn)
+    elif action == 'admin_dashboard':
+        return handle_admin_dashboard(event, dsn)
     else:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'})
-        }
+        return json_response(400, {'error': 'Invalid action'})
 
 def handle_register(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json_loads(event.get('body'))
     email = body_data.get('email', '').strip().lower()
     password = body_data.get('password', '')
     username = body_data.get('username', '').strip()
     full_name = body_data.get('full_name', '').strip()
     
     if not email or not password or not username:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email, password and username are required'})
-        }
+        return json_response(400, {'error': 'Email, password and username are required'})
     
     email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
     if not re.match(email_pattern, email):
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid email format'})
-        }
+        return json_response(400, {'error': 'Invalid email format'})
     
     if len(password) < 8:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Password must be at least 8 characters'})
-        }
+        return json_response(400, {'error': 'Password must be at least 8 characters'})
     
-    conn = psycopg2.connect(dsn)
+    conn = db_pool.getconn(dsn)
     cur = conn.cursor()
     
     cur.execute("SELECT id FROM users WHERE email = %s", (email,))
     if cur.fetchone():
         cur.close()
-        conn.close()
-        return {
-            'statusCode': 409,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email already registered'})
-        }
+        db_pool.putconn(conn)
+        return json_response(409, {'error': 'Email already registered'})
     
-    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    cur.close()
+    db_pool.putconn(conn)
+    
+    try:
+        password_hash = password_hasher.hash(password)
+    except HasherBusy:
+        return busy_response()
+    
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
     
     cur.execute(
         """
@@ -117,46 +744,44 @@ def handle_register(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     user = cur.fetchone()
     conn.commit()
     
-    cur.execute(
-        "INSERT INTO security_logs (user_id, action, success) VALUES (%s, 'register', true)",
-        (user[0],)
-    )
-    conn.commit()
-    
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
-    return {
-        'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'user': {
-                'id': user[0],
-                'email': user[1],
-                'username': user[2],
-                'full_name': user[3],
-                'credits': user[4],
-                'plan': user[5],
-                'created_at': user[6].isoformat() if user[6] else None
-            }
-        })
-    }
+    security_log.append(user[0], 'register', True)
+    
+    return json_response(201, {
+        'success': True,
+        'user': {
+            'id': user[0],
+            'email': user[1],
+            'username': user[2],
+            'full_name': user[3],
+            'credits': user[4],
+            'plan': user[5],
+            'created_at': user[6].isoformat() if user[6] else None
+        }
+    })
 
 def handle_login(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json_loads(event.get('body'))
     email = body_data.get('email', '').strip().lower()
     password = body_data.get('password', '')
     
     if not email or not password:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email and password are required'})
-        }
+        return json_response(400, {'error': 'Email and password are required'})
+    
+    ip_address = source_ip(event)
+    user_agent = event.get('headers', {}).get('User-Agent', 'unknown')
+    
+    retry_after = rate_limiter.check(dsn, [
+        ('login_ip', ip_address),
+        ('login_email', hashlib.sha256(email.encode('utf-8')).hexdigest())
+    ])
+    if retry_after:
+        security_log.append(None, 'login', False, ip_address, user_agent, details={'email': email, 'reason': 'rate_limited'})
+        return rate_limited_response(retry_after)
     
-    conn = psycopg2.connect(dsn)
+    conn = db_pool.getconn(dsn)
     cur = conn.cursor()
     
     cur.execute(
@@ -165,172 +790,131 @@ def handle_login(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     )
     user = cur.fetchone()
     
+    cur.close()
+    db_pool.putconn(conn)
+    
     if not user:
-        cur.execute(
-            "INSERT INTO security_logs (action, success, details) VALUES ('login', false, %s)",
-            (json.dumps({'email': email, 'reason': 'user_not_found'}),)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid email or password'})
-        }
+        security_log.append(None, 'login', False, ip_address, user_agent, details={'email': email, 'reason': 'user_not_found'})
+        return json_response(401, {'error': 'Invalid email or password'})
     
     password_hash = user[4]
-    if not bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8')):
-        cur.execute(
-            "INSERT INTO security_logs (user_id, action, success, details) VALUES (%s, 'login', false, %s)",
-            (user[0], json.dumps({'reason': 'wrong_password'}))
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid email or password'})
-        }
+    try:
+        password_ok = password_hasher.check(password, password_hash)
+        new_hash = password_hasher.hash(password) if password_ok and password_hasher.needs_rehash(password_hash) else None
+    except HasherBusy:
+        return busy_response()
+    
+    if not password_ok:
+        security_log.append(user[0], 'login', False, ip_address, user_agent, details={'reason': 'wrong_password'})
+        return json_response(401, {'error': 'Invalid email or password'})
     
     session_token = secrets.token_urlsafe(32)
     expires_at = datetime.utcnow() + timedelta(days=30)
     
-    request_context = event.get('requestContext', {})
-    identity = request_context.get('identity', {})
-    ip_address = identity.get('sourceIp', 'unknown')
-    user_agent = event.get('headers', {}).get('User-Agent', 'unknown')
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
     
     cur.execute(
         """
-        INSERT INTO user_sessions (user_id, session_token, expires_at, ip_address, user_agent) 
-        VALUES (%s, %s, %s, %s, %s)
+        WITH new_session AS (
+            INSERT INTO user_sessions (user_id, session_token, expires_at, ip_address, user_agent)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING user_id
+        )
+        UPDATE users SET last_login = CURRENT_TIMESTAMP, password_hash = COALESCE(%s, password_hash)
+        WHERE id = (SELECT user_id FROM new_session)
         """,
-        (user[0], session_token, expires_at, ip_address, user_agent)
-    )
-    conn.commit()
-    
-    cur.execute(
-        "UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = %s",
-        (user[0],)
-    )
-    conn.commit()
-    
-    cur.execute(
-        "INSERT INTO security_logs (user_id, action, success, ip_address, user_agent) VALUES (%s, 'login', true, %s, %s)",
-        (user[0], ip_address, user_agent)
+        (user[0], session_token, expires_at, ip_address, user_agent, new_hash)
     )
     conn.commit()
     
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'session_token': session_token,
-            'expires_at': expires_at.isoformat(),
-            'user': {
-                'id': user[0],
-                'email': user[1],
-                'username': user[2],
-                'full_name': user[3],
-                'credits': user[5],
-                'plan': user[6],
-                'avatar_url': user[7],
-                'is_admin': user[8]
-            }
-        })
-    }
+    security_log.append(user[0], 'login', True, ip_address, user_agent)
+    
+    return json_response(200, {
+        'success': True,
+        'session_token': session_token,
+        'expires_at': expires_at.isoformat(),
+        'user': {
+            'id': user[0],
+            'email': user[1],
+            'username': user[2],
+            'full_name': user[3],
+            'credits': user[5],
+            'plan': user[6],
+            'avatar_url': user[7],
+            'is_admin': user[8]
+        }
+    })
 
 def handle_verify(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    session_token = request_header(event, 'X-Session-Token')
     
     if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'})
-        }
+        return json_response(401, {'error': 'Session token required'})
     
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    cur.execute(
-        """
-        SELECT s.user_id, s.expires_at, u.email, u.username, u.full_name, u.credits, u.plan, u.avatar_url, u.is_admin
-        FROM user_sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = %s
-        """,
-        (session_token,)
-    )
-    session = cur.fetchone()
+    session = resolve_session(session_token, dsn)
     
     if not session:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid session token'})
+        return json_response(401, {'error': 'Invalid session token'})
+    
+    if time.time() > session['expires_at']:
+        return json_response(401, {'error': 'Session expired'})
+    
+    activity_buffer.touch(session['session_id'])
+    activity_buffer.flush_due(dsn)
+    
+    return json_response(200, {
+        'success': True,
+        'user': {
+            'id': session['user_id'],
+            'email': session['email'],
+            'username': session['username'],
+            'full_name': session['full_name'],
+            'credits': session['credits'],
+            'plan': session['plan'],
+            'avatar_url': session['avatar_url'],
+            'is_admin': session['is_admin']
         }
+    })
+
+def handle_logout(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    session_token = request_header(event, 'X-Session-Token')
     
-    expires_at = session[1]
-    if datetime.utcnow() > expires_at:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session expired'})
-        }
+    if not session_token:
+        return json_response(401, {'error': 'Session token required'})
+    
+    session_cache.invalidate(session_token)
+    
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
     
     cur.execute(
-        "UPDATE user_sessions SET last_activity = CURRENT_TIMESTAMP WHERE session_token = %s",
+        "DELETE FROM user_sessions WHERE session_token = %s RETURNING user_id",
         (session_token,)
     )
+    session = cur.fetchone()
+    
     conn.commit()
     
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'user': {
-                'id': session[0],
-                'email': session[2],
-                'username': session[3],
-                'full_name': session[4],
-                'credits': session[5],
-                'plan': session[6],
-                'avatar_url': session[7],
-                'is_admin': session[8]
-            }
-        })
-    }
+    if session:
+        security_log.append(session[0], 'logout', True)
+    
+    return json_response(200, {'success': True})
 
 def handle_reset_request(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json_loads(event.get('body'))
     email = body_data.get('email', '').strip().lower()
     
     if not email:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email is required'})
-        }
+        return json_response(400, {'error': 'Email is required'})
     
-    conn = psycopg2.connect(dsn)
+    conn = db_pool.getconn(dsn)
     cur = conn.cursor()
     
     cur.execute("SELECT id FROM users WHERE email = %s", (email,))
@@ -338,15 +922,11 @@ def handle_reset_request(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     
     if not user:
         cur.close()
-        conn.close()
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'message': 'If email exists, reset link will be sent'
-            })
-        }
+        db_pool.putconn(conn)
+        return json_response(200, {
+            'success': True,
+            'message': 'If email exists, reset link will be sent'
+        })
     
     reset_token = secrets.token_urlsafe(32)
     expires_at = datetime.utcnow() + timedelta(hours=1)
@@ -357,47 +937,30 @@ def handle_reset_request(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     )
     conn.commit()
     
-    cur.execute(
-        "INSERT INTO security_logs (user_id, action, success) VALUES (%s, 'password_reset_request', true)",
-        (user[0],)
-    )
-    conn.commit()
-    
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'message': 'Password reset token generated',
-            'token': reset_token,
-            'expires_at': expires_at.isoformat()
-        })
-    }
+    security_log.append(user[0], 'password_reset_request', True)
+    
+    return json_response(200, {
+        'success': True,
+        'message': 'Password reset token generated',
+        'token': reset_token,
+        'expires_at': expires_at.isoformat()
+    })
 
 def handle_reset_complete(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json_loads(event.get('body'))
     token = body_data.get('token', '')
     new_password = body_data.get('new_password', '')
     
     if not token or not new_password:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Token and new password are required'})
-        }
+        return json_response(400, {'error': 'Token and new password are required'})
     
     if len(new_password) < 8:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Password must be at least 8 characters'})
-        }
+        return json_response(400, {'error': 'Password must be at least 8 characters'})
     
-    conn = psycopg2.connect(dsn)
+    conn = db_pool.getconn(dsn)
     cur = conn.cursor()
     
     cur.execute(
@@ -412,25 +975,22 @@ def handle_reset_complete(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     
     if not token_data:
         cur.close()
-        conn.close()
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid or expired token'})
-        }
+        db_pool.putconn(conn)
+        return json_response(400, {'error': 'Invalid or expired token'})
     
     user_id, expires_at, used = token_data
     
     if used or datetime.utcnow() > expires_at:
         cur.close()
-        conn.close()
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Token has expired or already used'})
-        }
+        db_pool.putconn(conn)
+        return json_response(400, {'error': 'Token has expired or already used'})
     
-    password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    try:
+        password_hash = password_hasher.hash(new_password)
+    except HasherBusy:
+        cur.close()
+        db_pool.putconn(conn)
+        return busy_response()
     
     cur.execute(
         "UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
@@ -444,130 +1004,182 @@ def handle_reset_complete(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     )
     conn.commit()
     
-    cur.execute(
-        "INSERT INTO security_logs (user_id, action, success) VALUES (%s, 'password_reset_complete', true)",
-        (user_id,)
-    )
+    cur.execute("DELETE FROM user_sessions WHERE user_id = %s", (user_id,))
     conn.commit()
+    session_cache.invalidate_user(user_id)
     
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'message': 'Password has been reset successfully'
-        })
-    }
+    security_log.append(user_id, 'password_reset_complete', True)
+    
+    return json_response(200, {
+        'success': True,
+        'message': 'Password has been reset successfully'
+    })
 
 def verify_admin(session_token: str, dsn: str) -> tuple[bool, int | None]:
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    cur.execute(
-        """
-        SELECT s.user_id, u.is_admin, s.expires_at
-        FROM user_sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = %s
-        """,
-        (session_token,)
-    )
-    session = cur.fetchone()
-    
-    cur.close()
-    conn.close()
+    session = resolve_session(session_token, dsn)
     
     if not session:
         return False, None
     
-    user_id, is_admin, expires_at = session
-    
-    if datetime.utcnow() > expires_at:
+    if time.time() > session['expires_at']:
         return False, None
     
-    if not is_admin:
-        return False, user_id
+    if not session['is_admin']:
+        return False, session['user_id']
     
-    return True, user_id
+    return True, session['user_id']
 
-def handle_admin_stats(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+class AdminRequestError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+def run_admin(event: Dict[str, Any], dsn: str, *payloads: Callable[[Any, Dict[str, Any]], Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Authenticates an admin session and runs the payload queries on the same
+    pooled connection, merging their results into one response. With a warm
+    session cache the check costs no query at all; a cold one adds a single
+    lookup on that connection instead of a separate connect and round trip.
+    Payloads share one transaction, committed after the last one succeeds.
+    '''
+    session_token = request_header(event, 'X-Session-Token')
     
     if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'})
-        }
-    
-    is_admin, user_id = verify_admin(session_token, dsn)
-    if not is_admin:
-        return {
-            'statusCode': 403,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Admin access required'})
-        }
-    
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    cur.execute("SELECT COUNT(*) FROM users")
-    total_users = cur.fetchone()[0]
-    
-    cur.execute("SELECT COUNT(*) FROM generated_images")
-    total_images = cur.fetchone()[0]
+        return json_response(401, {'error': 'Session token required'})
+    
+    params = event.get('queryStringParameters') or {}
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        session = resolve_session(session_token, dsn, cur)
+        if not session or time.time() > session['expires_at'] or not session['is_admin']:
+            return json_response(403, {'error': 'Admin access required'})
+        
+        result: Dict[str, Any] = {'success': True}
+        for payload in payloads:
+            result.update(payload(cur, params))
+        conn.commit()
+        cur.close()
+    except AdminRequestError as e:
+        return json_response(e.status_code, {'error': str(e)})
+    finally:
+        db_pool.putconn(conn)
     
-    cur.execute("SELECT COALESCE(SUM(credits), 0) FROM users WHERE plan != 'unlimited'")
-    total_credits_used = cur.fetchone()[0]
+    return json_response(200, result)
+
+STATS_SERIES_DAYS = int(os.environ.get('STATS_SERIES_DAYS', '30'))
+STATS_SERIES_MAX_DAYS = int(os.environ.get('STATS_SERIES_MAX_DAYS', '366'))
+STATS_ACTIVE_USERS_TTL = float(os.environ.get('STATS_ACTIVE_USERS_TTL', '600'))
+STATS_RECONCILE_DAYS = int(os.environ.get('STATS_RECONCILE_DAYS', '2'))
+STATS_SERIES_METRICS = ('signups', 'generations', 'revenue')
+
+ACTIVE_USERS_REFRESH_SQL = """
+INSERT INTO stats_counters (name, shard, value, updated_at)
+SELECT 'active_users_7d', 0, COUNT(DISTINCT user_id), CURRENT_TIMESTAMP
+FROM user_sessions
+WHERE last_activity > NOW() - INTERVAL '7 days'
+ON CONFLICT (name, shard) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+RETURNING value
+"""
+
+def admin_stats_payload(cur: Any, params: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Reads trigger-maintained counters from stats_counters and daily buckets
+    from stats_daily, both summed over their shards, instead of aggregating users/images on every refresh.
+    Only the 7-day active user count is recomputed here, and only once it is
+    older than STATS_ACTIVE_USERS_TTL seconds.
+    '''
+    try:
+        days = min(max(int(params.get('days', STATS_SERIES_DAYS)), 1), STATS_SERIES_MAX_DAYS)
+    except ValueError:
+        raise AdminRequestError(400, 'Invalid days')
     
-    cur.execute("SELECT COUNT(DISTINCT user_id) FROM user_sessions WHERE last_activity > NOW() - INTERVAL '7 days'")
-    active_users = cur.fetchone()[0]
+    cur.execute(
+        """
+        SELECT name, SUM(value), EXTRACT(EPOCH FROM NOW() - MAX(updated_at))
+        FROM stats_counters
+        GROUP BY name
+        """
+    )
+    counters: Dict[str, Any] = {}
+    active_users_age = None
+    for name, value, age in cur.fetchall():
+        counters[name] = value
+        if name == 'active_users_7d':
+            active_users_age = age
+    
+    if active_users_age is None or active_users_age > STATS_ACTIVE_USERS_TTL:
+        activity_buffer.flush(cur=cur)
+        cur.execute(ACTIVE_USERS_REFRESH_SQL)
+        counters['active_users_7d'] = cur.fetchone()[0]
     
-    cur.close()
-    conn.close()
+    cur.execute(
+        """
+        SELECT m.metric, CURRENT_DATE - o.offset_days AS day, COALESCE(s.value, 0)
+        FROM generate_series(%s - 1, 0, -1) AS o(offset_days)
+        CROSS JOIN unnest(%s::text[]) AS m(metric)
+        LEFT JOIN (
+            SELECT metric, day, SUM(value) AS value FROM stats_daily
+            WHERE day > CURRENT_DATE - %s
+            GROUP BY metric, day
+        ) s ON s.metric = m.metric AND s.day = CURRENT_DATE - o.offset_days
+        ORDER BY day
+        """,
+        (days, list(STATS_SERIES_METRICS), days)
+    )
+    series: Dict[str, List[Dict[str, Any]]] = {metric: [] for metric in STATS_SERIES_METRICS}
+    for metric, day, value in cur.fetchall():
+        series[metric].append({'date': day.isoformat(), 'value': float(value) if metric == 'revenue' else int(value)})
     
     return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'stats': {
-                'total_users': total_users,
-                'total_images': total_images,
-                'total_credits_used': total_credits_used,
-                'active_users': active_users
-            }
-        })
+        'stats': {
+            'total_users': int(counters.get('total_users', 0)),
+            'total_images': int(counters.get('total_images', 0)),
+            'total_credits_used': int(counters.get('total_credits', 0)),
+            'total_revenue': float(counters.get('total_revenue', 0)),
+            'active_users': int(counters['active_users_7d'])
+        },
+        'series': series
     }
 
-def handle_admin_users(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
-    
-    if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'})
-        }
-    
-    is_admin, user_id = verify_admin(session_token, dsn)
-    if not is_admin:
-        return {
-            'statusCode': 403,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Admin access required'})
-        }
-    
-    conn = psycopg2.connect(dsn)
+def handle_admin_stats(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    return run_admin(event, dsn, admin_stats_payload)
+
+def handle_admin_stats_reconcile(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    '''
+    Recomputes the counters exactly and rebuilds the last STATS_RECONCILE_DAYS
+    daily buckets. Meant for a periodic trigger with X-Worker-Key; an admin
+    session may also run it by hand.
+    '''
+    worker_key = os.environ.get('JOB_WORKER_KEY')
+    if not worker_key or request_header(event, 'X-Worker-Key') != worker_key:
+        session_token = request_header(event, 'X-Session-Token')
+        if not session_token:
+            return json_response(401, {'error': 'Session token required'})
+        is_admin, user_id = verify_admin(session_token, dsn)
+        if not is_admin:
+            return json_response(403, {'error': 'Admin access required'})
+    
+    activity_buffer.flush(dsn)
+    
+    started = time.monotonic()
+    conn = db_pool.getconn(dsn)
     cur = conn.cursor()
+    cur.execute("SELECT reconcile_stats(CURRENT_DATE - %s)", (STATS_RECONCILE_DAYS,))
+    conn.commit()
+    cur.close()
+    db_pool.putconn(conn)
     
+    return json_response(200, {
+        'success': True,
+        'reconciled_days': STATS_RECONCILE_DAYS,
+        'duration_ms': round((time.monotonic() - started) * 1000, 1)
+    })
+
+def admin_users_payload(cur: Any, params: Dict[str, Any]) -> Dict[str, Any]:
     cur.execute(
         """
         SELECT id, username, email, credits, plan, is_admin, created_at
@@ -578,9 +1190,6 @@ def handle_admin_users(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     )
     users = cur.fetchall()
     
-    cur.close()
-    conn.close()
-    
     users_list = []
     for user in users:
         users_list.append({
@@ -593,42 +1202,16 @@ def handle_admin_users(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
             'created_at': user[6].isoformat() if user[6] else None
         })
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'users': users_list
-        })
-    }
+    return {'users': users_list}
 
-def handle_admin_images(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
-    
-    if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'})
-        }
-    
-    is_admin, user_id = verify_admin(session_token, dsn)
-    if not is_admin:
-        return {
-            'statusCode': 403,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Admin access required'})
-        }
-    
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
+def handle_admin_users(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    return run_admin(event, dsn, admin_users_payload)
+
+def admin_images_payload(cur: Any, params: Dict[str, Any]) -> Dict[str, Any]:
     cur.execute(
         """
         SELECT gi.id, gi.prompt, gi.image_url, gi.theme, gi.model, gi.created_at,
-               u.id, u.username, u.email
+               u.id, u.username, u.email, gi.variants
         FROM generated_images gi
         JOIN users u ON gi.user_id = u.id
         ORDER BY gi.created_at DESC
@@ -637,9 +1220,6 @@ def handle_admin_images(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     )
     images = cur.fetchall()
     
-    cur.close()
-    conn.close()
-    
     images_list = []
     for img in images:
         images_list.append({
@@ -653,15 +1233,16 @@ def handle_admin_images(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
                 'id': img[6],
                 'username': img[7],
                 'email': img[8]
-            }
+            },
+            'variants': img[9],
+            'srcset': image_srcset(img[9])
         })
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'images': images_list
-        })
-    }
\ No newline at end of file
+    return {'images': images_list}
+
+def handle_admin_images(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    return run_admin(event, dsn, admin_images_payload)
+
+def handle_admin_dashboard(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    '''Stats, latest users and latest images in one request for the admin dashboard'''
+    return run_admin(event, dsn, admin_stats_payload, admin_users_payload, admin_images_payload)
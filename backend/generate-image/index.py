@@ -1,71 +1,941 @@
 """
 Business: Generate AI images with usage limits - 3 free generations, then requires subscription
-Args: event with POST body {prompt, size, model} and header X-Session-Token
-Returns: HTTP response with generated image URL or limit exceeded error
+Args: event with POST body {prompt, size, model, theme, async} and header X-Session-Token;
+      GET ?job_id= polls a queued job, POST ?action=worker drains the job queue
+Returns: HTTP response with the saved image and its URL, job status or limit exceeded error
 """
 
+import base64
+import binascii
+import io
 import json
+import math
 import os
-from typing import Dict, Any
-import requests
-import psycopg2
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Any, Callable, List, Tuple
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'POST')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
-    
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
-    
-    if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+ALLOWED_METHODS = ('GET', 'POST', 'OPTIONS')
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': ', '.join(ALLOWED_METHODS),
+    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+    'Access-Control-Max-Age': CORS_MAX_AGE
+}
+
+def json_dumps(payload: Any, default: Callable[[Any], Any] | None = None) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(payload, default=default)
+
+def json_loads(raw: str | bytes | None) -> Any:
+    if not raw:
+        return {}
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] | None = None,
+                  default: Callable[[Any], Any] | None = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, **headers} if headers else dict(JSON_HEADERS),
+        'isBase64Encoded': False,
+        'body': json_dumps(payload, default)
+    }
+
+def request_header(event: Dict[str, Any], name: str) -> str | None:
+    headers = event.get('headers') or {}
+    return headers.get(name) or headers.get(name.lower())
+
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', '4'))
+BLOB_UPLOAD_WORKERS = int(os.environ.get('BLOB_UPLOAD_WORKERS', '2'))
+VARIANT_WORKERS = int(os.environ.get('VARIANT_WORKERS', '2'))
+
+# Job or backfill threads, background upload threads and the handler thread
+# can all hold a connection at once; the default pool has room for each
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '0')) or (
+    max(JOB_WORKER_CONCURRENCY, VARIANT_WORKERS) + BLOB_UPLOAD_WORKERS + 1
+)
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_LOG_EVERY = int(os.environ.get('DB_POOL_LOG_EVERY', '100'))
+
+class ConnectionPool:
+    '''
+    Per-process pool of warm connections kept at module scope, so a reused
+    container skips the TCP/TLS handshake and backend fork on every request.
+    Idle connections are health-checked and recycled by idle time and age.
+    '''
+
+    def __init__(self, connect: Callable[[str], Any], max_size: int):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []
+        self._born: Dict[int, float] = {}
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'waits': 0, 'recycled': 0, 'leaked': 0}
+
+    def getconn(self, dsn: str) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise RuntimeError('Database connection pool exhausted')
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._connect(dsn)
+                with self._lock:
+                    self._born[id(conn)] = time.monotonic()
+                self._count('misses')
+            else:
+                self._count('hits')
+        except Exception:
+            self._slots.release()
+            raise
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def reclaim(self) -> None:
+        for conn in list(self._checked_out()):
+            self._count('leaked')
+            self.putconn(conn, discard=True)
+
+    def scoped(self, func: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.reclaim()
+        return wrapper
+
+    def _take_idle(self) -> Any:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+                born = self._born.get(id(conn), 0.0)
+            now = time.monotonic()
+            if conn.closed or now - released_at > DB_POOL_MAX_IDLE or now - born > DB_POOL_MAX_LIFETIME:
+                self._count('recycled')
+                self._close(conn)
+                continue
+            if now - released_at > DB_POOL_CHECK_AFTER and not self._is_alive(conn):
+                self._count('recycled')
+                self._close(conn)
+                continue
+            return conn
+
+    def _is_alive(self, conn: Any) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn: Any) -> None:
+        with self._lock:
+            self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checked_out(self) -> List[Any]:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+            checkouts = self.stats['hits'] + self.stats['misses']
+            snapshot = dict(self.stats) if key in ('hits', 'misses') and checkouts % DB_POOL_LOG_EVERY == 0 else None
+        if snapshot:
+            print(json.dumps({'db_pool': snapshot}))
+
+def connect_db(dsn: str) -> Any:
+    import psycopg2
+    return psycopg2.connect(dsn)
+
+db_pool = ConnectionPool(connect_db, DB_POOL_MAX_SIZE)
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '30'))
+SESSION_CACHE_LOG_EVERY = int(os.environ.get('SESSION_CACHE_LOG_EVERY', '500'))
+
+class SessionCache:
+    '''
+    Bounded LRU of resolved sessions keyed by a SHA-256 of the token. Entries
+    live for SESSION_CACHE_TTL seconds or until the session expires, whichever
+    comes first, and are dropped explicitly on logout or account changes.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(session_token: str) -> str:
+        return hashlib.sha256(session_token.encode('utf-8')).hexdigest()
+
+    def get(self, session_token: str) -> Dict[str, Any] | None:
+        key = self.key(session_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                session = entry[1]
+                self._count('hits')
+            else:
+                if entry:
+                    del self._entries[key]
+                session = None
+                self._count('misses')
+        return session
+
+    def put(self, session_token: str, session: Dict[str, Any]) -> None:
+        ttl = min(self._ttl, session['expires_at'] - time.time())
+        if ttl <= 0:
+            return
+        key = self.key(session_token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, session)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, session_token: str) -> None:
+        with self._lock:
+            if self._entries.pop(self.key(session_token), None):
+                self.stats['invalidations'] += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            stale = [key for key, (_, session) in self._entries.items() if session['user_id'] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self.stats['invalidations'] += len(stale)
+
+    def _count(self, key: str) -> None:
+        self.stats[key] += 1
+        if (self.stats['hits'] + self.stats['misses']) % SESSION_CACHE_LOG_EVERY == 0:
+            print(json.dumps({'session_cache': self.stats}))
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+def resolve_session(session_token: str, dsn: str, fresh: bool = False) -> Dict[str, Any] | None:
+    '''
+    Returns the session with its user, from the cache when warm; expired
+    sessions are returned too. Logout and password resets only clear the
+    cache of the auth function, so here a revoked token stays valid for up
+    to SESSION_CACHE_TTL seconds; fresh=True reads user_sessions instead and
+    is used wherever the request spends or grants something.
+    '''
+    session = None if fresh else session_cache.get(session_token)
+    if session:
+        return session
+
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT s.user_id, EXTRACT(EPOCH FROM s.expires_at), u.email, u.username, u.full_name,
+                   u.credits, u.plan, u.avatar_url, u.is_admin, s.id
+            FROM user_sessions s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.session_token = %s
+            """,
+            (session_token,)
+        )
+        row = cur.fetchone()
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+
+    if not row:
+        return None
+
+    session = {
+        'user_id': row[0],
+        'expires_at': float(row[1]),
+        'email': row[2],
+        'username': row[3],
+        'full_name': row[4],
+        'credits': row[5],
+        'plan': row[6],
+        'avatar_url': row[7],
+        'is_admin': bool(row[8]),
+        'session_id': row[9]
+    }
+    session_cache.put(session_token, session)
+    return session
+OPENAI_API_BASE = os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
+IMAGE_API_TIMEOUT = float(os.environ.get('IMAGE_API_TIMEOUT', '60'))
+JOB_WORKER_BUDGET = float(os.environ.get('JOB_WORKER_BUDGET', '50'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', '180'))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', '15'))
+JOB_RETRY_MAX_DELAY = float(os.environ.get('JOB_RETRY_MAX_DELAY', '600'))
+JOB_MIN_CALL_TIME = float(os.environ.get('JOB_MIN_CALL_TIME', '20'))
+
+class ImageApiError(Exception):
+    def __init__(self, status_code: int, message: str, retryable: bool, retry_after: float | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+def call_image_api(prompt: str, size: str, model: str, quality: str, response_format: str = 'url',
+                   timeout: float = IMAGE_API_TIMEOUT) -> str:
+    api_key = os.environ.get('OPENAI_API_KEY')
+    if not api_key:
+        raise ImageApiError(500, 'OpenAI API key not configured', False)
+
+    import requests
+    try:
+        response = requests.post(
+            f'{OPENAI_API_BASE}/images/generations',
+            headers={
+                'Authorization': f'Bearer {api_key}',
+                'Content-Type': 'application/json'
             },
-            'body': json.dumps({'error': 'Session token required', 'code': 'AUTH_REQUIRED'})
-        }
-    
-    dsn = os.environ.get('DATABASE_URL')
-    if not dsn:
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
+            json={
+                'model': model,
+                'prompt': prompt,
+                'n': 1,
+                'size': size,
+                'quality': quality,
+                'response_format': response_format
             },
-            'body': json.dumps({'error': 'Database not configured'})
-        }
-    
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
+            timeout=timeout
+        )
+    except requests.RequestException as e:
+        raise ImageApiError(504, f'Image API request failed: {e}', True)
+
+    if response.status_code != 200:
+        try:
+            message = response.json().get('error', {}).get('message', 'Failed to generate image')
+        except ValueError:
+            message = 'Failed to generate image'
+        try:
+            retry_after = float(response.headers.get('Retry-After', ''))
+        except ValueError:
+            retry_after = None
+        raise ImageApiError(response.status_code, message, response.status_code == 429 or response.status_code >= 500, retry_after)
+
+    try:
+        return response.json()['data'][0].get(response_format, '')
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        raise ImageApiError(502, 'Image API returned an invalid response', True)
+
+BLOB_STORE = os.environ.get('BLOB_STORE', '')
+BLOB_PUBLIC_BASE_URL = os.environ.get('BLOB_PUBLIC_BASE_URL', '').rstrip('/')
+BLOB_FS_ROOT = os.environ.get('BLOB_FS_ROOT', '/tmp/blobs')
+BLOB_S3_BUCKET = os.environ.get('BLOB_S3_BUCKET', '')
+BLOB_S3_ENDPOINT = os.environ.get('BLOB_S3_ENDPOINT', 'https://storage.yandexcloud.net')
+BLOB_S3_REGION = os.environ.get('BLOB_S3_REGION', 'ru-central1')
+BLOB_UPLOAD_ATTEMPTS = int(os.environ.get('BLOB_UPLOAD_ATTEMPTS', '3'))
+BLOB_PARKED_MAX = int(os.environ.get('BLOB_PARKED_MAX', '8'))
+BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class FilesystemBlobStore:
+    '''
+    Stores blobs as files under root, for local runs and tests. Files are
+    written to a temporary name and renamed, so readers never see a partial
+    image.
+    '''
+
+    def __init__(self, root: str, base_url: str):
+        self._root = root
+        self._base_url = base_url
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        path = os.path.join(self._root, key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self._root, key), 'rb') as f:
+            return f.read()
+
+    def url(self, key: str) -> str:
+        if self._base_url:
+            return f'{self._base_url}/{key}'
+        return 'file://' + os.path.join(self._root, key)
+
+class S3BlobStore:
+    '''
+    S3-compatible object storage. boto3 is imported when the first upload
+    runs, so requests that never store an image do not pay for it.
+    '''
+
+    def __init__(self, bucket: str, endpoint: str, region: str, base_url: str):
+        self._bucket = bucket
+        self._endpoint = endpoint.rstrip('/')
+        self._region = region
+        self._base_url = base_url or f'{self._endpoint}/{bucket}'
+        self._client = None
+        self._lock = threading.Lock()
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        self._get_client().put_object(
+            Bucket=self._bucket,
+            Key=key,
+            Body=data,
+            ContentType=content_type,
+            CacheControl=BLOB_CACHE_CONTROL
+        )
+
+    def get(self, key: str) -> bytes:
+        return self._get_client().get_object(Bucket=self._bucket, Key=key)['Body'].read()
+
+    def url(self, key: str) -> str:
+        return f'{self._base_url}/{key}'
+
+    def _get_client(self) -> Any:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    self._client = boto3.client('s3', endpoint_url=self._endpoint, region_name=self._region)
+        return self._client
+
+def blob_store_from_env() -> Any:
+    if BLOB_STORE == 'filesystem':
+        return FilesystemBlobStore(BLOB_FS_ROOT, BLOB_PUBLIC_BASE_URL)
+    if BLOB_STORE == 's3':
+        return S3BlobStore(BLOB_S3_BUCKET, BLOB_S3_ENDPOINT, BLOB_S3_REGION, BLOB_PUBLIC_BASE_URL)
+    return None
+
+class BlobUploader:
+    '''
+    Uploads originals on a small background pool so responses never wait on
+    object storage, retrying with backoff, and then runs follow-up work such
+    as variant rendering. An upload that still fails is parked, up to
+    BLOB_PARKED_MAX images, and handed back to the pool by retry_parked() on
+    a later request. Keys are content-addressed, which makes retries and
+    duplicate uploads of the same image harmless.
+    '''
+
+    def __init__(self, store: Any, workers: int, attempts: int, parked_max: int):
+        self._store = store
+        self._attempts = attempts
+        self._parked_max = parked_max
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='blob')
+        self._lock = threading.Lock()
+        self._pending: set = set()
+        self._parked: OrderedDict[str, Tuple[bytes, str, Callable[[], None] | None]] = OrderedDict()
+
+    def store(self, key: str, data: bytes, content_type: str, then: Callable[[], None] | None = None) -> None:
+        future = self._executor.submit(self._upload, key, data, content_type, then)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+
+    def retry_parked(self) -> None:
+        with self._lock:
+            parked, self._parked = list(self._parked.items()), OrderedDict()
+        for key, (data, content_type, then) in parked:
+            self.store(key, data, content_type, then)
+
+    def wait(self, timeout: float) -> None:
+        with self._lock:
+            pending = list(self._pending)
+        if pending and timeout > 0:
+            wait(pending, timeout)
+
+    def _upload(self, key: str, data: bytes, content_type: str, then: Callable[[], None] | None) -> None:
+        for attempt in range(1, self._attempts + 1):
+            try:
+                self._store.put(key, data, content_type)
+                break
+            except Exception as e:
+                if attempt == self._attempts:
+                    print(json.dumps({'blob_upload_failed': key, 'error': str(e)}))
+                    self._park(key, data, content_type, then)
+                    return
+                time.sleep(0.5 * 2 ** (attempt - 1))
+        if then is not None:
+            try:
+                then()
+            except Exception as e:
+                print(json.dumps({'blob_followup_failed': key, 'error': str(e)}))
+
+    def _park(self, key: str, data: bytes, content_type: str, then: Callable[[], None] | None) -> None:
+        with self._lock:
+            self._parked[key] = (data, content_type, then)
+            while len(self._parked) > self._parked_max:
+                dropped, _ = self._parked.popitem(last=False)
+                print(json.dumps({'blob_upload_dropped': dropped}))
+
+    def _done(self, future: Any) -> None:
+        with self._lock:
+            self._pending.discard(future)
+
+blob_store = blob_store_from_env()
+blob_uploader = BlobUploader(blob_store, BLOB_UPLOAD_WORKERS, BLOB_UPLOAD_ATTEMPTS, BLOB_PARKED_MAX) if blob_store else None
+
+def blob_prefix(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    return f'images/{digest[:2]}/{digest}'
+
+def blob_key(data: bytes) -> str:
+    return f'{blob_prefix(data)}.png'
+
+VARIANT_FORMATS = [fmt.strip() for fmt in os.environ.get('VARIANT_FORMATS', 'webp').split(',') if fmt.strip()]
+VARIANT_WIDTHS = sorted(int(width) for width in os.environ.get('VARIANT_WIDTHS', '320,640,1024').split(',') if width.strip())
+VARIANT_QUALITY = int(os.environ.get('VARIANT_QUALITY', '80'))
+VARIANT_MAX_PIXELS = int(os.environ.get('VARIANT_MAX_PIXELS', str(4096 * 4096)))
+VARIANT_MAX_BYTES = int(os.environ.get('VARIANT_MAX_BYTES', str(20 * 1024 * 1024)))
+VARIANT_BACKFILL_BATCH = int(os.environ.get('VARIANT_BACKFILL_BATCH', '20'))
+VARIANT_BACKFILL_BUDGET = float(os.environ.get('VARIANT_BACKFILL_BUDGET', '50'))
+VARIANT_SOURCE_HOSTS = {host.strip().lower() for host in os.environ.get('VARIANT_SOURCE_HOSTS', '').split(',') if host.strip()}
+VARIANT_TABLES = ('generated_images', 'gallery_items', 'photoshoot_examples')
+VARIANT_SAVE_OPTIONS = {'webp': {'method': 4}, 'avif': {'speed': 6}}
+
+variant_slots = threading.BoundedSemaphore(VARIANT_WORKERS)
+
+class UnusableImage(ValueError):
+    '''The original can never yield variants: undecodable, too large or gone upstream'''
+
+class SourceNotAllowed(ValueError):
+    '''The original's URL is neither in the blob store nor on a VARIANT_SOURCE_HOSTS host'''
+
+def render_variants(data: bytes) -> List[Tuple[str, int, bytes]]:
+    '''
+    Decodes one image and encodes it at every VARIANT_WIDTHS width that is not
+    wider than the original, largest first, each step downscaling the last.
+    At most VARIANT_WORKERS decodes run at once, and images whose header
+    declares more than VARIANT_MAX_PIXELS are refused before any pixel data
+    is decoded, which bounds memory per instance.
+    '''
+    from PIL import Image
+
+    rendered = []
+    with variant_slots:
+        try:
+            with Image.open(io.BytesIO(data)) as source:
+                if source.width * source.height > VARIANT_MAX_PIXELS:
+                    raise UnusableImage(f'Image is {source.width}x{source.height}, above VARIANT_MAX_PIXELS')
+                source.draft('RGB', (VARIANT_WIDTHS[-1], VARIANT_WIDTHS[-1]))
+                image = source.convert('RGBA' if source.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        except (Image.DecompressionBombError, OSError, SyntaxError) as e:
+            raise UnusableImage(f'Image cannot be decoded: {e}')
+        for width in sorted({min(width, image.width) for width in VARIANT_WIDTHS}, reverse=True):
+            if width != image.width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            for fmt in VARIANT_FORMATS:
+                out = io.BytesIO()
+                try:
+                    image.save(out, fmt.upper(), quality=VARIANT_QUALITY, **VARIANT_SAVE_OPTIONS.get(fmt, {}))
+                except (KeyError, OSError) as e:
+                    print(json.dumps({'variant_format_failed': fmt, 'error': str(e)}))
+                    continue
+                rendered.append((fmt, width, out.getvalue()))
+    return rendered
+
+def store_variants(data: bytes, prefix: str) -> Dict[str, Dict[str, str]]:
+    '''Writes the variants next to the original as <prefix>-<width>w.<format> and returns {format: {width: url}}'''
+    variants: Dict[str, Dict[str, str]] = {}
+    for fmt, width, encoded in render_variants(data):
+        key = f'{prefix}-{width}w.{fmt}'
+        blob_store.put(key, encoded, f'image/{fmt}')
+        variants.setdefault(fmt, {})[str(width)] = blob_store.url(key)
+    return variants
+
+def attach_variants(storage_key: str, data: bytes) -> None:
+    '''Runs after the original is uploaded; rows inserted after this point are left to the backfill'''
+    variants = store_variants(data, storage_key.rsplit('.', 1)[0])
+    conn = db_pool.getconn(os.environ['DATABASE_URL'])
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE generated_images SET variants = %s::jsonb WHERE storage_key = %s AND variants IS NULL",
+            (json.dumps(variants), storage_key)
+        )
+        conn.commit()
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+
+def download_image(image_url: str, allow_redirects: bool = True) -> bytes:
+    import requests
+    with requests.get(image_url, timeout=IMAGE_API_TIMEOUT, stream=True, allow_redirects=allow_redirects) as response:
+        if response.status_code in (404, 410):
+            raise UnusableImage(f'Image is gone upstream ({response.status_code})')
+        response.raise_for_status()
+        chunks, size = [], 0
+        for chunk in response.iter_content(65536):
+            size += len(chunk)
+            if size > VARIANT_MAX_BYTES:
+                raise UnusableImage('Image is larger than VARIANT_MAX_BYTES')
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+def load_original(image_url: str, storage_key: str | None) -> bytes:
+    '''
+    Reads the original for the backfill. Row URLs can come from unauthenticated
+    writes, so only our own blob store and https hosts in VARIANT_SOURCE_HOSTS
+    are read; anything else is refused rather than fetched.
+    '''
+    from urllib.parse import urlsplit
+    if storage_key:
+        return blob_store.get(storage_key)
+    prefix = blob_store.url('')
+    if image_url.startswith(prefix):
+        key = image_url[len(prefix):]
+        if key and '..' not in key.split('/'):
+            return blob_store.get(key)
+    parts = urlsplit(image_url)
+    if parts.scheme != 'https' or (parts.hostname or '').lower() not in VARIANT_SOURCE_HOSTS:
+        raise SourceNotAllowed('Image URL is not in the blob store or VARIANT_SOURCE_HOSTS')
+    return download_image(image_url, allow_redirects=False)
+
+def backfill_variant(dsn: str, table: str, row: Tuple[Any, ...]) -> str:
+    '''
+    Renders one row and returns its outcome. Only an original that can never
+    work (UnusableImage) is marked with an empty map; a refused URL or a
+    network or storage error leaves variants NULL so a later run retries it.
+    '''
+    row_id, image_url, storage_key = row
+    try:
+        data = load_original(image_url, storage_key)
+        variants = store_variants(data, (storage_key or blob_key(data)).rsplit('.', 1)[0])
+        outcome = 'done'
+    except SourceNotAllowed:
+        return 'skipped'
+    except UnusableImage as e:
+        print(json.dumps({'variant_backfill_failed': f'{table}:{row_id}', 'error': str(e)}))
+        variants, outcome = {}, 'failed'
+    except Exception as e:
+        print(json.dumps({'variant_backfill_retry': f'{table}:{row_id}', 'error': str(e)}))
+        return 'retry'
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"UPDATE {table} SET variants = %s::jsonb WHERE id = %s AND variants IS NULL",
+            (json.dumps(variants), row_id)
+        )
+        conn.commit()
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+    return outcome
+
+def render_rows_now(dsn: str, table: str, ids: List[int]) -> Dict[str, Any]:
+    '''
+    Renders variants for rows the admin function has just saved, so gallery
+    and photoshoot images do not wait for the next backfill run. Rows left
+    NULL here are picked up by the backfill.
+    '''
+    if blob_store is None:
+        return json_response(409, {'error': 'BLOB_STORE is not configured'})
+    if table not in VARIANT_TABLES or table == 'generated_images':
+        return json_response(400, {'error': 'Invalid table'})
+    if not isinstance(ids, list) or not ids or not all(type(row_id) is int for row_id in ids):
+        return json_response(400, {'error': 'Invalid ids'})
+
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"SELECT id, image_url, NULL FROM {table} WHERE id = ANY(%s) AND variants IS NULL",
+            (ids[:VARIANT_BACKFILL_BATCH],)
+        )
+        rows = cur.fetchall()
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+
+    counts = {'done': 0, 'failed': 0, 'retry': 0, 'skipped': 0}
+    with ThreadPoolExecutor(max_workers=VARIANT_WORKERS) as executor:
+        for outcome in executor.map(lambda row: backfill_variant(dsn, table, row), rows):
+            counts[outcome] += 1
+    return json_response(200, {'success': True, 'variants': counts})
+
+def run_variant_backfill(dsn: str) -> Dict[str, Any]:
+    '''
+    Generates variants for rows saved before the pipeline existed, walking each
+    table in id order until the time budget is spent. Progress is the
+    variants column itself, so the next call resumes where this one stopped.
+    Rows whose original can never be rendered get an empty map and keep their
+    full-size image; transient failures and refused URLs stay NULL and are
+    retried by the next run.
+    '''
+    if blob_store is None:
+        return json_response(409, {'error': 'BLOB_STORE is not configured'})
+
+    deadline = time.monotonic() + VARIANT_BACKFILL_BUDGET
+    counts = {table: {'done': 0, 'failed': 0, 'retry': 0, 'skipped': 0, 'remaining': 0} for table in VARIANT_TABLES}
+
+    with ThreadPoolExecutor(max_workers=VARIANT_WORKERS) as executor:
+        for table in VARIANT_TABLES:
+            storage_column = 'storage_key' if table == 'generated_images' else 'NULL'
+            after = 0
+            while time.monotonic() < deadline:
+                conn = db_pool.getconn(dsn)
+                try:
+                    cur = conn.cursor()
+                    cur.execute(
+                        f"""
+                        SELECT id, image_url, {storage_column}
+                        FROM {table}
+                        WHERE variants IS NULL AND id > %s
+                        ORDER BY id
+                        LIMIT %s
+                        """,
+                        (after, VARIANT_BACKFILL_BATCH)
+                    )
+                    rows = cur.fetchall()
+                    cur.close()
+                finally:
+                    db_pool.putconn(conn)
+                if not rows:
+                    break
+                after = rows[-1][0]
+                for outcome in executor.map(lambda row: backfill_variant(dsn, table, row), rows):
+                    counts[table][outcome] += 1
+
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        for table in VARIANT_TABLES:
+            cur.execute(f"SELECT COUNT(*) FROM {table} WHERE variants IS NULL")
+            counts[table]['remaining'] = cur.fetchone()[0]
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+
+    return json_response(200, {'success': True, 'variants': counts})
+
+def fetch_image(prompt: str, size: str, model: str, quality: str, timeout: float = IMAGE_API_TIMEOUT) -> Tuple[str, str | None]:
+    '''
+    Returns (image_url, storage_key). With BLOB_STORE set the image is
+    requested as b64_json and decoded in-process, so there is no second
+    download; the URL is the content-addressed blob URL and the upload, then
+    variant rendering, run on the background pool without holding up the
+    response. Without a store the expiring upstream URL is returned.
+    '''
+    if blob_store is None:
+        image_url = call_image_api(prompt, size, model, quality, timeout=timeout)
+        if not image_url:
+            raise ImageApiError(502, 'Image API returned no image', True)
+        return image_url, None
+
+    encoded = call_image_api(prompt, size, model, quality, 'b64_json', timeout)
+    try:
+        data = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, TypeError, ValueError):
+        data = b''
+    if not data:
+        raise ImageApiError(502, 'Image API returned no image', True)
+    key = blob_key(data)
+    blob_uploader.store(key, data, 'image/png', lambda: attach_variants(key, data))
+    return blob_store.url(key), key
+
+PROMPT_CACHE_ENABLED = os.environ.get('PROMPT_CACHE_ENABLED', 'false').lower() == 'true'
+PROMPT_CACHE_SIZE = int(os.environ.get('PROMPT_CACHE_SIZE', '512'))
+PROMPT_CACHE_TTL = float(os.environ.get('PROMPT_CACHE_TTL', '1800'))
+PROMPT_CACHE_FREE_HITS = os.environ.get('PROMPT_CACHE_FREE_HITS', 'false').lower() == 'true'
+PROMPT_CACHE_LOG_EVERY = int(os.environ.get('PROMPT_CACHE_LOG_EVERY', '100'))
+
+class PromptFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Tuple[Tuple[str, str | None], float] | None = None
+        self.error: Exception | None = None
+
+class PromptCache:
+    '''
+    LRU of upstream image results keyed by a hash of the normalised
+    (prompt, size, model, quality). Concurrent misses for the same key are
+    coalesced: one caller goes upstream and the others wait for its result.
+    Without a blob store the TTL should stay below the lifetime of the
+    upstream image URLs.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, Tuple[str, str | None], float]] = OrderedDict()
+        self._inflight: Dict[str, PromptFlight] = {}
+        self.stats: Dict[str, float] = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'saved_seconds': 0.0}
+
+    @staticmethod
+    def key(prompt: str, size: str, model: str, quality: str) -> str:
+        normalised = ' '.join(prompt.split()).casefold()
+        return hashlib.sha256('\x1f'.join((normalised, size, model, quality)).encode('utf-8')).hexdigest()
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], Tuple[str, str | None]]) -> Tuple[Tuple[str, str | None], bool]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._count('hits', entry[2])
+                return entry[1], True
+            if entry:
+                del self._entries[key]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = PromptFlight()
+                self._count('misses', 0.0)
+
+        if not leader:
+            if not flight.done.wait(IMAGE_API_TIMEOUT + 5):
+                raise ImageApiError(504, 'Timed out waiting for an identical generation', True)
+            if flight.error is not None:
+                raise flight.error
+            image, elapsed = flight.result
+            with self._lock:
+                self._count('coalesced', elapsed)
+            return image, True
+
+        started = time.monotonic()
+        try:
+            image = fetch()
+            elapsed = time.monotonic() - started
+            flight.result = (image, elapsed)
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self._ttl, image, elapsed)
+                while len(self._entries) > self._max_size:
+                    self._entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+            return image, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def _count(self, key: str, saved: float) -> None:
+        self.stats[key] += 1
+        self.stats['saved_seconds'] += saved
+        lookups = self.stats['hits'] + self.stats['misses'] + self.stats['coalesced']
+        if lookups % PROMPT_CACHE_LOG_EVERY == 0:
+            report = dict(self.stats, hit_rate=round((lookups - self.stats['misses']) / lookups, 4))
+            print(json.dumps({'prompt_cache': report}))
+
+prompt_cache = PromptCache(PROMPT_CACHE_SIZE, PROMPT_CACHE_TTL)
+
+def generate_image(prompt: str, size: str, model: str, quality: str,
+                   timeout: float = IMAGE_API_TIMEOUT) -> Tuple[Tuple[str, str | None], bool]:
+    '''Returns ((image_url, storage_key), served_from_cache); goes straight upstream unless PROMPT_CACHE_ENABLED'''
+    if not PROMPT_CACHE_ENABLED:
+        return fetch_image(prompt, size, model, quality, timeout), False
+    return prompt_cache.get_or_fetch(
+        PromptCache.key(prompt, size, model, quality),
+        lambda: fetch_image(prompt, size, model, quality, timeout)
+    )
+
+SAVE_IMAGE_SQL = """
+    INSERT INTO generated_images (user_id, prompt, image_url, storage_key, theme, model, is_favorite, is_archived)
+    VALUES (%s, %s, %s, %s, %s, %s, FALSE, FALSE)
+    RETURNING id, user_id, prompt, image_url, theme, model, is_favorite, created_at
+"""
+
+def saved_image(row: Tuple[Any, ...]) -> Dict[str, Any]:
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'prompt': row[2],
+        'image_url': row[3],
+        'theme': row[4],
+        'model': row[5],
+        'is_favorite': row[6],
+        'created_at': str(row[7])
+    }
+
+def charge_kind(sub_status: str | None, is_admin: bool) -> str:
+    if is_admin:
+        return 'none'
+    if sub_status == 'none' or sub_status is None:
+        return 'free'
+    return 'credit'
+
+RESERVE_SQL = """
+    UPDATE users u
+    SET free_generations_used = u.free_generations_used + CASE
+            WHEN NOT COALESCE(u.is_admin, FALSE) AND COALESCE(u.subscription_status, 'none') = 'none' THEN 1 ELSE 0 END,
+        credits = u.credits - CASE
+            WHEN NOT COALESCE(u.is_admin, FALSE) AND COALESCE(u.subscription_status, 'none') <> 'none' THEN 1 ELSE 0 END
+    {source}
+      AND (COALESCE(u.is_admin, FALSE)
+           OR (COALESCE(u.subscription_status, 'none') = 'none' AND u.free_generations_used < u.free_generations_limit)
+           OR (COALESCE(u.subscription_status, 'none') <> 'none' AND u.credits > 0))
+    RETURNING u.id, u.free_generations_used, u.free_generations_limit,
+              u.subscription_status, u.credits, COALESCE(u.is_admin, FALSE)
+"""
+
+RESERVE_BY_SESSION_SQL = RESERVE_SQL.format(
+    source='FROM user_sessions s\n    WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP AND u.id = s.user_id'
+)
+
+def reserve_for_session(cur: Any, session_token: str) -> Tuple[Any, ...] | None:
+    '''
+    Resolves the session and takes one free generation or credit in a single
+    conditional UPDATE. The row lock makes parallel requests from one account
+    queue up and re-check the balance, so they cannot overspend. The session
+    is always checked against user_sessions here, never the cache, so a token
+    revoked by logout or a password reset cannot spend.
+    '''
+    cur.execute(RESERVE_BY_SESSION_SQL, (session_token,))
+    return cur.fetchone()
+
+def reservation_denied(cur: Any, session_token: str) -> Dict[str, Any]:
+    '''Builds the error for a failed reservation; only runs on the slow path'''
     cur.execute(
         """
-        SELECT u.id, u.free_generations_used, u.free_generations_limit, 
-               u.subscription_status, u.credits, u.plan, u.is_admin
+        SELECT u.free_generations_used, u.free_generations_limit, u.subscription_status, u.credits
         FROM user_sessions s
         JOIN users u ON s.user_id = u.id
         WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP
@@ -73,161 +943,559 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         (session_token,)
     )
     user_data = cur.fetchone()
-    
+
     if not user_data:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Invalid or expired session', 'code': 'AUTH_REQUIRED'})
-        }
-    
-    user_id, free_used, free_limit, sub_status, credits, plan, is_admin = user_data
-    
-    if is_admin:
-        pass
-    elif sub_status == 'none' or sub_status is None:
-        if free_used >= free_limit:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 403,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'Free generations limit exceeded',
-                    'code': 'LIMIT_EXCEEDED',
-                    'free_used': free_used,
-                    'free_limit': free_limit,
-                    'message': 'You have used all 3 free generations. Please subscribe to continue.'
-                })
-            }
-    else:
-        if credits <= 0:
+        return json_response(401, {'error': 'Invalid or expired session', 'code': 'AUTH_REQUIRED'})
+
+    free_used, free_limit, sub_status, credits = user_data
+    if sub_status == 'none' or sub_status is None:
+        return limit_exceeded_response(free_used, free_limit)
+    return no_credits_response(credits)
+
+def refund_generation(cur: Any, user_id: int, charge: str) -> None:
+    if charge == 'free':
+        cur.execute(
+            "UPDATE users SET free_generations_used = GREATEST(free_generations_used - 1, 0) WHERE id = %s",
+            (user_id,)
+        )
+    elif charge == 'credit':
+        cur.execute("UPDATE users SET credits = credits + 1 WHERE id = %s", (user_id,))
+
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '10000'))
+RATE_LIMIT_SWEEP_INTERVAL = float(os.environ.get('RATE_LIMIT_SWEEP_INTERVAL', '3600'))
+
+RATE_LIMIT_TAKE_SQL = """
+INSERT INTO rate_limit_buckets AS b (bucket_key, capacity, rate, tokens, allowed, updated_at)
+SELECT k, c, r, c - 1, TRUE, clock_timestamp()
+FROM unnest(%s::text[], %s::float8[], %s::float8[]) AS t(k, c, r)
+ORDER BY k
+ON CONFLICT (bucket_key) DO UPDATE SET
+    capacity = EXCLUDED.capacity,
+    rate = EXCLUDED.rate,
+    allowed = LEAST(EXCLUDED.capacity, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * EXCLUDED.rate) >= 1,
+    tokens = LEAST(EXCLUDED.capacity, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * EXCLUDED.rate)
+        - CASE WHEN LEAST(EXCLUDED.capacity, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * EXCLUDED.rate) >= 1
+               THEN 1 ELSE 0 END,
+    updated_at = clock_timestamp()
+RETURNING allowed, tokens, rate
+"""
+
+def parse_rate_limit(spec: str) -> Tuple[float, float] | None:
+    '''Parses "capacity/seconds" into (capacity, tokens per second); empty, 0 or off disables the limit'''
+    spec = spec.strip()
+    if not spec or spec in ('0', 'off'):
+        return None
+    capacity, _, seconds = spec.partition('/')
+    return float(capacity), float(capacity) / float(seconds or 1)
+
+class MemoryRateLimitStore:
+    '''
+    Token buckets held by this instance only. Buckets refill lazily when
+    touched, and the least recently used ones are dropped beyond max_keys.
+    '''
+
+    def __init__(self, max_keys: int):
+        self._max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def take(self, dsn: str, buckets: List[Tuple[str, float, float]]) -> float:
+        now = time.monotonic()
+        retry_after = 0.0
+        with self._lock:
+            for key, capacity, rate in buckets:
+                tokens, updated = self._buckets.pop(key, (capacity, now))
+                tokens = min(capacity, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    retry_after = max(retry_after, (1 - tokens) / rate)
+                self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+class PostgresRateLimitStore:
+    '''
+    Token buckets shared by every instance through rate_limit_buckets. One
+    UPSERT refills, checks and debits all buckets of a request under their
+    row locks, taken in key order so concurrent requests cannot deadlock.
+    '''
+
+    def __init__(self, sweep_interval: float):
+        self._sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+
+    def take(self, dsn: str, buckets: List[Tuple[str, float, float]]) -> float:
+        keys, capacities, rates = (list(column) for column in zip(*buckets))
+        conn = db_pool.getconn(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute(RATE_LIMIT_TAKE_SQL, (keys, capacities, rates))
+            rows = cur.fetchall()
+            if time.monotonic() >= self._next_sweep:
+                self._next_sweep = time.monotonic() + self._sweep_interval
+                cur.execute("DELETE FROM rate_limit_buckets WHERE updated_at < NOW() - INTERVAL '1 day'")
+            conn.commit()
             cur.close()
-            conn.close()
-            return {
-                'statusCode': 403,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'No credits remaining',
-                    'code': 'NO_CREDITS',
-                    'credits': credits,
-                    'message': 'You have no credits left. Please upgrade your plan.'
-                })
-            }
-    
-    api_key = os.environ.get('OPENAI_API_KEY')
-    if not api_key:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'OpenAI API key not configured'})
-        }
-    
-    body_data = json.loads(event.get('body', '{}'))
+        finally:
+            db_pool.putconn(conn)
+        return max([(1 - tokens) / rate for allowed, tokens, rate in rows if not allowed] or [0.0])
+
+class RateLimiter:
+    '''
+    Checks a request against named per-action limits. Every (limit, key) pair
+    is its own bucket; the request is rejected if any bucket is empty. Store
+    errors fail open so an outage of the limiter never blocks sign-ins.
+    '''
+
+    def __init__(self, store: Any, limits: Dict[str, Tuple[float, float] | None]):
+        self._store = store
+        self._limits = limits
+
+    def check(self, dsn: str, keys: List[Tuple[str, str]]) -> float:
+        buckets = [
+            (f'{name}:{key}', *self._limits[name])
+            for name, key in keys
+            if self._limits.get(name) and key
+        ]
+        if not buckets or self._store is None:
+            return 0.0
+        try:
+            return self._store.take(dsn, buckets)
+        except Exception as e:
+            print(json.dumps({'rate_limiter_error': str(e)}))
+            return 0.0
+
+def rate_limit_store(backend: str) -> Any:
+    if backend == 'postgres':
+        return PostgresRateLimitStore(RATE_LIMIT_SWEEP_INTERVAL)
+    if backend == 'memory':
+        return MemoryRateLimitStore(RATE_LIMIT_MAX_KEYS)
+    return None
+
+def source_ip(event: Dict[str, Any]) -> str:
+    return (event.get('requestContext') or {}).get('identity', {}).get('sourceIp', 'unknown')
+
+def rate_limited_response(retry_after: float) -> Dict[str, Any]:
+    seconds = max(1, math.ceil(retry_after))
+    return json_response(429, {'error': 'Too many requests', 'code': 'RATE_LIMITED', 'retry_after': seconds},
+                         {'Retry-After': str(seconds)})
+
+rate_limiter = RateLimiter(rate_limit_store(RATE_LIMIT_BACKEND), {
+    'generate_user': parse_rate_limit(os.environ.get('RATE_LIMIT_GENERATE_USER', '10/60')),
+    'generate_ip': parse_rate_limit(os.environ.get('RATE_LIMIT_GENERATE_IP', '30/60'))
+})
+
+@db_pool.scoped
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    if method == 'OPTIONS':
+        return {'statusCode': 200, 'headers': PREFLIGHT_HEADERS, 'body': ''}
+
+    if method not in ALLOWED_METHODS:
+        return json_response(405, {'error': 'Method not allowed'})
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        return json_response(500, {'error': 'Database not configured'})
+
+    if blob_uploader:
+        blob_uploader.retry_parked()
+
+    params = event.get('queryStringParameters') or {}
+
+    if method == 'POST' and params.get('action') == 'worker':
+        worker_key = os.environ.get('JOB_WORKER_KEY')
+        if not worker_key or request_header(event, 'X-Worker-Key') != worker_key:
+            return json_response(403, {'error': 'Forbidden'})
+        return run_worker(dsn)
+
+    if method == 'POST' and params.get('action') == 'variants-backfill':
+        worker_key = os.environ.get('JOB_WORKER_KEY')
+        if not worker_key or request_header(event, 'X-Worker-Key') != worker_key:
+            return json_response(403, {'error': 'Forbidden'})
+        return run_variant_backfill(dsn)
+
+    if method == 'POST' and params.get('action') == 'variants':
+        worker_key = os.environ.get('JOB_WORKER_KEY')
+        if not worker_key or request_header(event, 'X-Worker-Key') != worker_key:
+            return json_response(403, {'error': 'Forbidden'})
+        body_data = json_loads(event.get('body'))
+        return render_rows_now(dsn, body_data.get('table'), body_data.get('ids'))
+
+    session_token = request_header(event, 'X-Session-Token')
+
+    if not session_token:
+        return json_response(401, {'error': 'Session token required', 'code': 'AUTH_REQUIRED'})
+
+    if method == 'GET':
+        return get_job(params.get('job_id'), session_token, dsn)
+
+    # The IP bucket goes first so a flood of made-up tokens is refused before
+    # any session lookup; the user bucket needs the resolved session
+    retry_after = rate_limiter.check(dsn, [('generate_ip', source_ip(event))])
+    if retry_after:
+        return rate_limited_response(retry_after)
+
+    session = resolve_session(session_token, dsn)
+    identity = session['user_id'] if session else SessionCache.key(session_token)
+    retry_after = rate_limiter.check(dsn, [('generate_user', str(identity))])
+    if retry_after:
+        return rate_limited_response(retry_after)
+
+    body_data = json_loads(event.get('body'))
+    if params.get('mode') == 'async' or body_data.get('async'):
+        return enqueue_job(body_data, session_token, dsn)
+    return generate_now(body_data, session_token, dsn)
+
+def generate_now(body_data: Dict[str, Any], session_token: str, dsn: str) -> Dict[str, Any]:
     prompt = body_data.get('prompt', '')
     size = body_data.get('size', '1024x1024')
     model = body_data.get('model', 'dall-e-3')
-    
+
     if not prompt:
+        return json_response(400, {'error': 'Prompt is required'})
+
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
+    reservation = reserve_for_session(cur, session_token)
+
+    if not reservation:
+        conn.rollback()
+        denied = reservation_denied(cur, session_token)
         cur.close()
-        conn.close()
-        return {
-            'statusCode': 400,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Prompt is required'})
-        }
-    
-    openai_headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
-    
-    payload = {
-        'model': model,
+        db_pool.putconn(conn)
+        return denied
+
+    conn.commit()
+    cur.close()
+    db_pool.putconn(conn)
+
+    user_id, free_used, free_limit, sub_status, credits, is_admin = reservation
+    charge = charge_kind(sub_status, is_admin)
+
+    try:
+        (image_url, storage_key), cached = generate_image(prompt, size, model, 'standard')
+    except Exception as e:
+        refund_after_failure(dsn, user_id, charge, e)
+        if isinstance(e, ImageApiError):
+            return json_response(e.status_code, {'error': str(e)})
+        return json_response(502, {'error': 'Image generation failed'})
+
+    save_error = None
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(SAVE_IMAGE_SQL, (user_id, prompt, image_url, storage_key, body_data.get('theme'), model))
+        image = saved_image(cur.fetchone())
+        if cached and PROMPT_CACHE_FREE_HITS and charge != 'none':
+            refund_generation(cur, user_id, charge)
+            if charge == 'free':
+                free_used -= 1
+            else:
+                credits += 1
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        save_error = e
+    finally:
+        db_pool.putconn(conn)
+
+    if save_error is not None:
+        refund_after_failure(dsn, user_id, charge, save_error)
+        return json_response(500, {'error': 'Failed to save generated image'})
+
+    return json_response(200, {
+        'success': True,
+        'image_url': image_url,
+        'image': image,
         'prompt': prompt,
-        'n': 1,
-        'size': size,
-        'quality': 'standard'
-    }
-    
-    response = requests.post(
-        'https://api.openai.com/v1/images/generations',
-        headers=openai_headers,
-        json=payload,
-        timeout=60
-    )
-    
-    if response.status_code != 200:
-        error_data = response.json()
+        'model': model,
+        'cached': cached,
+        'remaining_free': max(0, free_limit - free_used) if sub_status == 'none' or sub_status is None else None,
+        'remaining_credits': credits if sub_status == 'active' else None,
+        'subscription_status': sub_status
+    })
+
+def refund_after_failure(dsn: str, user_id: int, charge: str, error: Exception) -> None:
+    '''Gives back a committed reservation when anything after it fails'''
+    print(json.dumps({'generation_failed': user_id, 'charge': charge, 'error': str(error)}))
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        refund_generation(cur, user_id, charge)
+        conn.commit()
         cur.close()
-        conn.close()
-        return {
-            'statusCode': response.status_code,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'error': error_data.get('error', {}).get('message', 'Failed to generate image')
-            })
+    finally:
+        db_pool.putconn(conn)
+
+def limit_exceeded_response(free_used: int, free_limit: int) -> Dict[str, Any]:
+    return json_response(403, {
+        'error': 'Free generations limit exceeded',
+        'code': 'LIMIT_EXCEEDED',
+        'free_used': free_used,
+        'free_limit': free_limit,
+        'message': 'You have used all 3 free generations. Please subscribe to continue.'
+    })
+
+def no_credits_response(credits: int) -> Dict[str, Any]:
+    return json_response(403, {
+        'error': 'No credits remaining',
+        'code': 'NO_CREDITS',
+        'credits': credits,
+        'message': 'You have no credits left. Please upgrade your plan.'
+    })
+
+def enqueue_job(body_data: Dict[str, Any], session_token: str, dsn: str) -> Dict[str, Any]:
+    prompt = body_data.get('prompt', '')
+    size = body_data.get('size', '1024x1024')
+    model = body_data.get('model', 'dall-e-3')
+    quality = body_data.get('quality', 'standard')
+
+    if not prompt:
+        return json_response(400, {'error': 'Prompt is required'})
+
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
+    reservation = reserve_for_session(cur, session_token)
+
+    if not reservation:
+        conn.rollback()
+        denied = reservation_denied(cur, session_token)
+        cur.close()
+        db_pool.putconn(conn)
+        return denied
+
+    user_id, free_used, free_limit, sub_status, credits, is_admin = reservation
+    charge = charge_kind(sub_status, is_admin)
+
+    cur.execute(
+        """
+        INSERT INTO generation_jobs (user_id, prompt, size, model, quality, charge, theme)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        RETURNING id, created_at
+        """,
+        (user_id, prompt, size, model, quality, charge, body_data.get('theme'))
+    )
+    job_id, created_at = cur.fetchone()
+    conn.commit()
+    cur.close()
+    db_pool.putconn(conn)
+
+    return json_response(202, {
+        'success': True,
+        'job_id': job_id,
+        'status': 'queued',
+        'created_at': created_at.isoformat() if created_at else None
+    })
+
+def get_job(job_id: str | None, session_token: str, dsn: str) -> Dict[str, Any]:
+    if not job_id or not job_id.isdigit():
+        return json_response(400, {'error': 'job_id is required'})
+
+    session = resolve_session(session_token, dsn)
+
+    if not session or time.time() > session['expires_at']:
+        return json_response(401, {'error': 'Invalid or expired session', 'code': 'AUTH_REQUIRED'})
+
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
+
+    cur.execute(
+        """
+        SELECT id, status, prompt, size, model, image_url, error, created_at, finished_at, image_id
+        FROM generation_jobs
+        WHERE id = %s AND user_id = %s
+        """,
+        (int(job_id), session['user_id'])
+    )
+    job = cur.fetchone()
+    cur.close()
+    db_pool.putconn(conn)
+
+    if not job:
+        return json_response(404, {'error': 'Job not found'})
+
+    return json_response(200, {
+        'success': True,
+        'job': {
+            'id': job[0],
+            'status': job[1],
+            'prompt': job[2],
+            'size': job[3],
+            'model': job[4],
+            'image_url': job[5],
+            'error': job[6],
+            'created_at': job[7].isoformat() if job[7] else None,
+            'finished_at': job[8].isoformat() if job[8] else None,
+            'image_id': job[9]
         }
-    
-    result = response.json()
-    image_url = result.get('data', [{}])[0].get('url', '')
-    
-    if not is_admin:
-        if sub_status == 'none' or sub_status is None:
+    })
+
+def run_worker(dsn: str) -> Dict[str, Any]:
+    '''
+    Drains queued jobs with at most JOB_WORKER_CONCURRENCY upstream calls in
+    flight. A slot is refilled as soon as its job finishes, and only while at
+    least JOB_MIN_CALL_TIME of the budget is left; each upstream call is cut
+    off at the deadline, so the run ends within JOB_WORKER_BUDGET. Meant for
+    a timer trigger.
+    '''
+    deadline = time.monotonic() + JOB_WORKER_BUDGET
+    counts = {'succeeded': 0, 'failed': 0, 'requeued': 0, 'stalled': 0, 'recovered': recover_stale_jobs(dsn)}
+
+    with ThreadPoolExecutor(max_workers=JOB_WORKER_CONCURRENCY) as executor:
+        running: set = set()
+        claiming = True
+        while True:
+            free = JOB_WORKER_CONCURRENCY - len(running)
+            if claiming and free and deadline - time.monotonic() >= JOB_MIN_CALL_TIME:
+                try:
+                    jobs = claim_jobs(dsn, free)
+                except Exception as e:
+                    print(json.dumps({'job_claim_failed': str(e)}))
+                    jobs, claiming = [], False
+                if not jobs and not running:
+                    break
+                running.update(executor.submit(process_job, dsn, job, deadline) for job in jobs)
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                counts[future.result()] += 1
+
+    if blob_uploader:
+        blob_uploader.wait(deadline - time.monotonic())
+
+    return json_response(200, {'success': True, 'jobs': counts})
+
+def claim_jobs(dsn: str, limit: int) -> List[Tuple[Any, ...]]:
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE generation_jobs
+            SET status = 'running', started_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM generation_jobs
+                WHERE status = 'queued' AND available_at <= CURRENT_TIMESTAMP
+                ORDER BY available_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, prompt, size, model, quality, charge, attempts, theme
+            """,
+            (limit,)
+        )
+        jobs = cur.fetchall()
+        conn.commit()
+        cur.close()
+        return jobs
+    finally:
+        db_pool.putconn(conn)
+
+def retry_delay(attempts: int, error: ImageApiError) -> float:
+    '''Exponential backoff from JOB_RETRY_DELAY, never shorter than an upstream Retry-After'''
+    delay = min(JOB_RETRY_DELAY * 2 ** max(attempts - 1, 0), JOB_RETRY_MAX_DELAY)
+    return max(delay, min(error.retry_after or 0.0, JOB_RETRY_MAX_DELAY))
+
+def process_job(dsn: str, job: Tuple[Any, ...], deadline: float) -> str:
+    job_id, user_id, prompt, size, model, quality, charge, attempts, theme = job
+
+    try:
+        timeout = min(IMAGE_API_TIMEOUT, max(deadline - time.monotonic(), 1.0))
+        (image_url, storage_key), cached = generate_image(prompt, size, model, quality, timeout)
+        error = None
+    except ImageApiError as e:
+        image_url, storage_key, cached = None, None, False
+        error = e
+    except Exception as e:
+        print(json.dumps({'job_generation_failed': job_id, 'error': str(e)}))
+        image_url, storage_key, cached = None, None, False
+        error = ImageApiError(502, 'Image generation failed', True)
+
+    conn = None
+    try:
+        conn = db_pool.getconn(dsn)
+        cur = conn.cursor()
+        if error is None:
+            cur.execute(SAVE_IMAGE_SQL, (user_id, prompt, image_url, storage_key, theme, model))
+            image_id = cur.fetchone()[0]
+            cur.execute(
+                """
+                UPDATE generation_jobs
+                SET status = 'succeeded', image_url = %s, image_id = %s, error = NULL, finished_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                """,
+                (image_url, image_id, job_id)
+            )
+            if cached and PROMPT_CACHE_FREE_HITS:
+                refund_generation(cur, user_id, charge)
+            outcome = 'succeeded'
+        elif error.retryable and attempts < JOB_MAX_ATTEMPTS:
             cur.execute(
-                "UPDATE users SET free_generations_used = free_generations_used + 1 WHERE id = %s",
-                (user_id,)
+                """
+                UPDATE generation_jobs
+                SET status = 'queued', error = %s, available_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id = %s
+                """,
+                (str(error), retry_delay(attempts, error), job_id)
             )
-            new_used = free_used + 1
+            outcome = 'requeued'
         else:
             cur.execute(
-                "UPDATE users SET credits = credits - 1 WHERE id = %s",
-                (user_id,)
+                """
+                UPDATE generation_jobs
+                SET status = 'failed', error = %s, finished_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                """,
+                (str(error), job_id)
             )
-            new_used = free_used
-    else:
-        new_used = free_used
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'image_url': image_url,
-            'prompt': prompt,
-            'model': model,
-            'remaining_free': max(0, free_limit - new_used) if sub_status == 'none' or sub_status is None else None,
-            'remaining_credits': credits - 1 if sub_status == 'active' else None,
-            'subscription_status': sub_status
-        })
-    }
\ No newline at end of file
+            refund_generation(cur, user_id, charge)
+            outcome = 'failed'
+        conn.commit()
+        cur.close()
+        return outcome
+    except Exception as e:
+        # The job stays running; recover_stale_jobs requeues or refunds it later
+        print(json.dumps({'job_update_failed': job_id, 'error': str(e)}))
+        return 'stalled'
+    finally:
+        if conn is not None:
+            db_pool.putconn(conn)
+
+def recover_stale_jobs(dsn: str) -> int:
+    '''Puts back jobs whose worker died mid-call; jobs out of attempts fail and are refunded'''
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, user_id, charge, attempts FROM generation_jobs
+            WHERE status = 'running' AND started_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+            FOR UPDATE SKIP LOCKED
+            """,
+            (JOB_STALE_AFTER,)
+        )
+        stale = cur.fetchall()
+        for job_id, user_id, charge, attempts in stale:
+            if attempts < JOB_MAX_ATTEMPTS:
+                cur.execute("UPDATE generation_jobs SET status = 'queued' WHERE id = %s", (job_id,))
+            else:
+                cur.execute(
+                    """
+                    UPDATE generation_jobs
+                    SET status = 'failed', error = 'Worker timed out', finished_at = CURRENT_TIMESTAMP
+                    WHERE id = %s
+                    """,
+                    (job_id,)
+                )
+                refund_generation(cur, user_id, charge)
+        conn.commit()
+        cur.close()
+        return len(stale)
+    finally:
+        db_pool.putconn(conn)
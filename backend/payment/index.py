@@ -1,17 +1,64 @@
 """
 Business: PayPal payment processing for subscriptions
-Args: event with action=create-order, capture-order, or webhook
+Args: event with action=create-order, capture-order, webhook or webhook-drain
 Returns: HTTP response with order details or payment confirmation
 """
 
 import json
 import os
-from typing import Dict, Any
-import requests
-import psycopg2
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, List, Tuple
 from datetime import datetime, timedelta
 
-PAYPAL_API_BASE = 'https://api-m.sandbox.paypal.com'
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+CORS_MAX_AGE = os.environ.get('CORS_MAX_AGE', '86400')
+ALLOWED_METHODS = ('GET', 'POST', 'OPTIONS')
+PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': ', '.join(ALLOWED_METHODS),
+    'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, Idempotency-Key',
+    'Access-Control-Max-Age': CORS_MAX_AGE
+}
+
+def json_dumps(payload: Any, default: Callable[[Any], Any] | None = None) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload, default=default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(payload, default=default)
+
+def json_loads(raw: str | bytes | None) -> Any:
+    if not raw:
+        return {}
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_response(status_code: int, payload: Any, headers: Dict[str, str] | None = None,
+                  default: Callable[[Any], Any] | None = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, **headers} if headers else dict(JSON_HEADERS),
+        'isBase64Encoded': False,
+        'body': json_dumps(payload, default)
+    }
+
+def request_header(event: Dict[str, Any], name: str) -> str | None:
+    headers = event.get('headers') or {}
+    return headers.get(name) or headers.get(name.lower())
+
+PAYPAL_API_BASE = os.environ.get('PAYPAL_API_BASE', 'https://api-m.sandbox.paypal.com')
+PAYPAL_CONNECT_TIMEOUT = float(os.environ.get('PAYPAL_CONNECT_TIMEOUT', '5'))
+PAYPAL_READ_TIMEOUT = float(os.environ.get('PAYPAL_READ_TIMEOUT', '30'))
+PAYPAL_TOKEN_MARGIN = float(os.environ.get('PAYPAL_TOKEN_MARGIN', '300'))
+WEBHOOK_APPLY_MODE = os.environ.get('WEBHOOK_APPLY_MODE', 'inline')
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '200'))
 
 PLANS = {
     'starter': {'price': '5.00', 'credits': 50, 'name': 'Стартовый'},
@@ -19,118 +66,456 @@ PLANS = {
     'premium': {'price': '15.00', 'credits': 200, 'name': 'Премиум'}
 }
 
-def get_paypal_access_token() -> str:
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '300'))
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', '30'))
+DB_POOL_LOG_EVERY = int(os.environ.get('DB_POOL_LOG_EVERY', '100'))
+
+class ConnectionPool:
+    '''
+    Per-process pool of warm connections kept at module scope, so a reused
+    container skips the TCP/TLS handshake and backend fork on every request.
+    Idle connections are health-checked and recycled by idle time and age.
+    '''
+
+    def __init__(self, connect: Callable[[str], Any], max_size: int):
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[Any, float]] = []
+        self._born: Dict[int, float] = {}
+        self._local = threading.local()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'waits': 0, 'recycled': 0, 'leaked': 0}
+
+    def getconn(self, dsn: str) -> Any:
+        if not self._slots.acquire(blocking=False):
+            self._count('waits')
+            if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+                raise RuntimeError('Database connection pool exhausted')
+        try:
+            conn = self._take_idle()
+            if conn is None:
+                conn = self._connect(dsn)
+                with self._lock:
+                    self._born[id(conn)] = time.monotonic()
+                self._count('misses')
+            else:
+                self._count('hits')
+        except Exception:
+            self._slots.release()
+            raise
+        self._checked_out().append(conn)
+        return conn
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        checked_out = self._checked_out()
+        if conn not in checked_out:
+            return
+        checked_out.remove(conn)
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def reclaim(self) -> None:
+        for conn in list(self._checked_out()):
+            self._count('leaked')
+            self.putconn(conn, discard=True)
+
+    def scoped(self, func: Callable[..., Dict[str, Any]]) -> Callable[..., Dict[str, Any]]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Dict[str, Any]:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.reclaim()
+        return wrapper
+
+    def _take_idle(self) -> Any:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                conn, released_at = self._idle.pop()
+                born = self._born.get(id(conn), 0.0)
+            now = time.monotonic()
+            if conn.closed or now - released_at > DB_POOL_MAX_IDLE or now - born > DB_POOL_MAX_LIFETIME:
+                self._count('recycled')
+                self._close(conn)
+                continue
+            if now - released_at > DB_POOL_CHECK_AFTER and not self._is_alive(conn):
+                self._count('recycled')
+                self._close(conn)
+                continue
+            return conn
+
+    def _is_alive(self, conn: Any) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _close(self, conn: Any) -> None:
+        with self._lock:
+            self._born.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _checked_out(self) -> List[Any]:
+        if not hasattr(self._local, 'conns'):
+            self._local.conns = []
+        return self._local.conns
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.stats[key] += 1
+            checkouts = self.stats['hits'] + self.stats['misses']
+            snapshot = dict(self.stats) if key in ('hits', 'misses') and checkouts % DB_POOL_LOG_EVERY == 0 else None
+        if snapshot:
+            print(json.dumps({'db_pool': snapshot}))
+
+def connect_db(dsn: str) -> Any:
+    import psycopg2
+    return psycopg2.connect(dsn)
+
+db_pool = ConnectionPool(connect_db, DB_POOL_MAX_SIZE)
+
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '1024'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '30'))
+SESSION_CACHE_LOG_EVERY = int(os.environ.get('SESSION_CACHE_LOG_EVERY', '500'))
+
+class SessionCache:
+    '''
+    Bounded LRU of resolved sessions keyed by a SHA-256 of the token. Entries
+    live for SESSION_CACHE_TTL seconds or until the session expires, whichever
+    comes first, and are dropped explicitly on logout or account changes.
+    '''
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, Tuple[float, Dict[str, Any]]] = OrderedDict()
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def key(session_token: str) -> str:
+        return hashlib.sha256(session_token.encode('utf-8')).hexdigest()
+
+    def get(self, session_token: str) -> Dict[str, Any] | None:
+        key = self.key(session_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                session = entry[1]
+                self._count('hits')
+            else:
+                if entry:
+                    del self._entries[key]
+                session = None
+                self._count('misses')
+        return session
+
+    def put(self, session_token: str, session: Dict[str, Any]) -> None:
+        ttl = min(self._ttl, session['expires_at'] - time.time())
+        if ttl <= 0:
+            return
+        key = self.key(session_token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, session)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, session_token: str) -> None:
+        with self._lock:
+            if self._entries.pop(self.key(session_token), None):
+                self.stats['invalidations'] += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            stale = [key for key, (_, session) in self._entries.items() if session['user_id'] == user_id]
+            for key in stale:
+                del self._entries[key]
+            self.stats['invalidations'] += len(stale)
+
+    def _count(self, key: str) -> None:
+        self.stats[key] += 1
+        if (self.stats['hits'] + self.stats['misses']) % SESSION_CACHE_LOG_EVERY == 0:
+            print(json.dumps({'session_cache': self.stats}))
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+def resolve_session(session_token: str, dsn: str, fresh: bool = False) -> Dict[str, Any] | None:
+    '''
+    Returns the session with its user, from the cache when warm; expired
+    sessions are returned too. Logout and password resets only clear the
+    cache of the auth function, so here a revoked token stays valid for up
+    to SESSION_CACHE_TTL seconds; fresh=True reads user_sessions instead and
+    is used wherever the request spends or grants something.
+    '''
+    session = None if fresh else session_cache.get(session_token)
+    if session:
+        return session
+
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT s.user_id, EXTRACT(EPOCH FROM s.expires_at), u.email, u.username, u.full_name,
+                   u.credits, u.plan, u.avatar_url, u.is_admin, s.id
+            FROM user_sessions s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.session_token = %s
+            """,
+            (session_token,)
+        )
+        row = cur.fetchone()
+        cur.close()
+    finally:
+        db_pool.putconn(conn)
+
+    if not row:
+        return None
+
+    session = {
+        'user_id': row[0],
+        'expires_at': float(row[1]),
+        'email': row[2],
+        'username': row[3],
+        'full_name': row[4],
+        'credits': row[5],
+        'plan': row[6],
+        'avatar_url': row[7],
+        'is_admin': bool(row[8]),
+        'session_id': row[9]
+    }
+    session_cache.put(session_token, session)
+    return session
+
+_paypal_http = None
+_paypal_http_lock = threading.Lock()
+
+def paypal_http() -> Any:
+    '''Keep-alive session for PayPal, created on first use so requests is only imported by invocations that call out'''
+    global _paypal_http
+    if _paypal_http is None:
+        with _paypal_http_lock:
+            if _paypal_http is None:
+                import requests
+                _paypal_http = requests.Session()
+    return _paypal_http
+
+class PayPalTokenCache:
+    '''
+    Keeps the OAuth token until expires_in minus PAYPAL_TOKEN_MARGIN seconds.
+    Refreshes are single-flight: concurrent callers wait for the one request
+    in flight instead of each fetching a token.
+    '''
+
+    def __init__(self, margin: float):
+        self._margin = margin
+        self._lock = threading.Lock()
+        self._token: str | None = None
+        self._expires_at = 0.0
+
+    def get(self) -> str:
+        token, expires_at = self._token, self._expires_at
+        if token and time.monotonic() < expires_at:
+            return token
+        with self._lock:
+            if self._token and time.monotonic() < self._expires_at:
+                return self._token
+            token, expires_in = fetch_paypal_access_token()
+            self._token = token
+            self._expires_at = time.monotonic() + max(0.0, expires_in - self._margin)
+            return token
+
+    def invalidate(self, token: str) -> None:
+        with self._lock:
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0.0
+
+paypal_tokens = PayPalTokenCache(PAYPAL_TOKEN_MARGIN)
+
+def fetch_paypal_access_token() -> Tuple[str, float]:
     client_id = os.environ.get('PAYPAL_CLIENT_ID')
     client_secret = os.environ.get('PAYPAL_CLIENT_SECRET')
     
     if not client_id or not client_secret:
         raise Exception('PayPal credentials not configured')
     
-    response = requests.post(
+    response = paypal_http().post(
         f'{PAYPAL_API_BASE}/v1/oauth2/token',
         headers={'Accept': 'application/json'},
         auth=(client_id, client_secret),
-        data={'grant_type': 'client_credentials'}
+        data={'grant_type': 'client_credentials'},
+        timeout=(PAYPAL_CONNECT_TIMEOUT, PAYPAL_READ_TIMEOUT)
     )
     
     if response.status_code != 200:
         raise Exception('Failed to get PayPal access token')
     
-    return response.json()['access_token']
+    token_data = response.json()
+    return token_data['access_token'], float(token_data.get('expires_in', 0))
+
+def get_paypal_access_token() -> str:
+    return paypal_tokens.get()
+
+def paypal_request(method: str, path: str, **kwargs: Any) -> Any:
+    '''Calls the PayPal REST API over the shared keep-alive session, retrying once if the cached token was revoked'''
+    for attempt in range(2):
+        access_token = get_paypal_access_token()
+        response = paypal_http().request(
+            method,
+            f'{PAYPAL_API_BASE}{path}',
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {access_token}'
+            },
+            timeout=(PAYPAL_CONNECT_TIMEOUT, PAYPAL_READ_TIMEOUT),
+            **kwargs
+        )
+        if response.status_code != 401 or attempt:
+            return response
+        paypal_tokens.invalidate(access_token)
+    return response
 
+@db_pool.scoped
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'POST')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return {'statusCode': 200, 'headers': PREFLIGHT_HEADERS, 'body': ''}
     
     path_params = event.get('pathParams', {})
     action = path_params.get('action', event.get('queryStringParameters', {}).get('action', 'create-order'))
     
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
+        return json_response(500, {'error': 'Database not configured'})
+    
+    idempotency_key = request_header(event, 'Idempotency-Key')
     
     if action == 'create-order':
+        if idempotency_key:
+            return run_idempotent(event, dsn, action, idempotency_key, create_order)
         return create_order(event, dsn)
     elif action == 'capture-order':
+        if idempotency_key:
+            return run_idempotent(event, dsn, action, idempotency_key, capture_order)
         return capture_order(event, dsn)
     elif action == 'webhook':
         return handle_webhook(event, dsn)
+    elif action == 'webhook-drain':
+        worker_key = os.environ.get('JOB_WORKER_KEY')
+        if not worker_key or request_header(event, 'X-Worker-Key') != worker_key:
+            return json_response(403, {'error': 'Forbidden'})
+        return drain_webhook_events(dsn)
     else:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid action'})
-        }
+        return json_response(400, {'error': 'Invalid action'})
+
+def run_idempotent(event: Dict[str, Any], dsn: str, action: str, idempotency_key: str,
+                   work: Callable[[Dict[str, Any], str], Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Runs work at most once per Idempotency-Key and replays the stored response
+    afterwards. Concurrent duplicates block on the key row until the first
+    request commits, then read its result without calling PayPal again.
+    '''
+    session_token = request_header(event, 'X-Session-Token') or ''
+    scope = f'{action}:{SessionCache.key(session_token)}' if session_token else action
+    request_hash = hashlib.sha256((event.get('body') or '').encode('utf-8')).hexdigest()
+    
+    if len(idempotency_key) > 255:
+        return json_response(400, {'error': 'Idempotency-Key is too long'})
+    
+    conn = db_pool.getconn(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO idempotency_keys (scope, idempotency_key, request_hash)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (scope, idempotency_key) DO NOTHING
+            """,
+            (scope, idempotency_key, request_hash)
+        )
+        cur.execute(
+            """
+            SELECT request_hash, response
+            FROM idempotency_keys
+            WHERE scope = %s AND idempotency_key = %s
+            FOR UPDATE
+            """,
+            (scope, idempotency_key)
+        )
+        stored_hash, stored_response = cur.fetchone()
+        
+        if stored_hash != request_hash:
+            conn.rollback()
+            return json_response(422, {'error': 'Idempotency-Key was already used with a different request'})
+        
+        if stored_response is not None:
+            conn.commit()
+            stored_response['headers']['Idempotent-Replayed'] = 'true'
+            return stored_response
+        
+        response = work(event, dsn)
+        
+        if response['statusCode'] < 500:
+            cur.execute(
+                """
+                UPDATE idempotency_keys SET response = %s, completed_at = CURRENT_TIMESTAMP
+                WHERE scope = %s AND idempotency_key = %s
+                """,
+                (json.dumps(response), scope, idempotency_key)
+            )
+            conn.commit()
+        else:
+            conn.rollback()
+        cur.close()
+        return response
+    finally:
+        db_pool.putconn(conn)
 
 def create_order(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    headers = event.get('headers', {})
-    session_token = headers.get('X-Session-Token') or headers.get('x-session-token')
+    session_token = request_header(event, 'X-Session-Token')
     
     if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'})
-        }
+        return json_response(401, {'error': 'Session token required'})
     
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json_loads(event.get('body'))
     plan_id = body_data.get('plan', 'starter')
     
     if plan_id not in PLANS:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid plan'})
-        }
+        return json_response(400, {'error': 'Invalid plan'})
     
-    conn = psycopg2.connect(dsn)
-    cur = conn.cursor()
-    
-    cur.execute(
-        """
-        SELECT u.id, u.email, u.username
-        FROM user_sessions s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP
-        """,
-        (session_token,)
-    )
-    user_data = cur.fetchone()
+    session = resolve_session(session_token, dsn, fresh=True)
     
-    if not user_data:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid session'})
-        }
+    if not session or time.time() > session['expires_at']:
+        return json_response(401, {'error': 'Invalid session'})
     
-    user_id, user_email, username = user_data
+    user_id = session['user_id']
     plan = PLANS[plan_id]
     
-    access_token = get_paypal_access_token()
-    
-    paypal_headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
-    
     order_payload = {
         'intent': 'CAPTURE',
         'purchase_units': [{
@@ -149,24 +534,17 @@ def create_order(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
         }
     }
     
-    response = requests.post(
-        f'{PAYPAL_API_BASE}/v2/checkout/orders',
-        headers=paypal_headers,
-        json=order_payload
-    )
+    response = paypal_request('POST', '/v2/checkout/orders', json=order_payload)
     
     if response.status_code != 201:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Failed to create PayPal order'})
-        }
+        return json_response(response.status_code, {'error': 'Failed to create PayPal order'})
     
     order_data = response.json()
     order_id = order_data['id']
     
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
+    
     cur.execute(
         """
         INSERT INTO transactions (user_id, amount, currency, status, payment_method, paypal_order_id, plan, metadata)
@@ -176,118 +554,209 @@ def create_order(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
     )
     conn.commit()
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
     approve_link = next((link['href'] for link in order_data.get('links', []) if link['rel'] == 'approve'), None)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'order_id': order_id,
-            'approve_link': approve_link,
-            'plan': plan_id,
-            'amount': plan['price']
-        })
-    }
+    return json_response(200, {
+        'success': True,
+        'order_id': order_id,
+        'approve_link': approve_link,
+        'plan': plan_id,
+        'amount': plan['price']
+    })
 
 def capture_order(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    body_data = json.loads(event.get('body', '{}'))
+    body_data = json_loads(event.get('body'))
     order_id = body_data.get('order_id')
     
     if not order_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Order ID required'})
-        }
-    
-    access_token = get_paypal_access_token()
-    
-    paypal_headers = {
-        'Content-Type': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
+        return json_response(400, {'error': 'Order ID required'})
     
-    response = requests.post(
-        f'{PAYPAL_API_BASE}/v2/checkout/orders/{order_id}/capture',
-        headers=paypal_headers
-    )
-    
-    if response.status_code != 201:
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Failed to capture payment'})
-        }
-    
-    capture_data = response.json()
-    
-    conn = psycopg2.connect(dsn)
+    conn = db_pool.getconn(dsn)
     cur = conn.cursor()
     
     cur.execute(
-        "SELECT user_id, plan, metadata FROM transactions WHERE paypal_order_id = %s",
+        "SELECT user_id, (metadata->>'credits')::int, status FROM transactions WHERE paypal_order_id = %s",
         (order_id,)
     )
     transaction = cur.fetchone()
     
+    cur.close()
+    db_pool.putconn(conn)
+    
     if not transaction:
-        cur.close()
-        conn.close()
-        return {
-            'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Transaction not found'})
-        }
+        return json_response(404, {'error': 'Transaction not found'})
+    
+    user_id, credits, status = transaction
+    
+    if status == 'completed':
+        return json_response(200, {
+            'success': True,
+            'order_id': order_id,
+            'status': 'completed',
+            'credits_added': credits or 0
+        })
+    
+    response = paypal_request('POST', f'/v2/checkout/orders/{order_id}/capture')
     
-    user_id, plan_id, metadata = transaction
-    credits = json.loads(metadata).get('credits', 0)
+    if response.status_code != 201:
+        return json_response(response.status_code, {'error': 'Failed to capture payment'})
+    
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
     
+    fulfil_orders(cur, [order_id])
+    conn.commit()
+    session_cache.invalidate_user(user_id)
+    cur.close()
+    db_pool.putconn(conn)
+    
+    return json_response(200, {
+        'success': True,
+        'order_id': order_id,
+        'status': 'completed',
+        'credits_added': credits or 0
+    })
+
+def fulfil_orders(cur: Any, order_ids: List[str]) -> List[Tuple[int, int]]:
+    '''
+    Completes pending transactions and credits their users in one statement.
+    Orders that are already completed are skipped, so replays from the
+    webhook and the browser capture never credit twice.
+    '''
     cur.execute(
         """
-        UPDATE transactions 
-        SET status = 'completed', completed_at = CURRENT_TIMESTAMP 
-        WHERE paypal_order_id = %s
+        WITH completed AS (
+            UPDATE transactions
+            SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+            WHERE paypal_order_id = ANY(%s) AND status <> 'completed'
+            RETURNING user_id, plan, created_at, COALESCE((metadata->>'credits')::int, 0) AS credits
+        ), per_user AS (
+            SELECT user_id, SUM(credits) AS credits, (array_agg(plan ORDER BY created_at DESC))[1] AS plan
+            FROM completed
+            GROUP BY user_id
+        )
+        UPDATE users u
+        SET credits = u.credits + p.credits,
+            plan = p.plan,
+            subscription_status = 'active',
+            subscription_expires_at = %s
+        FROM per_user p
+        WHERE u.id = p.user_id
+        RETURNING u.id, p.credits
         """,
-        (order_id,)
+        (order_ids, datetime.utcnow() + timedelta(days=30))
     )
+    return cur.fetchall()
+
+def verify_webhook_signature(event: Dict[str, Any], webhook_event: Dict[str, Any]) -> bool:
+    webhook_id = os.environ.get('PAYPAL_WEBHOOK_ID')
+    if not webhook_id:
+        return False
+    
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    response = paypal_request('POST', '/v1/notifications/verify-webhook-signature', json={
+        'auth_algo': headers.get('paypal-auth-algo'),
+        'cert_url': headers.get('paypal-cert-url'),
+        'transmission_id': headers.get('paypal-transmission-id'),
+        'transmission_sig': headers.get('paypal-transmission-sig'),
+        'transmission_time': headers.get('paypal-transmission-time'),
+        'webhook_id': webhook_id,
+        'webhook_event': webhook_event
+    })
+    return response.status_code == 200 and response.json().get('verification_status') == 'SUCCESS'
+
+def capture_order_id(resource: Dict[str, Any]) -> str | None:
+    return ((resource.get('supplementary_data') or {}).get('related_ids') or {}).get('order_id')
+
+def handle_webhook(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
+    try:
+        webhook_event = json_loads(event.get('body'))
+    except ValueError:
+        return json_response(400, {'error': 'Invalid webhook event'})
+    if not isinstance(webhook_event, dict):
+        return json_response(400, {'error': 'Invalid webhook event'})
+    
+    event_id = webhook_event.get('id')
+    event_type = webhook_event.get('event_type', '')
+    resource = webhook_event.get('resource') or {}
     
-    expires_at = datetime.utcnow() + timedelta(days=30)
+    if not event_id or not verify_webhook_signature(event, webhook_event):
+        return json_response(400, {'error': 'Invalid webhook event'})
+    
+    conn = db_pool.getconn(dsn)
+    cur = conn.cursor()
     
     cur.execute(
         """
-        UPDATE users 
-        SET credits = credits + %s,
-            plan = %s,
-            subscription_status = 'active',
-            subscription_expires_at = %s
-        WHERE id = %s
+        INSERT INTO paypal_webhook_events (event_id, event_type, resource)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (event_id) DO NOTHING
+        RETURNING event_id
         """,
-        (credits, plan_id, expires_at, user_id)
+        (event_id, event_type, json_dumps(resource))
     )
+    is_new = cur.fetchone() is not None
     
+    if is_new and WEBHOOK_APPLY_MODE == 'inline':
+        apply_webhook_events(cur, [(event_id, event_type, resource)])
     conn.commit()
+    
     cur.close()
-    conn.close()
+    db_pool.putconn(conn)
     
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'isBase64Encoded': False,
-        'body': json.dumps({
-            'success': True,
-            'order_id': order_id,
-            'status': 'completed',
-            'credits_added': credits
-        })
-    }
+    return json_response(200, {'received': True, 'duplicate': not is_new})
 
-def handle_webhook(event: Dict[str, Any], dsn: str) -> Dict[str, Any]:
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'received': True})
-    }
+def apply_webhook_events(cur: Any, events: List[Tuple[str, str, Dict[str, Any]]]) -> int:
+    '''Applies stored events inside the caller's transaction; returns how many orders were fulfilled'''
+    order_ids = [
+        capture_order_id(resource) for _, event_type, resource in events
+        if event_type == 'PAYMENT.CAPTURE.COMPLETED' and capture_order_id(resource)
+    ]
+    credited = fulfil_orders(cur, order_ids) if order_ids else []
+    
+    cur.execute(
+        """
+        UPDATE paypal_webhook_events
+        SET status = CASE WHEN event_type = 'PAYMENT.CAPTURE.COMPLETED' THEN 'applied' ELSE 'ignored' END,
+            applied_at = CURRENT_TIMESTAMP
+        WHERE event_id = ANY(%s)
+        """,
+        ([event_id for event_id, _, _ in events],)
+    )
+    for user_id, _ in credited:
+        session_cache.invalidate_user(user_id)
+    return len(order_ids)
+
+def drain_webhook_events(dsn: str) -> Dict[str, Any]:
+    '''Applies queued events in batches of WEBHOOK_BATCH_SIZE, one transaction per batch'''
+    events_applied = 0
+    orders_fulfilled = 0
+    
+    while True:
+        conn = db_pool.getconn(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT event_id, event_type, resource FROM paypal_webhook_events
+                WHERE status = 'pending'
+                ORDER BY received_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+                """,
+                (WEBHOOK_BATCH_SIZE,)
+            )
+            batch = cur.fetchall()
+            if batch:
+                orders_fulfilled += apply_webhook_events(cur, batch)
+                events_applied += len(batch)
+            conn.commit()
+            cur.close()
+        finally:
+            db_pool.putconn(conn)
+        if len(batch) < WEBHOOK_BATCH_SIZE:
+            break
+    
+    return json_response(200, {'success': True, 'events': events_applied, 'orders_fulfilled': orders_fulfilled})
@@ -0,0 +1,22 @@
+-- Очередь асинхронных генераций изображений
+CREATE TABLE IF NOT EXISTS generation_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    status TEXT NOT NULL DEFAULT 'queued',
+    prompt TEXT NOT NULL,
+    size VARCHAR(20) DEFAULT '1024x1024',
+    model VARCHAR(50) DEFAULT 'dall-e-3',
+    quality VARCHAR(20) DEFAULT 'standard',
+    charge TEXT NOT NULL DEFAULT 'none',
+    image_url TEXT,
+    error TEXT,
+    attempts INTEGER DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Индексы для выборки очереди воркером и опроса статуса
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_queued ON generation_jobs(created_at) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_running ON generation_jobs(started_at) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_user_id ON generation_jobs(user_id);
@@ -0,0 +1,6 @@
+-- Составные частичные индексы для keyset-пагинации по (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_generated_images_active_created
+ON generated_images(created_at DESC, id DESC) WHERE is_archived = FALSE;
+
+CREATE INDEX IF NOT EXISTS idx_generated_images_user_active_created
+ON generated_images(user_id, created_at DESC, id DESC) WHERE is_archived = FALSE;
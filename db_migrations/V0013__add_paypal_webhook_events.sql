@@ -0,0 +1,13 @@
+-- Журнал входящих вебхуков PayPal; event_id защищает от повторной обработки
+CREATE TABLE IF NOT EXISTS paypal_webhook_events (
+    event_id TEXT PRIMARY KEY,
+    event_type TEXT NOT NULL,
+    resource JSONB,
+    status TEXT NOT NULL DEFAULT 'pending',
+    received_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Индекс для выборки необработанных событий пачками
+CREATE INDEX IF NOT EXISTS idx_paypal_webhook_events_pending
+ON paypal_webhook_events(received_at) WHERE status = 'pending';
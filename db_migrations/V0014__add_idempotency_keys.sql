@@ -0,0 +1,12 @@
+-- Ключи идемпотентности для платёжных запросов с сохранённым ответом
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,
+    idempotency_key VARCHAR(255) NOT NULL,
+    request_hash TEXT NOT NULL,
+    response JSONB,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (scope, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at);
@@ -0,0 +1,150 @@
+-- Инкрементальные счётчики статистики админ-панели.
+-- Каждый счётчик разбит на шарды по pg_backend_pid(), чтобы параллельные
+-- вставки не упирались в блокировку одной строки; итог = SUM(value).
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT NOT NULL,
+    shard SMALLINT NOT NULL DEFAULT 0,
+    value NUMERIC NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (name, shard)
+);
+
+-- Дневные срезы: signups, generations, revenue
+CREATE TABLE IF NOT EXISTS stats_daily (
+    metric TEXT NOT NULL,
+    day DATE NOT NULL,
+    value NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, day)
+);
+
+-- Индекс для пересчёта активных пользователей за 7 дней
+CREATE INDEX IF NOT EXISTS idx_user_sessions_last_activity ON user_sessions(last_activity);
+
+CREATE OR REPLACE FUNCTION stats_bump(counter TEXT, delta NUMERIC) RETURNS void AS $$
+BEGIN
+    IF delta IS NULL OR delta = 0 THEN
+        RETURN;
+    END IF;
+    INSERT INTO stats_counters (name, shard, value, updated_at)
+    VALUES (counter, pg_backend_pid() % 8, delta, CURRENT_TIMESTAMP)
+    ON CONFLICT (name, shard) DO UPDATE
+    SET value = stats_counters.value + EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггеры уровня оператора с таблицами переходов: массовые операции
+-- обновляют счётчики одним агрегатом, а не построчно
+CREATE OR REPLACE FUNCTION stats_users_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stats_bump('total_users', (SELECT COUNT(*) FROM new_rows));
+        PERFORM stats_bump('total_credits', (SELECT SUM(credits) FROM new_rows WHERE plan <> 'unlimited'));
+        INSERT INTO stats_daily (metric, day, value)
+        SELECT 'signups', COALESCE(created_at, CURRENT_TIMESTAMP)::date, COUNT(*) FROM new_rows GROUP BY 2
+        ON CONFLICT (metric, day) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM stats_bump('total_credits',
+            COALESCE((SELECT SUM(credits) FROM new_rows WHERE plan <> 'unlimited'), 0)
+            - COALESCE((SELECT SUM(credits) FROM old_rows WHERE plan <> 'unlimited'), 0));
+    ELSE
+        PERFORM stats_bump('total_users', -(SELECT COUNT(*) FROM old_rows));
+        PERFORM stats_bump('total_credits', -(SELECT SUM(credits) FROM old_rows WHERE plan <> 'unlimited'));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_images_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stats_bump('total_images', (SELECT COUNT(*) FROM new_rows));
+        INSERT INTO stats_daily (metric, day, value)
+        SELECT 'generations', COALESCE(created_at, CURRENT_TIMESTAMP)::date, COUNT(*) FROM new_rows GROUP BY 2
+        ON CONFLICT (metric, day) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    ELSE
+        PERFORM stats_bump('total_images', -(SELECT COUNT(*) FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Выручка учитывается в момент перехода транзакции в статус completed
+CREATE OR REPLACE FUNCTION stats_transactions_changed() RETURNS trigger AS $$
+DECLARE
+    bucket RECORD;
+BEGIN
+    FOR bucket IN
+        SELECT COALESCE(n.completed_at, n.created_at, CURRENT_TIMESTAMP)::date AS day, SUM(n.amount) AS amount
+        FROM new_rows n
+        WHERE n.status = 'completed'
+          AND (TG_OP = 'INSERT' OR NOT EXISTS (
+              SELECT 1 FROM old_rows o WHERE o.id = n.id AND o.status = 'completed'
+          ))
+        GROUP BY 1
+    LOOP
+        PERFORM stats_bump('total_revenue', bucket.amount);
+        INSERT INTO stats_daily (metric, day, value) VALUES ('revenue', bucket.day, bucket.amount)
+        ON CONFLICT (metric, day) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS stats_users_insert ON users;
+DROP TRIGGER IF EXISTS stats_users_update ON users;
+DROP TRIGGER IF EXISTS stats_users_delete ON users;
+CREATE TRIGGER stats_users_insert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_users_changed();
+CREATE TRIGGER stats_users_update AFTER UPDATE ON users
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_users_changed();
+CREATE TRIGGER stats_users_delete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_users_changed();
+
+DROP TRIGGER IF EXISTS stats_images_insert ON generated_images;
+DROP TRIGGER IF EXISTS stats_images_delete ON generated_images;
+CREATE TRIGGER stats_images_insert AFTER INSERT ON generated_images
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_images_changed();
+CREATE TRIGGER stats_images_delete AFTER DELETE ON generated_images
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_images_changed();
+
+DROP TRIGGER IF EXISTS stats_transactions_insert ON transactions;
+DROP TRIGGER IF EXISTS stats_transactions_update ON transactions;
+CREATE TRIGGER stats_transactions_insert AFTER INSERT ON transactions
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_transactions_changed();
+CREATE TRIGGER stats_transactions_update AFTER UPDATE ON transactions
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_transactions_changed();
+
+-- Точный пересчёт счётчиков и дневных срезов начиная с since.
+-- EXCLUSIVE-блокировка ждёт завершения транзакций, уже изменивших счётчики,
+-- и задерживает новые до конца пересчёта, поэтому дрейф не теряется.
+CREATE OR REPLACE FUNCTION reconcile_stats(since DATE) RETURNS void AS $$
+BEGIN
+    LOCK TABLE stats_counters, stats_daily IN EXCLUSIVE MODE;
+
+    DELETE FROM stats_counters WHERE name IN ('total_users', 'total_images', 'total_credits', 'total_revenue', 'active_users_7d');
+    INSERT INTO stats_counters (name, shard, value)
+    SELECT 'total_users', 0, COUNT(*) FROM users
+    UNION ALL
+    SELECT 'total_images', 0, COUNT(*) FROM generated_images
+    UNION ALL
+    SELECT 'total_credits', 0, COALESCE(SUM(credits), 0) FROM users WHERE plan <> 'unlimited'
+    UNION ALL
+    SELECT 'total_revenue', 0, COALESCE(SUM(amount), 0) FROM transactions WHERE status = 'completed'
+    UNION ALL
+    SELECT 'active_users_7d', 0, COUNT(DISTINCT user_id) FROM user_sessions WHERE last_activity > NOW() - INTERVAL '7 days';
+
+    DELETE FROM stats_daily WHERE day >= since;
+    INSERT INTO stats_daily (metric, day, value)
+    SELECT 'signups', created_at::date, COUNT(*) FROM users
+    WHERE created_at >= since GROUP BY 2
+    UNION ALL
+    SELECT 'generations', created_at::date, COUNT(*) FROM generated_images
+    WHERE created_at >= since GROUP BY 2
+    UNION ALL
+    SELECT 'revenue', COALESCE(completed_at, created_at)::date, SUM(amount) FROM transactions
+    WHERE status = 'completed' AND COALESCE(completed_at, created_at) >= since GROUP BY 2;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Первичное заполнение за всю историю
+SELECT reconcile_stats(DATE '-infinity');
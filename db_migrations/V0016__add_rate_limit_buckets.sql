@@ -0,0 +1,12 @@
+-- Корзины токенов для ограничения частоты запросов (RATE_LIMIT_BACKEND=postgres)
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    bucket_key TEXT PRIMARY KEY,
+    capacity DOUBLE PRECISION NOT NULL,
+    rate DOUBLE PRECISION NOT NULL,
+    tokens DOUBLE PRECISION NOT NULL,
+    allowed BOOLEAN NOT NULL DEFAULT TRUE,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Индекс для очистки давно неиспользуемых корзин
+CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated_at ON rate_limit_buckets(updated_at);
@@ -0,0 +1,6 @@
+-- Ключ изображения в blob-хранилище (sha256 содержимого) вместо временной ссылки OpenAI
+ALTER TABLE generated_images ADD COLUMN IF NOT EXISTS storage_key TEXT;
+
+-- Асинхронные задачи сохраняют результат в generated_images сами
+ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS theme VARCHAR(50);
+ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS image_id INTEGER REFERENCES generated_images(id);
@@ -0,0 +1,11 @@
+-- Уменьшенные копии изображений для сеток галереи и админ-панели.
+-- variants = {"webp": {"320": url, "640": url, ...}}; NULL означает, что копии
+-- ещё не созданы, пустой объект — что оригинал прочитать не удалось.
+ALTER TABLE generated_images ADD COLUMN IF NOT EXISTS variants JSONB;
+ALTER TABLE gallery_items ADD COLUMN IF NOT EXISTS variants JSONB;
+ALTER TABLE photoshoot_examples ADD COLUMN IF NOT EXISTS variants JSONB;
+
+-- Частичные индексы для возобновляемого дозаполнения по id
+CREATE INDEX IF NOT EXISTS idx_generated_images_variants_pending ON generated_images(id) WHERE variants IS NULL;
+CREATE INDEX IF NOT EXISTS idx_gallery_items_variants_pending ON gallery_items(id) WHERE variants IS NULL;
+CREATE INDEX IF NOT EXISTS idx_photoshoot_examples_variants_pending ON photoshoot_examples(id) WHERE variants IS NULL;
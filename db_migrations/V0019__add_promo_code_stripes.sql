@@ -0,0 +1,13 @@
+-- Полосатые счётчики для «горячих» промокодов.
+-- При stripes > 1 лимит max_uses делится между строками promo_code_stripes,
+-- и одновременные активации блокируют разные строки вместо одной
+-- строки promo_codes. Итог = promo_codes.used_count + SUM(stripes.used_count).
+ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS stripes SMALLINT NOT NULL DEFAULT 1;
+
+CREATE TABLE IF NOT EXISTS promo_code_stripes (
+    promo_code_id INTEGER NOT NULL REFERENCES promo_codes(id) ON DELETE CASCADE,
+    stripe SMALLINT NOT NULL,
+    used_count INTEGER NOT NULL DEFAULT 0,
+    capacity INTEGER,
+    PRIMARY KEY (promo_code_id, stripe)
+);
@@ -0,0 +1,32 @@
+-- Версии публичного контента (галерея, фотосессии) для кэша и ETag.
+-- Любое изменение таблицы увеличивает версию одним триггером уровня оператора.
+CREATE TABLE IF NOT EXISTS content_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO content_versions (name) VALUES ('gallery'), ('photoshoots')
+ON CONFLICT (name) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_content_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE content_versions SET version = version + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS gallery_items_content_version ON gallery_items;
+CREATE TRIGGER gallery_items_content_version AFTER INSERT OR UPDATE OR DELETE ON gallery_items
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_content_version('gallery');
+
+DROP TRIGGER IF EXISTS photoshoot_examples_content_version ON photoshoot_examples;
+CREATE TRIGGER photoshoot_examples_content_version AFTER INSERT OR UPDATE OR DELETE ON photoshoot_examples
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_content_version('photoshoots');
+
+-- Индексы под публичную выдачу в порядке сортировки
+CREATE INDEX IF NOT EXISTS idx_gallery_items_public
+    ON gallery_items(category, is_visible, display_order DESC, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_photoshoot_examples_public
+    ON photoshoot_examples(is_visible, display_order DESC, created_at DESC);
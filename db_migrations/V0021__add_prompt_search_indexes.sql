@@ -0,0 +1,16 @@
+-- Поиск по промптам в админ-панели.
+-- Промпты бывают и на русском, и на английском, поэтому вектор строится
+-- по обеим конфигурациям; триграммный индекс покрывает поиск по фрагментам
+-- слов и опечатки. Индексы по выражению не требуют перезаписи таблицы.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE OR REPLACE FUNCTION prompt_search_vector(prompt TEXT) RETURNS tsvector AS $$
+    SELECT to_tsvector('russian'::regconfig, COALESCE(prompt, ''))
+        || to_tsvector('english'::regconfig, COALESCE(prompt, ''))
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+CREATE INDEX IF NOT EXISTS idx_generated_images_prompt_fts
+    ON generated_images USING GIN (prompt_search_vector(prompt));
+
+CREATE INDEX IF NOT EXISTS idx_generated_images_prompt_trgm
+    ON generated_images USING GIN (prompt gin_trgm_ops);
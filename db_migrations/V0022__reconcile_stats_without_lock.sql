@@ -0,0 +1,64 @@
+-- Пересчёт статистики без эксклюзивной блокировки.
+-- Прежняя версия держала LOCK TABLE stats_counters, stats_daily на время
+-- полных сканов users/generated_images/transactions, и каждый триггер
+-- (регистрация, списание, генерация, оплата) ждал её окончания.
+-- Теперь точные значения и текущие счётчики читаются одним запросом, то есть
+-- из одного снимка: триггер меняет счётчик в той же транзакции, что и строку,
+-- поэтому их разность — это накопленный дрейф. Он добавляется обычным
+-- инкрементом, и изменения, сделанные после снимка, сохраняются.
+CREATE OR REPLACE FUNCTION reconcile_stats(since DATE) RETURNS void AS $$
+DECLARE
+    drift RECORD;
+BEGIN
+    FOR drift IN
+        WITH exact AS (
+            SELECT 'total_users' AS name, COUNT(*)::numeric AS value FROM users
+            UNION ALL
+            SELECT 'total_images', COUNT(*) FROM generated_images
+            UNION ALL
+            SELECT 'total_credits', COALESCE(SUM(credits), 0) FROM users WHERE plan <> 'unlimited'
+            UNION ALL
+            SELECT 'total_revenue', COALESCE(SUM(amount), 0) FROM transactions WHERE status = 'completed'
+        ),
+        counted AS (
+            SELECT name, SUM(value) AS value FROM stats_counters GROUP BY name
+        )
+        SELECT e.name, e.value - COALESCE(c.value, 0) AS delta
+        FROM exact e
+        LEFT JOIN counted c ON c.name = e.name
+    LOOP
+        PERFORM stats_bump(drift.name, drift.delta);
+    END LOOP;
+
+    FOR drift IN
+        WITH exact AS (
+            SELECT 'signups' AS metric, created_at::date AS day, COUNT(*)::numeric AS value FROM users
+            WHERE created_at >= since GROUP BY 2
+            UNION ALL
+            SELECT 'generations', created_at::date, COUNT(*) FROM generated_images
+            WHERE created_at >= since GROUP BY 2
+            UNION ALL
+            SELECT 'revenue', COALESCE(completed_at, created_at)::date, SUM(amount) FROM transactions
+            WHERE status = 'completed' AND COALESCE(completed_at, created_at) >= since GROUP BY 2
+        )
+        SELECT COALESCE(e.metric, s.metric) AS metric, COALESCE(e.day, s.day) AS day,
+               COALESCE(e.value, 0) - COALESCE(s.value, 0) AS delta
+        FROM exact e
+        FULL JOIN (
+            SELECT metric, day, value FROM stats_daily
+            WHERE day >= since AND metric IN ('signups', 'generations', 'revenue')
+        ) s ON s.metric = e.metric AND s.day = e.day
+        WHERE COALESCE(e.value, 0) <> COALESCE(s.value, 0)
+    LOOP
+        INSERT INTO stats_daily (metric, day, value) VALUES (drift.metric, drift.day, drift.delta)
+        ON CONFLICT (metric, day) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    END LOOP;
+
+    -- Активные пользователи не ведутся триггерами и просто перезаписываются
+    INSERT INTO stats_counters (name, shard, value, updated_at)
+    SELECT 'active_users_7d', 0, COUNT(DISTINCT user_id), CURRENT_TIMESTAMP
+    FROM user_sessions
+    WHERE last_activity > NOW() - INTERVAL '7 days'
+    ON CONFLICT (name, shard) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,128 @@
+-- Дневные срезы шардируются так же, как stats_counters.
+-- Каждая регистрация и каждая генерация обновляли одну строку stats_daily
+-- за день ('signups' / 'generations'), и блокировка этой строки выстраивала
+-- в очередь всех писателей со всех инстансов. Теперь строка выбирается по
+-- pg_backend_pid() % 8, итог за день = SUM(value) по шардам.
+ALTER TABLE stats_daily ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE stats_daily DROP CONSTRAINT IF EXISTS stats_daily_pkey;
+ALTER TABLE stats_daily ADD PRIMARY KEY (metric, day, shard);
+
+CREATE OR REPLACE FUNCTION stats_users_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stats_bump('total_users', (SELECT COUNT(*) FROM new_rows));
+        PERFORM stats_bump('total_credits', (SELECT SUM(credits) FROM new_rows WHERE plan <> 'unlimited'));
+        INSERT INTO stats_daily (metric, day, shard, value)
+        SELECT 'signups', COALESCE(created_at, CURRENT_TIMESTAMP)::date, pg_backend_pid() % 8, COUNT(*) FROM new_rows GROUP BY 2
+        ON CONFLICT (metric, day, shard) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM stats_bump('total_credits',
+            COALESCE((SELECT SUM(credits) FROM new_rows WHERE plan <> 'unlimited'), 0)
+            - COALESCE((SELECT SUM(credits) FROM old_rows WHERE plan <> 'unlimited'), 0));
+    ELSE
+        PERFORM stats_bump('total_users', -(SELECT COUNT(*) FROM old_rows));
+        PERFORM stats_bump('total_credits', -(SELECT SUM(credits) FROM old_rows WHERE plan <> 'unlimited'));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_images_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stats_bump('total_images', (SELECT COUNT(*) FROM new_rows));
+        INSERT INTO stats_daily (metric, day, shard, value)
+        SELECT 'generations', COALESCE(created_at, CURRENT_TIMESTAMP)::date, pg_backend_pid() % 8, COUNT(*) FROM new_rows GROUP BY 2
+        ON CONFLICT (metric, day, shard) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    ELSE
+        PERFORM stats_bump('total_images', -(SELECT COUNT(*) FROM old_rows));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_transactions_changed() RETURNS trigger AS $$
+DECLARE
+    bucket RECORD;
+BEGIN
+    FOR bucket IN
+        SELECT COALESCE(n.completed_at, n.created_at, CURRENT_TIMESTAMP)::date AS day, SUM(n.amount) AS amount
+        FROM new_rows n
+        WHERE n.status = 'completed'
+          AND (TG_OP = 'INSERT' OR NOT EXISTS (
+              SELECT 1 FROM old_rows o WHERE o.id = n.id AND o.status = 'completed'
+          ))
+        GROUP BY 1
+    LOOP
+        PERFORM stats_bump('total_revenue', bucket.amount);
+        INSERT INTO stats_daily (metric, day, shard, value) VALUES ('revenue', bucket.day, pg_backend_pid() % 8, bucket.amount)
+        ON CONFLICT (metric, day, shard) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Пересчёт под блокировкой SHARE ROW EXCLUSIVE: она дожидается транзакций,
+-- уже изменивших счётчики, и не пускает новые до конца пересчёта, поэтому
+-- точные значения и суммы счётчиков читаются без параллельных инкрементов
+-- и разность между ними — чистый дрейф. Чтение самих счётчиков (SELECT)
+-- эта блокировка не задерживает.
+CREATE OR REPLACE FUNCTION reconcile_stats(since DATE) RETURNS void AS $$
+DECLARE
+    drift RECORD;
+BEGIN
+    LOCK TABLE stats_counters, stats_daily IN SHARE ROW EXCLUSIVE MODE;
+
+    FOR drift IN
+        WITH exact AS (
+            SELECT 'total_users' AS name, COUNT(*)::numeric AS value FROM users
+            UNION ALL
+            SELECT 'total_images', COUNT(*) FROM generated_images
+            UNION ALL
+            SELECT 'total_credits', COALESCE(SUM(credits), 0) FROM users WHERE plan <> 'unlimited'
+            UNION ALL
+            SELECT 'total_revenue', COALESCE(SUM(amount), 0) FROM transactions WHERE status = 'completed'
+        ),
+        counted AS (
+            SELECT name, SUM(value) AS value FROM stats_counters GROUP BY name
+        )
+        SELECT e.name, e.value - COALESCE(c.value, 0) AS delta
+        FROM exact e
+        LEFT JOIN counted c ON c.name = e.name
+    LOOP
+        PERFORM stats_bump(drift.name, drift.delta);
+    END LOOP;
+
+    FOR drift IN
+        WITH exact AS (
+            SELECT 'signups' AS metric, created_at::date AS day, COUNT(*)::numeric AS value FROM users
+            WHERE created_at >= since GROUP BY 2
+            UNION ALL
+            SELECT 'generations', created_at::date, COUNT(*) FROM generated_images
+            WHERE created_at >= since GROUP BY 2
+            UNION ALL
+            SELECT 'revenue', COALESCE(completed_at, created_at)::date, SUM(amount) FROM transactions
+            WHERE status = 'completed' AND COALESCE(completed_at, created_at) >= since GROUP BY 2
+        )
+        SELECT COALESCE(e.metric, s.metric) AS metric, COALESCE(e.day, s.day) AS day,
+               COALESCE(e.value, 0) - COALESCE(s.value, 0) AS delta
+        FROM exact e
+        FULL JOIN (
+            SELECT metric, day, SUM(value) AS value FROM stats_daily
+            WHERE day >= since AND metric IN ('signups', 'generations', 'revenue')
+            GROUP BY metric, day
+        ) s ON s.metric = e.metric AND s.day = e.day
+        WHERE COALESCE(e.value, 0) <> COALESCE(s.value, 0)
+    LOOP
+        INSERT INTO stats_daily (metric, day, shard, value) VALUES (drift.metric, drift.day, pg_backend_pid() % 8, drift.delta)
+        ON CONFLICT (metric, day, shard) DO UPDATE SET value = stats_daily.value + EXCLUDED.value;
+    END LOOP;
+
+    -- Активные пользователи не ведутся триггерами и просто перезаписываются
+    INSERT INTO stats_counters (name, shard, value, updated_at)
+    SELECT 'active_users_7d', 0, COUNT(DISTINCT user_id), CURRENT_TIMESTAMP
+    FROM user_sessions
+    WHERE last_activity > NOW() - INTERVAL '7 days'
+    ON CONFLICT (name, shard) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,8 @@
+-- Отложенный повтор задач генерации.
+-- Повторяемая ошибка (429, 5xx, таймаут) возвращала задачу в очередь, и тот же
+-- воркер забирал её снова через доли секунды, так что JOB_MAX_ATTEMPTS
+-- исчерпывались за один запуск. Теперь задача ждёт available_at.
+ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS available_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+DROP INDEX IF EXISTS idx_generation_jobs_queued;
+CREATE INDEX IF NOT EXISTS idx_generation_jobs_available ON generation_jobs(available_at) WHERE status = 'queued';
@@ -0,0 +1,99 @@
+'''
+Hashes per second for password hashing in auth, before and after the bounded pool.
+
+Starts --clients threads that each hash --per-client passwords as fast as they
+can, the way concurrent register/login requests in one instance do:
+
+- before: bcrypt.hashpw(..., bcrypt.gensalt()) inline in every caller, as
+  auth did before the pool (gensalt's default cost, 12);
+- after: PasswordHasher from backend/auth/index.py at BCRYPT_ROUNDS with
+  BCRYPT_WORKERS threads and BCRYPT_QUEUE_DEPTH admitted waiters. Callers
+  past that bound get HasherBusy (a 503 in the handler) and are counted as
+  rejected rather than retried.
+
+Prints completed hashes/sec, per-hash latency percentiles and rejections for
+each run. Set BCRYPT_ROUNDS / BCRYPT_WORKERS / BCRYPT_QUEUE_DEPTH the way
+the function is deployed. Needs bcrypt, no database:
+
+    BCRYPT_ROUNDS=12 python3 scripts/bcrypt_pool_bench.py --clients 32 --per-client 4
+'''
+
+import argparse
+import importlib.util
+import os
+import secrets
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple
+
+import bcrypt
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'auth', 'index.py')
+
+def load_auth() -> Any:
+    spec = importlib.util.spec_from_file_location('auth_index', INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def run(hash_one: Callable[[str], str], busy: type, clients: int, per_client: int) -> Tuple[float, List[float], int]:
+    barrier = threading.Barrier(clients)
+
+    def client(_: int) -> Tuple[List[float], int]:
+        timings: List[float] = []
+        rejected = 0
+        barrier.wait()
+        for _ in range(per_client):
+            started = time.perf_counter()
+            try:
+                hash_one(secrets.token_urlsafe(12))
+            except busy:
+                rejected += 1
+                continue
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings, rejected
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(client, range(clients)))
+    elapsed = time.perf_counter() - started
+    return elapsed, [t for timings, _ in results for t in timings], sum(rejected for _, rejected in results)
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(name: str, cost: int, elapsed: float, timings: List[float], rejected: int) -> None:
+    if not timings:
+        print(f'{name:7} cost {cost:2}  no hash completed, {rejected} rejected')
+        return
+    print(f'{name:7} cost {cost:2}  {len(timings) / elapsed:7.1f} hashes/s  p50 {statistics.median(timings):8.1f} ms  '
+          f'p95 {percentile(timings, 0.95):8.1f} ms  max {max(timings):8.1f} ms  {rejected} rejected')
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--per-client', type=int, default=4)
+    args = parser.parse_args()
+
+    auth = load_auth()
+    hasher = auth.password_hasher
+    print(f'{os.cpu_count()} CPUs, {auth.BCRYPT_WORKERS} workers, queue depth {auth.BCRYPT_QUEUE_DEPTH}, '
+          f'{args.clients} clients x {args.per_client} hashes')
+
+    def inline(password: str) -> str:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+    class NeverRaised(Exception):
+        pass
+
+    default_cost = int(bcrypt.gensalt().split(b'$')[2])
+    report('before', default_cost, *run(inline, NeverRaised, args.clients, args.per_client))
+    report('after', hasher.rounds, *run(hasher.hash, auth.HasherBusy, args.clients, args.per_client))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
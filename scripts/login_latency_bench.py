@@ -0,0 +1,112 @@
+'''
+Per-login latency of the auth function with inline and buffered security logs.
+
+Loads backend/auth/index.py twice with different settings and calls its
+handler in-process for --logins sequential logins, --fail-ratio of them with
+a wrong password:
+
+- inline: SECURITY_LOG_FLUSH_SIZE=1, so every logged event is inserted and
+  committed before the response, as each login did before the buffer;
+- buffered: the shipped SECURITY_LOG_FLUSH_SIZE / SECURITY_LOG_FLUSH_INTERVAL.
+
+Rate limits are switched off and bcrypt runs at --rounds (default 4) so the
+numbers show the database writes rather than the hash cost. Needs psycopg2,
+bcrypt and a disposable database with db_migrations applied:
+
+    DATABASE_URL=postgresql://localhost/photoset_scratch python3 scripts/login_latency_bench.py --logins 500
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import secrets
+import statistics
+import sys
+import time
+from typing import Any, Dict, List
+
+import psycopg2
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'auth', 'index.py')
+
+def load_auth(name: str, env: Dict[str, str]) -> Any:
+    os.environ.update(env)
+    spec = importlib.util.spec_from_file_location(name, INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def login_event(email: str, password: str) -> Dict[str, Any]:
+    return {
+        'httpMethod': 'POST',
+        'queryStringParameters': {'action': 'login'},
+        'headers': {'User-Agent': 'login-latency-bench'},
+        'requestContext': {'identity': {'sourceIp': '127.0.0.1'}},
+        'body': json.dumps({'email': email, 'password': password})
+    }
+
+def run(auth: Any, email: str, password: str, logins: int, fail_ratio: float) -> List[float]:
+    fail_every = round(1 / fail_ratio) if fail_ratio > 0 else 0
+    timings = []
+    for i in range(logins):
+        wrong = fail_every and i % fail_every == 0
+        event = login_event(email, password + 'x' if wrong else password)
+        started = time.perf_counter()
+        response = auth.handler(event, None)
+        timings.append((time.perf_counter() - started) * 1000)
+        if response['statusCode'] != (401 if wrong else 200):
+            raise RuntimeError(f'unexpected {response["statusCode"]}: {response["body"]}')
+    auth.security_log.flush(os.environ['DATABASE_URL'])
+    return timings
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--logins', type=int, default=500)
+    parser.add_argument('--fail-ratio', type=float, default=0.2)
+    parser.add_argument('--rounds', type=int, default=4)
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+
+    common = {'RATE_LIMIT_BACKEND': 'none', 'BCRYPT_ROUNDS': str(args.rounds)}
+    inline = load_auth('auth_inline', {**common, 'SECURITY_LOG_FLUSH_SIZE': '1'})
+    os.environ.pop('SECURITY_LOG_FLUSH_SIZE')
+    buffered = load_auth('auth_buffered', common)
+
+    email = f'bench-{secrets.token_hex(6)}@example.com'
+    password = secrets.token_urlsafe(12)
+    inline.handler({
+        'httpMethod': 'POST',
+        'queryStringParameters': {'action': 'register'},
+        'body': json.dumps({'email': email, 'password': password, 'username': 'login-bench'})
+    }, None)
+    try:
+        for name, auth in (('inline', inline), ('buffered', buffered)):
+            run(auth, email, password, min(20, args.logins), args.fail_ratio)
+            timings = run(auth, email, password, args.logins, args.fail_ratio)
+            print(f'{name:9} p50 {statistics.median(timings):7.2f} ms  p95 {percentile(timings, 0.95):7.2f} ms  '
+                  f'p99 {percentile(timings, 0.99):7.2f} ms  mean {statistics.fmean(timings):7.2f} ms')
+    finally:
+        conn = psycopg2.connect(dsn)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT id FROM users WHERE email = %s", (email,))
+            user_ids = [row[0] for row in cur.fetchall()]
+            cur.execute("DELETE FROM security_logs WHERE user_id = ANY(%s) OR details->>'email' = %s", (user_ids, email))
+            cur.execute("DELETE FROM user_sessions WHERE user_id = ANY(%s)", (user_ids,))
+            cur.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+            conn.commit()
+        finally:
+            conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
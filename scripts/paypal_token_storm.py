@@ -0,0 +1,132 @@
+'''
+Retry storm check for the PayPal token cache in payment.
+
+Starts a local stand-in for the PayPal API, points backend/payment/index.py at
+it and warms the token cache. The stand-in then revokes that token, and
+--callers threads released together by a barrier call paypal_request at
+once. Every one of them gets a 401, invalidates the token and retries. The
+check fails unless every call ends in 200 and the whole storm causes exactly
+one extra POST /v1/oauth2/token: refreshes are single-flight, and an
+invalidate for a token that was already replaced is a no-op.
+
+Needs requests, no database or PayPal credentials:
+
+    python3 scripts/paypal_token_storm.py --callers 64 --token-latency 0.2
+'''
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'payment', 'index.py')
+
+def load_payment() -> Any:
+    spec = importlib.util.spec_from_file_location('payment_index', INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakePayPal(ThreadingHTTPServer):
+    '''Issues token-1, token-2, ... and accepts only the latest one'''
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, token_latency: float):
+        super().__init__(('127.0.0.1', 0), FakePayPalHandler)
+        self.token_latency = token_latency
+        self.lock = threading.Lock()
+        self.tokens_issued = 0
+        self.current_token: str | None = None
+        self.rejected = 0
+
+    def revoke(self) -> None:
+        with self.lock:
+            self.current_token = None
+
+class FakePayPalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server = self.server
+        if self.path == '/v1/oauth2/token':
+            time.sleep(server.token_latency)
+            with server.lock:
+                server.tokens_issued += 1
+                server.current_token = f'token-{server.tokens_issued}'
+                token = server.current_token
+            self.reply(200, {'access_token': token, 'expires_in': 32400})
+            return
+        with server.lock:
+            authorized = self.headers.get('Authorization') == f'Bearer {server.current_token}'
+            if not authorized:
+                server.rejected += 1
+        self.reply(200 if authorized else 401, {'id': 'ORDER'} if authorized else {'error': 'invalid_token'})
+
+    def reply(self, status: int, payload: Any) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--callers', type=int, default=64)
+    parser.add_argument('--token-latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    server = FakePayPal(args.token_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ.update({
+        'PAYPAL_API_BASE': f'http://127.0.0.1:{server.server_address[1]}',
+        'PAYPAL_CLIENT_ID': 'storm',
+        'PAYPAL_CLIENT_SECRET': 'storm'
+    })
+    payment = load_payment()
+    failures = []
+    try:
+        payment.get_paypal_access_token()
+        server.revoke()
+        barrier = threading.Barrier(args.callers)
+
+        def call(_: int) -> Any:
+            barrier.wait()
+            try:
+                return payment.paypal_request('POST', '/v2/checkout/orders', json={}).status_code
+            except Exception as e:
+                return type(e).__name__
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.callers) as executor:
+            statuses = list(executor.map(call, range(args.callers)))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+
+    refreshes = server.tokens_issued - 1
+    print(f'{args.callers} callers, {server.rejected} 401s, {refreshes} token refreshes, {elapsed * 1000:.0f} ms')
+    if statuses.count(200) != args.callers:
+        failures.append(f'{args.callers - statuses.count(200)} calls did not end in 200: {sorted(set(map(str, statuses)))}')
+    if refreshes != 1:
+        failures.append(f'{refreshes} token refreshes for one revoked token, expected 1')
+    for failure in failures:
+        print(f'FAIL {failure}')
+    if not failures:
+        print('OK the storm of 401s shared one token refresh')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
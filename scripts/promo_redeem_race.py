@@ -0,0 +1,181 @@
+'''
+Concurrency check for promo code redemption in admin.
+
+Creates one promo code with --max-uses and --stripes and --workers users,
+then redeems the code for every user at once, each on its own connection and
+released together by a barrier. It runs REDEEM_PROMO_SQL from
+backend/admin/index.py itself and commits or rolls back the way the
+activate-promo action does. A monitor thread polls promo_codes.used_count
+plus SUM(promo_code_stripes.used_count) while the race runs. The check fails
+unless exactly min(--workers, --max-uses) users are credited, the striped
+total never passes max_uses, no stripe passes its capacity and every
+credited user has exactly one usage row.
+
+Needs psycopg and a disposable database with db_migrations applied:
+
+    DATABASE_URL=postgresql://localhost/photoset_scratch python3 scripts/promo_redeem_race.py --workers 64 --max-uses 20 --stripes 8
+'''
+
+import argparse
+import importlib.util
+import os
+import secrets
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+
+import psycopg
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'admin', 'index.py')
+
+def load_admin() -> Any:
+    spec = importlib.util.spec_from_file_location('admin_index', INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def create_promo(dsn: str, admin: Any, max_uses: int, stripes: int) -> Tuple[int, str]:
+    code = 'RACE' + secrets.token_hex(4).upper()
+    with psycopg.connect(dsn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO promo_codes (code, generations_count, max_uses, stripes) VALUES (%s, 1, %s, %s) RETURNING id",
+            (code, max_uses, stripes)
+        )
+        promo_id = cur.fetchone()[0]
+        if stripes > 1:
+            cur.executemany(
+                "INSERT INTO promo_code_stripes (promo_code_id, stripe, capacity) VALUES (%s, %s, %s)",
+                [(promo_id, stripe, capacity) for stripe, capacity in enumerate(admin.promo_stripe_capacities(max_uses, stripes))]
+            )
+    return promo_id, code
+
+def create_users(dsn: str, count: int) -> List[int]:
+    tag = secrets.token_hex(6)
+    with psycopg.connect(dsn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO users (email, username, password_hash, credits)
+            SELECT 'promo-race-' || %s || '-' || g || '@example.com', 'promo-race-' || %s || '-' || g, '', 0
+            FROM generate_series(1, %s) AS g
+            RETURNING id
+            """,
+            (tag, tag, count)
+        )
+        return [row[0] for row in cur.fetchall()]
+
+def drop_fixtures(dsn: str, promo_id: int, user_ids: List[int]) -> None:
+    with psycopg.connect(dsn) as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM promo_code_usage WHERE promo_code_id = %s", (promo_id,))
+        cur.execute("DELETE FROM promo_codes WHERE id = %s", (promo_id,))
+        cur.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+
+def read_usage(cur: Any, promo_id: int) -> Tuple[int, List[Tuple[int, int, int | None]]]:
+    cur.execute("SELECT COALESCE(used_count, 0) FROM promo_codes WHERE id = %s", (promo_id,))
+    direct = cur.fetchone()[0]
+    cur.execute("SELECT stripe, used_count, capacity FROM promo_code_stripes WHERE promo_code_id = %s ORDER BY stripe", (promo_id,))
+    return direct, cur.fetchall()
+
+class Monitor(threading.Thread):
+    '''Polls the striped total until stopped and records every state past max_uses or a stripe capacity'''
+
+    def __init__(self, dsn: str, promo_id: int, max_uses: int):
+        super().__init__(daemon=True)
+        self._dsn = dsn
+        self._promo_id = promo_id
+        self._max_uses = max_uses
+        self._halt = threading.Event()
+        self.violations: List[Tuple[int, List[Tuple[int, int, int | None]]]] = []
+        self.samples = 0
+
+    def run(self) -> None:
+        with psycopg.connect(self._dsn, autocommit=True) as conn:
+            cur = conn.cursor()
+            while not self._halt.is_set():
+                direct, stripes = read_usage(cur, self._promo_id)
+                self.samples += 1
+                over_capacity = any(capacity is not None and used > capacity for _, used, capacity in stripes)
+                if direct + sum(used for _, used, _ in stripes) > self._max_uses or over_capacity:
+                    self.violations.append((direct, stripes))
+
+    def stop(self) -> None:
+        self._halt.set()
+        self.join()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--max-uses', type=int, default=20)
+    parser.add_argument('--stripes', type=int, default=8)
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+    if args.workers <= args.max_uses:
+        print('--workers must exceed --max-uses for the race to mean anything', file=sys.stderr)
+        return 2
+
+    admin = load_admin()
+    promo_id, code = create_promo(dsn, admin, args.max_uses, args.stripes)
+    user_ids = create_users(dsn, args.workers)
+    barrier = threading.Barrier(args.workers)
+    failures: List[str] = []
+
+    def redeem(user_id: int) -> bool:
+        with psycopg.connect(dsn) as conn:
+            cur = conn.cursor()
+            barrier.wait()
+            cur.execute(admin.REDEEM_PROMO_SQL, {'code': code, 'user_id': user_id})
+            credited = cur.fetchone()[6]
+            if credited:
+                conn.commit()
+            else:
+                conn.rollback()
+            return credited
+
+    try:
+        monitor = Monitor(dsn, promo_id, args.max_uses)
+        monitor.start()
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            credited = sum(executor.map(redeem, user_ids))
+        monitor.stop()
+
+        with psycopg.connect(dsn) as conn:
+            cur = conn.cursor()
+            direct, stripes = read_usage(cur, promo_id)
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM promo_code_usage WHERE promo_code_id = %s", (promo_id,))
+            usage_rows, usage_users = cur.fetchone()
+            cur.execute("SELECT COUNT(*) FROM users WHERE id = ANY(%s) AND credits > 0", (user_ids,))
+            credited_users = cur.fetchone()[0]
+
+        used = direct + sum(used for _, used, _ in stripes)
+        expected = min(args.workers, args.max_uses)
+        if credited != expected or credited_users != expected:
+            failures.append(f'{credited} redemptions reported, {credited_users} users credited, expected {expected}')
+        if used != credited or used > args.max_uses:
+            failures.append(f'used {used} (direct {direct} + stripes) for {credited} redemptions, max_uses {args.max_uses}')
+        for stripe, stripe_used, capacity in stripes:
+            if capacity is not None and stripe_used > capacity:
+                failures.append(f'stripe {stripe} used {stripe_used} of {capacity}')
+        if usage_rows != credited or usage_users != usage_rows:
+            failures.append(f'{usage_rows} usage rows for {usage_users} users after {credited} redemptions')
+        for state in monitor.violations:
+            failures.append(f'seen direct, stripes = {state}')
+        print(f'{args.workers} workers, max_uses {args.max_uses}, {args.stripes} stripes, '
+              f'{credited} redeemed, stripes {[used for _, used, _ in stripes]}, {monitor.samples} samples')
+    finally:
+        drop_fixtures(dsn, promo_id, user_ids)
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    if not failures:
+        print('OK used never passed max_uses and every redemption was counted once')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
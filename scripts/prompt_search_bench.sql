@@ -0,0 +1,110 @@
+-- Синтетические данные и планы для поиска по промптам в admin-images.
+-- Запускать только на одноразовой базе с применёнными db_migrations:
+--
+--   psql "$SCRATCH_DATABASE_URL" -v rows=1000000 -f scripts/prompt_search_bench.sql
+--
+-- Скрипт добавляет :rows изображений с промптами из русских и английских
+-- слов; слово «кракен» встречается примерно в 0.01% строк, «sunset» — в
+-- каждой третьей. Затем печатает EXPLAIN (ANALYZE, BUFFERS) для прежнего
+-- запроса (OR в WHERE + ORDER BY created_at LIMIT) и для текущего, где у
+-- каждой ветки UNION свои фильтры и ORDER BY created_at DESC LIMIT.
+-- Искать в планах: для «кракен» ветки должны идти через Bitmap Index Scan
+-- по GIN и top-N heapsort, а не через Index Scan по
+-- idx_generated_images_active_created с Filter (обход всей таблицы ради
+-- LIMIT); для «sunset» наоборот — обход idx_generated_images_active_created
+-- с остановкой на 51 строке вместо сортировки трети таблицы.
+\set ON_ERROR_STOP on
+\if :{?rows}
+\else
+\set rows 1000000
+\endif
+
+INSERT INTO users (email, username, password_hash)
+SELECT 'bench' || g || '@example.com', 'bench' || g, ''
+FROM generate_series(1, 1000) AS g
+ON CONFLICT (email) DO NOTHING;
+
+INSERT INTO generated_images (user_id, prompt, image_url, theme, model, created_at, is_archived)
+SELECT
+    (SELECT id FROM users WHERE email = 'bench' || (1 + g % 1000) || '@example.com'),
+    concat_ws(' ',
+        (ARRAY['портрет', 'пейзаж', 'кошка', 'город', 'лес', 'море', 'замок', 'робот'])[1 + g % 8],
+        (ARRAY['на закате', 'ночью', 'в тумане', 'зимой', 'under the rain', 'at dawn', 'in space'])[1 + (g / 8) % 7],
+        (ARRAY['oil painting', 'watercolor', 'photorealistic', 'аниме', 'пиксель-арт'])[1 + (g / 56) % 5],
+        CASE WHEN g % 3 = 0 THEN 'sunset' END,
+        CASE WHEN g % 10007 = 0 THEN 'кракен' END,
+        md5(g::text)
+    ),
+    'https://cdn.example/bench/' || g || '.png',
+    (ARRAY['portrait', 'landscape', 'fantasy', NULL])[1 + g % 4],
+    (ARRAY['dall-e-3', 'dall-e-2'])[1 + g % 2],
+    CURRENT_TIMESTAMP - make_interval(secs => g),
+    g % 20 = 0
+FROM generate_series(1, :rows) AS g;
+
+ANALYZE users;
+ANALYZE generated_images;
+
+\echo '=== прежний запрос, редкое слово ==='
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT gi.id, gi.prompt, gi.created_at, u.username
+FROM generated_images gi
+LEFT JOIN users u ON gi.user_id = u.id
+WHERE gi.is_archived = FALSE
+  AND (prompt_search_vector(gi.prompt) @@ (websearch_to_tsquery('russian', 'кракен') || websearch_to_tsquery('english', 'кракен'))
+       OR gi.prompt ILIKE '%кракен%')
+ORDER BY gi.created_at DESC, gi.id DESC
+LIMIT 51;
+
+\echo '=== текущий запрос, редкое слово ==='
+EXPLAIN (ANALYZE, BUFFERS)
+WITH matched AS (
+    (SELECT gi.id, gi.created_at FROM generated_images gi
+     WHERE prompt_search_vector(gi.prompt) @@ (websearch_to_tsquery('russian', 'кракен') || websearch_to_tsquery('english', 'кракен'))
+       AND gi.is_archived = FALSE
+     ORDER BY gi.created_at DESC, gi.id DESC
+     LIMIT 51)
+    UNION
+    (SELECT gi.id, gi.created_at FROM generated_images gi
+     WHERE gi.prompt ILIKE '%кракен%' AND gi.is_archived = FALSE
+     ORDER BY gi.created_at DESC, gi.id DESC
+     LIMIT 51)
+)
+SELECT gi.id, gi.prompt, gi.created_at, u.username
+FROM matched m
+JOIN generated_images gi ON gi.id = m.id
+LEFT JOIN users u ON gi.user_id = u.id
+ORDER BY m.created_at DESC, m.id DESC
+LIMIT 51;
+
+\echo '=== прежний запрос, частое слово ==='
+EXPLAIN (ANALYZE, BUFFERS)
+SELECT gi.id, gi.prompt, gi.created_at, u.username
+FROM generated_images gi
+LEFT JOIN users u ON gi.user_id = u.id
+WHERE gi.is_archived = FALSE
+  AND (prompt_search_vector(gi.prompt) @@ (websearch_to_tsquery('russian', 'sunset') || websearch_to_tsquery('english', 'sunset'))
+       OR gi.prompt ILIKE '%sunset%')
+ORDER BY gi.created_at DESC, gi.id DESC
+LIMIT 51;
+
+\echo '=== текущий запрос, частое слово ==='
+EXPLAIN (ANALYZE, BUFFERS)
+WITH matched AS (
+    (SELECT gi.id, gi.created_at FROM generated_images gi
+     WHERE prompt_search_vector(gi.prompt) @@ (websearch_to_tsquery('russian', 'sunset') || websearch_to_tsquery('english', 'sunset'))
+       AND gi.is_archived = FALSE
+     ORDER BY gi.created_at DESC, gi.id DESC
+     LIMIT 51)
+    UNION
+    (SELECT gi.id, gi.created_at FROM generated_images gi
+     WHERE gi.prompt ILIKE '%sunset%' AND gi.is_archived = FALSE
+     ORDER BY gi.created_at DESC, gi.id DESC
+     LIMIT 51)
+)
+SELECT gi.id, gi.prompt, gi.created_at, u.username
+FROM matched m
+JOIN generated_images gi ON gi.id = m.id
+LEFT JOIN users u ON gi.user_id = u.id
+ORDER BY m.created_at DESC, m.id DESC
+LIMIT 51;
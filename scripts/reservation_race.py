@@ -0,0 +1,198 @@
+'''
+Concurrency check for the generation reservation in generate-image.
+
+Runs --workers parallel reservations, each on its own connection and
+released together by a barrier, against one subscribed account holding
+--balance credits and one free-tier account with --balance free
+generations. It uses RESERVE_BY_SESSION_SQL and refund_generation from
+backend/generate-image/index.py itself. A monitor thread polls both balances
+while the race runs. The check fails unless exactly --balance reservations
+succeed per account, credits never drop below zero and free usage never
+passes its limit. A second round refunds every reservation concurrently
+with new ones and checks that no credit is lost or created.
+
+Needs psycopg2 and a disposable database with db_migrations applied:
+
+    DATABASE_URL=postgresql://localhost/photoset_scratch python3 scripts/reservation_race.py --workers 64 --balance 10
+'''
+
+import argparse
+import importlib.util
+import os
+import secrets
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+
+import psycopg2
+
+INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'generate-image', 'index.py')
+
+def load_generate_image() -> Any:
+    spec = importlib.util.spec_from_file_location('generate_image_index', INDEX_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def create_account(dsn: str, subscription_status: str, balance: int) -> Tuple[int, str]:
+    tag = secrets.token_hex(6)
+    token = secrets.token_urlsafe(32)
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO users (email, username, password_hash, credits, subscription_status,
+                               free_generations_used, free_generations_limit)
+            VALUES (%s, %s, '', %s, %s, 0, %s)
+            RETURNING id
+            """,
+            (f'race-{tag}@example.com', f'race-{tag}', balance if subscription_status != 'none' else 0,
+             subscription_status, balance if subscription_status == 'none' else 0)
+        )
+        user_id = cur.fetchone()[0]
+        cur.execute(
+            "INSERT INTO user_sessions (user_id, session_token, expires_at) VALUES (%s, %s, CURRENT_TIMESTAMP + INTERVAL '1 hour')",
+            (user_id, token)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return user_id, token
+
+def drop_accounts(dsn: str, user_ids: List[int]) -> None:
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM user_sessions WHERE user_id = ANY(%s)", (user_ids,))
+        cur.execute("DELETE FROM users WHERE id = ANY(%s)", (user_ids,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def read_balance(cur: Any, user_id: int) -> Tuple[int, int, int]:
+    cur.execute("SELECT credits, free_generations_used, free_generations_limit FROM users WHERE id = %s", (user_id,))
+    return cur.fetchone()
+
+class Monitor(threading.Thread):
+    '''Polls balances until stopped and records every state that breaks an invariant'''
+
+    def __init__(self, dsn: str, user_ids: List[int]):
+        super().__init__(daemon=True)
+        self._dsn = dsn
+        self._user_ids = user_ids
+        self._halt = threading.Event()
+        self.violations: List[Tuple[int, Tuple[int, int, int]]] = []
+        self.samples = 0
+
+    def run(self) -> None:
+        conn = psycopg2.connect(self._dsn)
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            while not self._halt.is_set():
+                for user_id in self._user_ids:
+                    credits, free_used, free_limit = read_balance(cur, user_id)
+                    self.samples += 1
+                    if credits < 0 or free_used > free_limit or free_used < 0:
+                        self.violations.append((user_id, (credits, free_used, free_limit)))
+        finally:
+            conn.close()
+
+    def stop(self) -> None:
+        self._halt.set()
+        self.join()
+
+def race(dsn: str, workers: int, task: Any) -> List[Any]:
+    barrier = threading.Barrier(workers)
+
+    def run(index: int) -> Any:
+        conn = psycopg2.connect(dsn)
+        try:
+            barrier.wait()
+            return task(conn, index)
+        finally:
+            conn.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run, range(workers)))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--balance', type=int, default=10)
+    args = parser.parse_args()
+
+    dsn = os.environ.get('DATABASE_URL')
+    if not dsn:
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 2
+    if args.workers <= args.balance:
+        print('--workers must exceed --balance for the race to mean anything', file=sys.stderr)
+        return 2
+
+    generate_image = load_generate_image()
+    accounts = {
+        'credit': create_account(dsn, 'active', args.balance),
+        'free': create_account(dsn, 'none', args.balance)
+    }
+    user_ids = [user_id for user_id, _ in accounts.values()]
+    failures: List[str] = []
+    try:
+        monitor = Monitor(dsn, user_ids)
+        monitor.start()
+
+        for kind, (user_id, token) in accounts.items():
+            def reserve(conn: Any, index: int) -> Any:
+                cur = conn.cursor()
+                cur.execute(generate_image.RESERVE_BY_SESSION_SQL, (token,))
+                row = cur.fetchone()
+                conn.commit()
+                return row
+
+            granted = [row for row in race(dsn, args.workers, reserve) if row]
+            if len(granted) != args.balance:
+                failures.append(f'{kind}: {len(granted)} of {args.workers} reservations succeeded, expected {args.balance}')
+
+            # Refund everything that was granted while the same number of new
+            # reservations compete for the credits being returned
+            charge = generate_image.charge_kind(granted[0][3] if granted else None, False)
+
+            def refund_or_reserve(conn: Any, index: int) -> Any:
+                cur = conn.cursor()
+                if index < len(granted):
+                    generate_image.refund_generation(cur, user_id, charge)
+                    conn.commit()
+                    return 'refunded'
+                cur.execute(generate_image.RESERVE_BY_SESSION_SQL, (token,))
+                row = cur.fetchone()
+                conn.commit()
+                return 'reserved' if row else None
+
+            outcomes = race(dsn, max(args.workers, 2 * len(granted)), refund_or_reserve)
+            reserved = outcomes.count('reserved')
+            conn = psycopg2.connect(dsn)
+            try:
+                credits, free_used, free_limit = read_balance(conn.cursor(), user_id)
+            finally:
+                conn.close()
+            remaining = credits if kind == 'credit' else free_limit - free_used
+            if reserved > len(granted) or remaining != args.balance - reserved:
+                failures.append(f'{kind}: {reserved} re-reserved after {len(granted)} refunds, {remaining} left, expected {args.balance - reserved}')
+
+        monitor.stop()
+        for user_id, state in monitor.violations:
+            failures.append(f'user {user_id} seen with credits, free_used, free_limit = {state}')
+        print(f'{args.workers} workers, balance {args.balance}, {monitor.samples} balance samples')
+    finally:
+        drop_accounts(dsn, user_ids)
+
+    for failure in failures:
+        print(f'FAIL {failure}')
+    if not failures:
+        print('OK balances never went negative and no reservation was lost or duplicated')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -53,14 +53,14 @@ const AdminDashboard = () => {
       return;
     }
 
-    loadStats();
+    loadDashboard();
   };
 
-  const loadStats = async () => {
+  const loadDashboard = async () => {
     setLoading(true);
     try {
       const sessionToken = localStorage.getItem('session_token');
-      const response = await fetch('https://functions.poehali.dev/d72c2702-d925-43c1-9343-c8c94ce97cf1?action=admin_stats', {
+      const response = await fetch('https://functions.poehali.dev/d72c2702-d925-43c1-9343-c8c94ce97cf1?action=admin_dashboard', {
         headers: {
           'X-Session-Token': sessionToken || ''
         }
@@ -69,9 +69,11 @@ const AdminDashboard = () => {
       const data = await response.json();
       if (data.success) {
         setStats(data.stats);
+        setUsers(data.users);
+        setImages(data.images);
       }
     } catch (error) {
-      console.error('Error loading stats:', error);
+      console.error('Error loading dashboard:', error);
     } finally {
       setLoading(false);
     }
@@ -129,14 +131,6 @@ const AdminDashboard = () => {
     navigate('/login');
   };
 
-  useEffect(() => {
-    if (activeTab === 'users') {
-      loadUsers();
-    } else if (activeTab === 'images') {
-      loadImages();
-    }
-  }, [activeTab]);
-
   return (
     <div className="min-h-screen bg-gradient-to-br from-black via-gray-900 to-primary/20">
       <AdminHeader 
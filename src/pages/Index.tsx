@@ -242,7 +242,8 @@ const Index = () => {
         body: JSON.stringify({
           prompt: promptText,
           size: '1024x1024',
-          model: 'dall-e-3'
+          model: 'dall-e-3',
+          theme: selectedTheme
         })
       });
 
@@ -282,23 +283,8 @@ const Index = () => {
           });
         }
         
-        const saveResponse = await fetch('https://functions.poehali.dev/d94b5564-3eda-4bec-a6fb-a93cd0de2407', {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
-            user_id: user.id,
-            prompt: promptText,
-            image_url: data.image_url,
-            theme: selectedTheme,
-            model: 'dall-e-3'
-          })
-        });
-        
-        const savedData = await saveResponse.json();
-        if (savedData.success && savedData.image) {
-          addImage(savedData.image);
+        if (data.image) {
+          addImage(data.image);
         }
 
         toast({